@@ -16,7 +16,8 @@ class PlayPolicyBase(ABC):
         """
         If `color` is allowed to take an action, select one and return it.
         Otherwise, do any bookkeeping related to the last action taken and
-        return None
+        return None. `game` is the client's copy of the game, which persists
+        across turns and so must not be modified
         """
 
         raise NotImplementedError()
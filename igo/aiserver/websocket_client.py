@@ -4,16 +4,19 @@ via `await Client(...).start()`. See notes there for details
 """
 
 import asyncio
-from typing import Dict, Optional
+from collections import deque
+from datetime import datetime
+from typing import Callable, Deque, Dict, Optional, Union
 from asyncinit import asyncinit
 from .policy.random import RandomPolicy
 from .policy.base import PlayPolicyBase
-from igo.game import Action, GameStatus
+from igo.game import Action, ActionType, Board, Color, Game, GameStatus
 import logging
 from igo.gameserver.containers import (
     ActionResponseContainer,
     ErrorContainer,
     GameStatusContainer,
+    GameStatusDeltaContainer,
     JoinGameResponseContainer,
     OpponentConnectedContainer,
 )
@@ -22,7 +25,19 @@ from igo.gameserver.messages import (
     OutgoingMessage,
     OutgoingMessageType,
 )
-from igo.gameserver.constants import ACTION_TYPE, COORDS, KEY, TYPE, AI_SECRET
+from igo.gameserver import wire
+from igo.gameserver.constants import (
+    ACTION_TYPE,
+    BINARY_SUBPROTOCOL,
+    COORDS,
+    FEATURE_BATCH,
+    FEATURE_COMPACT,
+    FEATURE_DELTA,
+    FEATURES,
+    KEY,
+    TYPE,
+    AI_SECRET,
+)
 import json
 from tornado.options import define, options
 from tornado.websocket import (
@@ -57,12 +72,25 @@ class Client:
         # resend
         self.last_message_id = 0
         self.connection: Optional[WebSocketClientConnection] = None
+        # whether the game server agreed to the binary subprotocol. see wire
+        self.binary = False
+        # the latest game status, to which game status deltas are applied. its
+        # game persists across updates where possible, see _update_game_status
+        self.game_status: Optional[GameStatusContainer] = None
+        # messages received in a batch which have yet to be read
+        self.unread: Deque[OutgoingMessage] = deque()
 
     async def _connect(self) -> None:
         url: str = options.game_server_url
+        url += (
+            f"{'&' if '?' in url else '?'}{FEATURES}="
+            f"{FEATURE_DELTA},{FEATURE_COMPACT},{FEATURE_BATCH}"
+        )
         while True:
             try:
-                self.connection = await websocket_connect(url)
+                self.connection = await websocket_connect(
+                    url, subprotocols=[BINARY_SUBPROTOCOL]
+                )
             except:
                 logging.exception(
                     "Something went wrong while attempting to (re)connect to"
@@ -70,20 +98,34 @@ class Client:
                 )
                 await asyncio.sleep(ERROR_SLEEP_PERIOD)
             else:
-                logging.info(f"Successfully connected to {url}")
+                self.binary = (
+                    getattr(self.connection, "selected_subprotocol", None)
+                    == BINARY_SUBPROTOCOL
+                )
+                logging.info(
+                    f"Successfully connected to {url} using"
+                    f" {BINARY_SUBPROTOCOL if self.binary else 'JSON'}"
+                )
                 break
 
     async def _read(self) -> OutgoingMessage:
+        if self.unread:
+            return self.unread.popleft()
         if not self.connection:
             await self._connect()
 
         while True:
-            msg: Optional[str] = await self.connection.read_message()
+            msg: Optional[Union[str, bytes]] = await self.connection.read_message()
             # per the docs, the read_message Future returns None if the
             # connection is closed. we always assume that the connection being
             # closed is an error and attempt to reconnect
             if msg is not None:
-                res: OutgoingMessage = OutgoingMessage.deserialize(msg)
+                res: OutgoingMessage = OutgoingMessage.deserialize(
+                    wire.decode(msg) if isinstance(msg, bytes) else msg
+                )
+                if res.message_type is OutgoingMessageType.batch:
+                    self.unread.extend(res.data.messages)
+                    return self.unread.popleft()
                 return res
             else:
                 logging.error(
@@ -96,13 +138,17 @@ class Client:
         if not self.connection:
             await self._connect()
 
-        jsonified: str = json.dumps(message)
         while True:
             try:
-                await self.connection.write_message(jsonified)
+                if self.binary:
+                    await self.connection.write_message(
+                        wire.encode(message), binary=True
+                    )
+                else:
+                    await self.connection.write_message(json.dumps(message))
             except:
                 logging.exception(
-                    f"Something went wrong while attempting to write {jsonified}"
+                    f"Something went wrong while attempting to write {message}"
                     " to the socket"
                 )
                 await self._connect()
@@ -134,6 +180,119 @@ class Client:
         logging.info(f"Shutting down connection for player key {self.player_key}")
         self.connection.close()
 
+    def _update_game_status(self, message: OutgoingMessage) -> bool:
+        """Bring `self.game_status` up to date with a game status or game status
+        delta message. Return False if it is a delta which doesn't apply to the
+        current status, in which case we need a resync
+
+        A game deserialized from a game status has none of the history that
+        makes ko legal or not (see `Game._deserialize`), and rebuilding one
+        every turn is most of the work done by the client outside of the
+        policy. So, where the server's version tells us that exactly one action
+        was taken since our current status, we take that action on our own
+        game instead, and keep it if the result matches what the server sent.
+        Otherwise, e.g. after a resync or for anything other than a stone
+        placement or pass, we fall back to the server's game"""
+
+        if message.message_type is OutgoingMessageType.game_status:
+            status: GameStatusContainer = message.data
+            if self._advance_game(
+                status.version,
+                status.game.jsonifyable_without_board(),
+                lambda game, _: game.board._data == status.game.board._data,
+            ):
+                self.game_status = GameStatusContainer(
+                    self.game_status.game,
+                    status.time_played,
+                    status.version,
+                    status.compact,
+                )
+            else:
+                self.game_status = status
+            return True
+
+        delta: GameStatusDeltaContainer = message.data
+        if (
+            not self.game_status
+            or self.game_status.version is None
+            or self.game_status.version != delta.base_version
+        ):
+            return False
+
+        def board_matches(game: Game, base_board: bytes) -> bool:
+            board = Board(game.board.size)
+            board._data[:] = base_board
+            for i, j, point in delta.changes:
+                board._set_point(i, j, point)
+            return board._data == game.board._data
+
+        if self._advance_game(delta.version, delta.fields, board_matches):
+            self.game_status = GameStatusContainer(
+                self.game_status.game,
+                delta.time_played,
+                delta.version,
+                self.game_status.compact,
+            )
+        else:
+            self.game_status = self.game_status.apply_delta(delta)
+        return True
+
+    def _advance_game(
+        self,
+        version: Optional[int],
+        fields: Dict,
+        board_matches: Callable[[Game, bytes], bool],
+    ) -> bool:
+        """Try to bring the game of `self.game_status` to `version` of the game
+        status, for which the server sent `fields` (see
+        `Game.jsonifyable_without_board`) and a board which `board_matches`,
+        given our game and the packed state of our board beforehand. Return
+        whether we did so. If not, the game is left as it was"""
+
+        if not self.game_status or self.game_status.version is None or version is None:
+            return False
+        game = self.game_status.game
+        base_board = bytes(game.board._data)
+        if version == self.game_status.version:
+            # e.g. a resync of the status which we already have
+            return self._fields_match(game, fields) and board_matches(game, base_board)
+        if version != self.game_status.version + 1:
+            return False
+
+        if fields["lastMove"]:
+            action = Action(
+                ActionType.place_stone,
+                Color[fields["turn"]].inverse(),
+                datetime.now().timestamp(),
+                tuple(fields["lastMove"]),
+            )
+        elif game.status is GameStatus.play:
+            # which may also have been a request or resignation, in which case
+            # the result won't match below
+            action = Action(ActionType.pass_turn, game.turn, datetime.now().timestamp())
+        else:
+            return False
+        snapshot = game._snapshot()
+        num_actions = len(game.action_stack)
+        success, _ = game.take_action(action)
+        if not success:
+            return False
+        if self._fields_match(game, fields) and board_matches(game, base_board):
+            return True
+        self.game_status.game = Game._restore(
+            snapshot, game.action_stack[:num_actions], game.komi, game.superko
+        )
+        return False
+
+    @staticmethod
+    def _fields_match(game: Game, fields: Dict) -> bool:
+        ours = game.jsonifyable_without_board()
+        # the last move may be a tuple or a list, depending on where it came from
+        return {**ours, "lastMove": ours["lastMove"] and list(ours["lastMove"])} == {
+            **fields,
+            "lastMove": fields["lastMove"] and list(fields["lastMove"]),
+        }
+
     async def _message_consumer(self) -> None:
         while True:
             message = await self._read()
@@ -156,9 +315,23 @@ class Client:
                     )
 
             # game status
-            elif message.message_type is OutgoingMessageType.game_status:
-                game_status: GameStatusContainer = message.data
-                game = game_status.game
+            elif message.message_type in (
+                OutgoingMessageType.game_status,
+                OutgoingMessageType.game_status_delta,
+            ):
+                if not self._update_game_status(message):
+                    logging.info(
+                        f"Game status for player key {self.player_key} is stale."
+                        " Requesting a resync"
+                    )
+                    await self._write(
+                        {
+                            TYPE: IncomingMessageType.resync_game.name,
+                            KEY: self.player_key,
+                        }
+                    )
+                    continue
+                game = self.game_status.game
                 if game.status is GameStatus.complete:
                     break
                 action: Action = await self.play_policy.play(game, self.color)
@@ -0,0 +1,631 @@
+"""
+In-process microbenchmarks for hot paths in the game engine and server. Where
+`igo.gameserver.perf_runner` measures a running server end to end, these are
+meant for quick before/after comparisons of a single change. Run e.g.
+
+    python -m igo.benchmarks --benchmark=placement
+
+or specify `--help` for the full list of options
+"""
+
+from copy import deepcopy
+import json
+import pickle
+import random
+from time import perf_counter
+import tracemalloc
+from typing import Callable, Dict, List
+from igo.codec import decode_game, encode_game
+from igo.game import Action, ActionType, Board, Color, Game, count_territories, np
+from igo.replay import DEFAULT_INTERVAL, Replay, replay_all
+from tornado.options import define, options
+
+define(
+    "benchmark",
+    default="all",
+    help="run the named benchmark, or all of them if 'all'",
+    type=str,
+)
+define(
+    "iterations",
+    default=200,
+    help="repeat each timed operation the given number of times",
+    type=int,
+)
+define(
+    "sample_game_path",
+    default="sample_game.bin",
+    help="the path to a pickled sample game to use as input",
+    type=str,
+)
+
+_BENCHMARKS: Dict[str, Callable[[], None]] = {}
+
+
+def benchmark(fn: Callable[[], None]) -> Callable[[], None]:
+    """Register `fn` to be run under its own name"""
+
+    _BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def load_sample_game() -> Game:
+    with open(options.sample_game_path, "rb") as reader:
+        return pickle.load(reader)
+
+
+def fmt(seconds: float) -> str:
+    """Format `seconds` in the most readable unit"""
+
+    if seconds >= 1:
+        return f"{seconds:.04}s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.04}ms"
+    return f"{seconds * 1e6:.04}µs"
+
+
+def replay(game: Game) -> Game:
+    """Replay `game`'s action stack in a fresh game and return the result"""
+
+    res = Game(game.board.size, game.komi)
+    for action in game.action_stack:
+        success, msg = res.take_action(action)
+        assert success, msg
+    return res
+
+
+@benchmark
+def placement() -> None:
+    """
+    Time `take_action` on every action of the sample game as well as
+    `legal_moves` at every position along the way
+    """
+
+    sample_game = load_sample_game()
+    actions: List[Action] = sample_game.action_stack
+    num_placements = sum(a.action_type is ActionType.place_stone for a in actions)
+
+    start = perf_counter()
+    for _ in range(options.iterations):
+        replay(sample_game)
+    replay_time = perf_counter() - start
+
+    # time placements alone by replaying up to each placement untimed
+    placement_time = 0.0
+    legal_moves_time = 0.0
+    num_legal_moves_calls = 0
+    for _ in range(max(1, options.iterations // 10)):
+        game = Game(sample_game.board.size, sample_game.komi)
+        for action in actions:
+            if action.action_type is ActionType.place_stone:
+                start = perf_counter()
+                game.legal_moves(game.turn)
+                legal_moves_time += perf_counter() - start
+                num_legal_moves_calls += 1
+                start = perf_counter()
+                game.take_action(action)
+                placement_time += perf_counter() - start
+            else:
+                game.take_action(action)
+
+    print(f"Sample game: {sample_game.board.size}x{sample_game.board.size}")
+    print(f"Actions per replay: {len(actions)} ({num_placements} placements)")
+    print(f"Mean replay time: {fmt(replay_time / options.iterations)}")
+    print(f"Mean action time: {fmt(replay_time / options.iterations / len(actions))}")
+    print(
+        "Mean placement time:"
+        f" {fmt(placement_time / (max(1, options.iterations // 10) * num_placements))}"
+    )
+    print(f"Mean legal_moves time: {fmt(legal_moves_time / num_legal_moves_calls)}")
+
+
+@benchmark
+def persistence() -> None:
+    """
+    Report the size of the sample game as written to the database, and time
+    writing and reading it back, with `igo.codec` versus pickle
+    """
+
+    game = replay(load_sample_game())
+    for name, dumps, loads in (
+        ("pickle", pickle.dumps, pickle.loads),
+        ("codec", encode_game, decode_game),
+    ):
+        blob = dumps(game)
+
+        start = perf_counter()
+        for _ in range(options.iterations):
+            dumps(game)
+        dumps_time = perf_counter() - start
+
+        start = perf_counter()
+        for _ in range(options.iterations):
+            loads(blob)
+        loads_time = perf_counter() - start
+
+        print(f"{name}:")
+        print(f"  Size: {len(blob)} bytes")
+        print(f"  Mean encode time: {fmt(dumps_time / options.iterations)}")
+        print(f"  Mean decode time: {fmt(loads_time / options.iterations)}")
+
+
+@benchmark
+def memory() -> None:
+    """
+    Report the memory held by a game in the sample game's final position, and
+    time copying it
+    """
+
+    sample_game = load_sample_game()
+    # the action stack is shared with the sample game so as to only count the
+    # memory held by the game state
+    tracemalloc.start()
+    games = [replay(sample_game) for _ in range(options.iterations)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = perf_counter()
+    for game in games:
+        deepcopy(game.board)
+    board_copy_time = perf_counter() - start
+
+    print(f"Memory per game: {size / len(games) / 1024:.01f}KiB")
+    print(f"Mean board deepcopy time: {fmt(board_copy_time / len(games))}")
+
+
+@benchmark
+def board_sizes() -> None:
+    """
+    Time stone placement, `legal_moves` and territory counting over seeded
+    random games on each of the standard board sizes
+    """
+
+    for size in (9, 13, 19):
+        rng = random.Random(size)
+        placement_time = 0.0
+        legal_moves_time = 0.0
+        territory_time = 0.0
+        num_placements = 0
+        num_games = max(1, options.iterations // 20)
+        for _ in range(num_games):
+            game = Game(size)
+            # stop well short of filling the board so as to not spend all of
+            # our time in the sparse endgame of random play
+            for _ in range(size * size // 2):
+                start = perf_counter()
+                moves = game.legal_moves()
+                legal_moves_time += perf_counter() - start
+                if not moves:
+                    break
+                action = Action(ActionType.place_stone, game.turn, 0, rng.choice(moves))
+                start = perf_counter()
+                game.take_action(action)
+                placement_time += perf_counter() - start
+                num_placements += 1
+            start = perf_counter()
+            game._count_territory()
+            territory_time += perf_counter() - start
+
+        print(f"{size}x{size}:")
+        print(f"  Mean placement time: {fmt(placement_time / num_placements)}")
+        print(f"  Mean legal_moves time: {fmt(legal_moves_time / num_placements)}")
+        print(f"  Mean territory count time: {fmt(territory_time / num_games)}")
+
+
+@benchmark
+def territory() -> None:
+    """
+    Time counting the territory of a batch of random positions on each of the
+    standard board sizes, one board at a time and all at once
+    """
+
+    for size in (9, 13, 19):
+        rng = random.Random(size)
+        boards = []
+        for _ in range(max(1, options.iterations // 2)):
+            game = Game(size)
+            for _ in range(rng.randrange(size * size // 3, size * size * 2 // 3)):
+                moves = game.legal_moves()
+                if not moves:
+                    break
+                game.take_action(
+                    Action(ActionType.place_stone, game.turn, 0, rng.choice(moves))
+                )
+            boards.append(game.board)
+
+        start = perf_counter()
+        for board in boards:
+            board.territory_map()
+        single_time = perf_counter() - start
+
+        start = perf_counter()
+        count_territories(boards)
+        batch_time = perf_counter() - start
+
+        print(f"{size}x{size}:")
+        print(f"  Mean territory_map time: {fmt(single_time / len(boards))}")
+        print(
+            f"  Mean count_territories time per board ({len(boards)} boards"
+            f"{'' if np else ', without numpy'}): {fmt(batch_time / len(boards))}"
+        )
+
+
+@benchmark
+def seek() -> None:
+    """
+    Time rebuilding random positions of long, seeded random games on a 19x19
+    board by naive replay from the start versus with a `Replay`, along with
+    stepping backwards through a whole game
+    """
+
+    rng = random.Random(19)
+    games = []
+    for _ in range(max(1, options.iterations // 20)):
+        game = Game(19)
+        for _ in range(300):
+            moves = game.legal_moves()
+            if not moves:
+                break
+            game.take_action(
+                Action(ActionType.place_stone, game.turn, 0, rng.choice(moves))
+            )
+        games.append(game)
+    targets = [
+        (game, rng.randrange(len(game.action_stack) + 1))
+        for game in games
+        for _ in range(10)
+    ]
+
+    start = perf_counter()
+    for game, k in targets:
+        res = Game(19)
+        for action in game.action_stack[:k]:
+            res.take_action(action)
+    naive_time = perf_counter() - start
+
+    start = perf_counter()
+    replays = replay_all(games)
+    build_time = perf_counter() - start
+    by_game = {id(game): r for game, r in zip(games, replays)}
+
+    start = perf_counter()
+    for game, k in targets:
+        by_game[id(game)].position_at(k)
+    position_at_time = perf_counter() - start
+
+    start = perf_counter()
+    num_steps = 0
+    for r in replays:
+        while r.position:
+            r.step_back()
+            num_steps += 1
+    step_back_time = perf_counter() - start
+
+    snapshot_size = sum(len(s[1]) for r in replays for s in r._snapshots)
+    num_actions = sum(len(r) for r in replays)
+    print(f"Games: {len(games)}, mean length {num_actions / len(games):.01f} actions")
+    print(f"Snapshot interval: {DEFAULT_INTERVAL}")
+    print(f"Mean naive replay to position: {fmt(naive_time / len(targets))}")
+    print(f"Mean Replay.position_at time: {fmt(position_at_time / len(targets))}")
+    print(f"Mean Replay.step_back time: {fmt(step_back_time / num_steps)}")
+    print(f"Mean Replay build time per game: {fmt(build_time / len(games))}")
+    print(f"Mean board snapshot bytes per action: {snapshot_size / num_actions:.01f}")
+
+
+@benchmark
+def wire() -> None:
+    """
+    Report the size of the board of a 19x19 game in the middle of play as sent
+    to clients, and time encoding it to and decoding it from JSON, in the full
+    representation versus the compact one
+    """
+
+    rng = random.Random(0)
+    game = Game(19)
+    for _ in range(150):
+        coords = rng.choice(game.legal_moves())
+        game.take_action(Action(ActionType.place_stone, game.turn, 0, coords))
+
+    for name, compact in (("full", False), ("compact", True)):
+        blob = json.dumps(game.board.jsonifyable(compact))
+
+        start = perf_counter()
+        for _ in range(options.iterations):
+            json.dumps(game.board.jsonifyable(compact))
+        encode_time = perf_counter() - start
+
+        start = perf_counter()
+        for _ in range(options.iterations):
+            Board.deserialize(blob)
+        decode_time = perf_counter() - start
+
+        print(f"{name}:")
+        print(f"  Size: {len(blob)} bytes")
+        print(f"  Mean encode time: {fmt(encode_time / options.iterations)}")
+        print(f"  Mean decode time: {fmt(decode_time / options.iterations)}")
+
+
+@benchmark
+def protocol() -> None:
+    """
+    Measure the messages per second which can be encoded and decoded, and
+    their mean size, for the messages exchanged in playing a move, as JSON
+    versus the binary subprotocol. Run `igo.gameserver.perf_runner` with and
+    without `--binary` for the end to end comparison
+    """
+
+    # imported here so as to not pull in the game server for the other
+    # benchmarks
+    from igo.gameserver import wire
+    from igo.gameserver.containers import ActionResponseContainer, GameStatusContainer
+    from igo.gameserver.messages import OutgoingMessage, OutgoingMessageType
+
+    game = replay(load_sample_game())
+    outgoing = [
+        OutgoingMessage(
+            OutgoingMessageType.game_status,
+            GameStatusContainer(game, 123.4, game.version(), compact),
+        ).jsonifyable()
+        for compact in (False, True)
+    ]
+    outgoing.append(
+        OutgoingMessage(
+            OutgoingMessageType.game_action_response,
+            ActionResponseContainer(True, "success"),
+        ).jsonifyable()
+    )
+    incoming = {
+        "type": "game_action",
+        "key": "0123456789",
+        "action_type": "place_stone",
+        "coords": [3, 4],
+    }
+
+    for name, dumps, loads in (
+        ("json", json.dumps, json.loads),
+        ("binary", wire.encode, wire.decode),
+    ):
+        print(f"{name}:")
+        for label, messages in (
+            ("full game_status", outgoing[:1]),
+            ("compact game_status", outgoing[1:2]),
+            ("game_action_response", outgoing[2:]),
+            ("game_action", [incoming]),
+        ):
+            blob = dumps(messages[0])
+            start = perf_counter()
+            for _ in range(options.iterations):
+                loads(dumps(messages[0]))
+            elapsed = perf_counter() - start
+            print(
+                f"  {label}: {len(blob)} bytes,"
+                f" {options.iterations / elapsed:,.0f} messages/sec round trip"
+            )
+
+
+@benchmark
+def serializers() -> None:
+    """
+    Time serializing a representative message of each outgoing message type to
+    JSON via `jsonifyable` and `json.dumps` versus the fast path serializers,
+    which must produce the same text
+    """
+
+    # imported here so as to not pull in the game server for the other
+    # benchmarks
+    from igo.gameserver.chat import ChatMessage, ChatThread
+    from igo.gameserver.containers import (
+        ActionResponseContainer,
+        ErrorContainer,
+        GameStatusContainer,
+        GameStatusDeltaContainer,
+        JoinGameResponseContainer,
+        KeyContainer,
+        NewGameResponseContainer,
+        OpponentConnectedContainer,
+    )
+    from igo.gameserver.messages import (
+        MessageBatch,
+        OutgoingMessage,
+        OutgoingMessageType,
+    )
+
+    # a game in the middle of play, and the status before its last move
+    rng = random.Random(0)
+    game = Game(19)
+    for _ in range(150):
+        base = deepcopy(game)
+        coords = rng.choice(game.legal_moves())
+        game.take_action(Action(ActionType.place_stone, game.turn, 0, coords))
+    keys = KeyContainer("0123456789", "9876543210")
+    delta = GameStatusDeltaContainer.from_boards(
+        game, 123.4, base.version(), bytes(base.board._data)
+    )
+    chat = ChatThread(
+        [ChatMessage(1.5 * k, Color.black, f"message {k}", k) for k in range(10)], True
+    )
+    messages = [
+        (t.name, OutgoingMessage(t, d))
+        for t, d in (
+            (
+                OutgoingMessageType.new_game_response,
+                NewGameResponseContainer(True, "success", keys, Color.white),
+            ),
+            (
+                OutgoingMessageType.join_game_response,
+                JoinGameResponseContainer(True, "success", keys, Color.black),
+            ),
+            (
+                OutgoingMessageType.game_action_response,
+                ActionResponseContainer(True, "success"),
+            ),
+            (OutgoingMessageType.game_status, GameStatusContainer(game, 123.4)),
+            (OutgoingMessageType.chat, chat),
+            (OutgoingMessageType.opponent_connected, OpponentConnectedContainer(True)),
+            (OutgoingMessageType.error, ErrorContainer(Exception("error"))),
+            (OutgoingMessageType.game_status_delta, delta),
+        )
+    ]
+    messages.insert(
+        4,
+        (
+            "game_status (compact)",
+            OutgoingMessage(
+                OutgoingMessageType.game_status,
+                GameStatusContainer(game, 123.4, game.version(), True),
+            ),
+        ),
+    )
+    messages.append(
+        (
+            OutgoingMessageType.batch.name,
+            OutgoingMessage(
+                OutgoingMessageType.batch,
+                MessageBatch([msg for _, msg in messages[:4]]),
+            ),
+        )
+    )
+
+    for label, msg in messages:
+        assert msg.serialize() == json.dumps(msg.jsonifyable()), label
+        times = []
+        for serialize in (lambda: json.dumps(msg.jsonifyable()), msg.serialize):
+            start = perf_counter()
+            for _ in range(options.iterations):
+                serialize()
+            times.append((perf_counter() - start) / options.iterations)
+        print(
+            f"{label}: {fmt(times[0])} with json.dumps, {fmt(times[1])} fast path"
+            f" ({times[0] / times[1]:.01f}x)"
+        )
+
+
+@benchmark
+def logging_overhead() -> None:
+    """
+    Measure the messages per second which can be handled, counting only the
+    logging done for a game action and the sending of its response, with
+    logging off versus on in each format, sampled, and as f-strings formatted
+    regardless of level, as the server used to log. Logs are written to memory
+    """
+
+    # imported here so as to not pull in the game server for the other
+    # benchmarks
+    import asyncio
+    import io
+    import logging
+    from igo.gameserver.containers import ActionResponseContainer
+    from igo.gameserver import log_events
+    from igo.gameserver.log_events import log_event
+    from igo.gameserver.messages import (
+        IncomingMessageType,
+        OutgoingMessage,
+        OutgoingMessageType,
+    )
+
+    class Handler:
+        """Stands in for an IgoWebSocket"""
+
+        id = "127.0.0.1 (AbCdEfG)"
+
+        async def write_message(self, message: str, binary: bool = False) -> None:
+            pass
+
+    handler = Handler()
+    response = OutgoingMessage(
+        OutgoingMessageType.game_action_response,
+        ActionResponseContainer(True, "Successfully placed a white stone at (3, 4)"),
+        handler,
+    )
+    message_type = IncomingMessageType.game_action
+
+    async def structured() -> None:
+        for _ in range(options.iterations):
+            start = perf_counter()
+            log_event("received", message_type=message_type, client=handler.id)
+            log_event(
+                "action",
+                player_key="0123456789",
+                action_type="place_stone",
+                success=True,
+                explanation=response.data.explanation,
+            )
+            await response.send()
+            log_event(
+                "processed",
+                message_type=message_type,
+                client=handler.id,
+                seconds=perf_counter() - start,
+            )
+
+    async def f_strings() -> None:
+        for _ in range(options.iterations):
+            start = perf_counter()
+            logging.info(f"Received {message_type.name} message from {handler.id}")
+            logging.info(
+                "Took action with result success=True,"
+                f" explanation={response.data.explanation}"
+            )
+            await response.send()
+            logging.info(
+                f"Processed {message_type.name} message in"
+                f" {perf_counter() - start}s"
+            )
+
+    root = logging.getLogger()
+    old_level, old_handlers = root.level, root.handlers
+    old_options = {
+        name: options[name]
+        for name in ("log_format", "log_sample_rate", "log_sample_rates")
+    }
+    stream = io.StringIO()
+    log_handler = logging.StreamHandler(stream)
+    log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    root.handlers = [log_handler]
+    try:
+        for label, level, log_format, sample_rate, run in (
+            ("off", logging.WARNING, "kv", 1.0, structured),
+            ("key=value", logging.INFO, "kv", 1.0, structured),
+            ("json", logging.INFO, "json", 1.0, structured),
+            ("key=value, 1% sampled", logging.INFO, "kv", 0.01, structured),
+            ("f-strings", logging.INFO, "kv", 1.0, f_strings),
+            ("f-strings, off", logging.WARNING, "kv", 1.0, f_strings),
+        ):
+            root.setLevel(level)
+            options.log_format = log_format
+            options.log_sample_rate = sample_rate
+            options.log_sample_rates = ""
+            log_events.configure()
+            stream.seek(0)
+            stream.truncate()
+            start = perf_counter()
+            asyncio.run(run())
+            elapsed = perf_counter() - start
+            print(
+                f"{label}: {options.iterations / elapsed:,.0f} messages/sec,"
+                f" {len(stream.getvalue()) / options.iterations:.0f} bytes logged"
+                " per message"
+            )
+    finally:
+        root.setLevel(old_level)
+        root.handlers = old_handlers
+        for name, value in old_options.items():
+            setattr(options, name, value)
+        log_events.configure()
+
+
+def main() -> None:
+    options.parse_command_line()
+    names = list(_BENCHMARKS) if options.benchmark == "all" else [options.benchmark]
+    for name in names:
+        if name not in _BENCHMARKS:
+            raise ValueError(
+                f"Unknown benchmark '{name}'. Choose from {', '.join(_BENCHMARKS)}"
+            )
+        print(f"*** {name}")
+        _BENCHMARKS[name]()
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+"""
+Compact, versioned binary encoding of `Game`, as stored in the database. A
+pickled game carries a lot of redundant structure, e.g. an object per action,
+so instead we write
+
+- a short header: magic, codec version, board size, komi, flags
+- the status, turn, prisoner and territory counts, any pending request and
+  result
+- the Zobrist hash of the position and the ko state (see `Game`)
+- the four planes of the board (see `Board`), 2 bits per point, omitting those
+  which are entirely empty
+- the action log, one header byte per action followed by varints for its
+  timestamp and coordinates
+
+Timestamps are stored as the difference between the IEEE 754 bit patterns of
+consecutive timestamps. This is lossless, unlike e.g. rounding to
+microseconds, and as consecutive timestamps are close together it is about as
+compact. Games pickled before this codec was introduced are still decoded, see
+`decode_game`
+"""
+
+from __future__ import annotations
+from igo.game import (
+    Action,
+    ActionType,
+    Board,
+    Color,
+    Game,
+    GameStatus,
+    Request,
+    RequestType,
+    Result,
+    ResultType,
+)
+import pickle
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple
+
+CODEC_VERSION = 1
+_MAGIC = b"IG"
+# games written before this codec are pickles, all of protocol 2 or above and
+# so starting with this byte
+LEGACY_PREFIX = b"\x80"
+
+# flags
+_SUPERKO = 1
+_PREV_HASH = 2
+_PENDING_REQUEST = 4
+_RESULT = 8
+
+# coords kinds, stored in the top two bits of the action header byte
+_NO_COORDS = 0
+_SINGLE_COORDS = 1
+_MULTI_COORDS = 2
+
+# lookup tables by enum value, all of which are auto() and so start at one
+_COLORS = (None, *Color)
+_ACTION_TYPES = (None, *ActionType)
+_GAME_STATUSES = (None, *GameStatus)
+_REQUEST_TYPES = (None, *RequestType)
+_RESULT_TYPES = (None, *ResultType)
+
+# the action type, color and coords kind of each possible action header byte
+_HEADERS = [
+    (
+        _ACTION_TYPES[b & 0xF] if b & 0xF < len(_ACTION_TYPES) else None,
+        _COLORS[b >> 4 & 3] if b >> 4 & 3 < len(_COLORS) else None,
+        b >> 6,
+    )
+    for b in range(256)
+]
+
+# the four 2-bit values packed into each possible byte
+_UNPACK = [bytes((b & 3, b >> 2 & 3, b >> 4 & 3, b >> 6)) for b in range(256)]
+
+
+_COORDS_TABLES: Dict[int, List[Tuple[int, int]]] = {}
+
+
+def _coords_table(size: int) -> List[Tuple[int, int]]:
+    """Return the coordinates of each flat index on a board of the given size
+    (see `igo.game.neighbor_table`), shared by all decoded actions"""
+
+    if size not in _COORDS_TABLES:
+        _COORDS_TABLES[size] = [divmod(k, size) for k in range(size * size)]
+    return _COORDS_TABLES[size]
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    """Append non-negative `value` to `out` as a LEB128 varint"""
+
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    """Return the varint starting at `pos` in `data` and the position
+    following it"""
+
+    value = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _pack_plane(plane: bytes) -> bytes:
+    """Pack a plane of values in [0, 3] four to a byte"""
+
+    plane = plane + bytes(-len(plane) % 4)
+    return bytes(
+        a | b << 2 | c << 4 | d << 6
+        for a, b, c, d in zip(plane[0::4], plane[1::4], plane[2::4], plane[3::4])
+    )
+
+
+def encode_state(game: Game) -> bytearray:
+    """
+    Return the binary encoding of `game` less its action log, i.e. everything
+    which `encode_game` writes before the number of actions. Unlike the action
+    log, this doesn't grow with the length of the game
+    """
+
+    board = game.board
+    size = board.size
+    n = size * size
+    out = bytearray(_MAGIC)
+    out.append(CODEC_VERSION)
+    _write_varint(out, size)
+    out += struct.pack("<d", game.komi)
+    out.append(
+        (_SUPERKO if game.superko else 0)
+        | (_PREV_HASH if game._prev_hash is not None else 0)
+        | (_PENDING_REQUEST if game.pending_request else 0)
+        | (_RESULT if game.result else 0)
+    )
+    out.append(game.status.value)
+    out.append(game.turn.value)
+    for counts in (game.prisoners, game.territory):
+        _write_varint(out, counts[Color.white])
+        _write_varint(out, counts[Color.black])
+    if game.pending_request:
+        out.append(game.pending_request.request_type.value)
+        out.append(game.pending_request.initiator.value)
+    if game.result:
+        out.append(game.result.result_type.value)
+        out.append(game.result.winner.value if game.result.winner else 0)
+
+    out += struct.pack("<Q", game._hash)
+    if game._prev_hash is not None:
+        out += struct.pack("<Q", game._prev_hash)
+    _write_varint(out, len(game._hash_history))
+    out += struct.pack(f"<{len(game._hash_history)}Q", *sorted(game._hash_history))
+
+    planes = [bytes(board._data[p * n : (p + 1) * n]) for p in range(4)]
+    present = [any(plane) for plane in planes]
+    out.append(sum(1 << p for p in range(4) if present[p]))
+    for p in range(4):
+        if present[p]:
+            out += _pack_plane(planes[p])
+    return out
+
+
+class ActionLog:
+    """
+    The encoded action log of a game, which is extended by new actions without
+    encoding those before them again. A game which is written after every few
+    actions, as by the engine workers (see `igo.gameserver.engine`), can then be
+    encoded in time independent of the length of its action log, given its
+    state as encoded by `encode_state`
+
+    Attributes:
+
+        size: int - the board size, which the coordinates are encoded by
+
+        num_actions: int - the number of actions in the log, i.e. the version
+        of the game
+    """
+
+    __slots__ = ("size", "num_actions", "_data", "_prev_bits")
+
+    def __init__(self, size: int, actions: Sequence[Action] = ()) -> None:
+        self.size = size
+        self.num_actions = 0
+        self._data = bytearray()
+        # the bit pattern of the last timestamp, see module docstring
+        self._prev_bits = 0
+        self.extend(actions)
+
+    def extend(self, actions: Sequence[Action]) -> None:
+        """Append `actions` to the log"""
+
+        num_actions = len(actions)
+        if not num_actions:
+            return
+        out, size = self._data, self.size
+        # convert all of the timestamps at once
+        timestamps = struct.pack(f"<{num_actions}d", *(a.timestamp for a in actions))
+        all_bits = struct.unpack(f"<{num_actions}q", timestamps)
+        prev_bits = self._prev_bits
+        for action, bits in zip(actions, all_bits):
+            coords = action.coords
+            if coords is None:
+                kind = _NO_COORDS
+            elif isinstance(coords[0], tuple):
+                kind = _MULTI_COORDS
+            else:
+                kind = _SINGLE_COORDS
+            # NB: _value_ rather than value avoids the enum property lookup,
+            # which adds up over a long game
+            out.append(
+                action.action_type._value_ | action.color._value_ << 4 | kind << 6
+            )
+            delta = bits - prev_bits
+            delta = delta << 1 if delta >= 0 else (-delta << 1) - 1
+            if delta < 0x80:
+                out.append(delta)
+            else:
+                _write_varint(out, delta)
+            prev_bits = bits
+            if kind == _SINGLE_COORDS:
+                k = coords[0] * size + coords[1]
+                if k < 0x80:
+                    out.append(k)
+                else:
+                    _write_varint(out, k)
+            elif kind == _MULTI_COORDS:
+                _write_varint(out, len(coords))
+                for i, j in coords:
+                    _write_varint(out, i * size + j)
+        self._prev_bits = prev_bits
+        self.num_actions += num_actions
+
+    def encode_game(self, state: bytes) -> bytes:
+        """Return the binary encoding of the game whose state, as encoded by
+        `encode_state`, is `state` and whose action log this is. See
+        `encode_game`"""
+
+        out = bytearray(state)
+        _write_varint(out, self.num_actions)
+        out += self._data
+        return bytes(out)
+
+
+def encode_game(game: Game) -> bytes:
+    """Return the binary encoding of `game`"""
+
+    return ActionLog(game.board.size, game.action_stack).encode_game(
+        encode_state(game)
+    )
+
+
+def decode_game(data: bytes) -> Game:
+    """Inverse of `encode_game`. Games written as pickles by earlier versions
+    of the server are unpickled, so that existing rows remain readable until
+    they are next written. Raise ValueError if `data` is neither"""
+
+    if data[: len(LEGACY_PREFIX)] == LEGACY_PREFIX:
+        game = pickle.loads(data)
+        if not isinstance(game, Game):
+            raise ValueError(f"Expected a pickled Game, got {type(game).__name__}")
+        return game
+    if data[: len(_MAGIC)] != _MAGIC:
+        raise ValueError("Data is neither an encoded nor a pickled Game")
+    version = data[len(_MAGIC)]
+    if version != CODEC_VERSION:
+        raise ValueError(f"Unknown game codec version {version}")
+
+    pos = len(_MAGIC) + 1
+    size, pos = _read_varint(data, pos)
+    n = size * size
+    (komi,) = struct.unpack_from("<d", data, pos)
+    pos += 8
+    flags, status, turn = data[pos : pos + 3]
+    pos += 3
+    counts = []
+    for _ in range(4):
+        count, pos = _read_varint(data, pos)
+        counts.append(count)
+    pending_request: Optional[Request] = None
+    if flags & _PENDING_REQUEST:
+        pending_request = Request(_REQUEST_TYPES[data[pos]], _COLORS[data[pos + 1]])
+        pos += 2
+    result: Optional[Result] = None
+    if flags & _RESULT:
+        result = Result(_RESULT_TYPES[data[pos]], _COLORS[data[pos + 1]])
+        pos += 2
+
+    (h,) = struct.unpack_from("<Q", data, pos)
+    pos += 8
+    prev_hash: Optional[int] = None
+    if flags & _PREV_HASH:
+        (prev_hash,) = struct.unpack_from("<Q", data, pos)
+        pos += 8
+    num_hashes, pos = _read_varint(data, pos)
+    hash_history = struct.unpack_from(f"<{num_hashes}Q", data, pos)
+    pos += 8 * num_hashes
+
+    board = Board(size)
+    plane_mask = data[pos]
+    pos += 1
+    packed_len = (n + 3) // 4
+    for p in range(4):
+        if plane_mask & 1 << p:
+            packed = data[pos : pos + packed_len]
+            pos += packed_len
+            board._data[p * n : (p + 1) * n] = b"".join(_UNPACK[b] for b in packed)[:n]
+
+    num_actions, pos = _read_varint(data, pos)
+    coords_table = _coords_table(size)
+    actions: List[Tuple] = []
+    bits = 0
+    for _ in range(num_actions):
+        action_type, color, kind = _HEADERS[data[pos]]
+        delta = data[pos + 1]
+        pos += 2
+        if delta >= 0x80:
+            delta, pos = _read_varint(data, pos - 1)
+        bits += delta >> 1 if not delta & 1 else -((delta + 1) >> 1)
+        if kind == _SINGLE_COORDS:
+            k = data[pos]
+            pos += 1
+            if k >= 0x80:
+                k, pos = _read_varint(data, pos - 1)
+            coords = coords_table[k]
+        elif kind == _MULTI_COORDS:
+            num_coords, pos = _read_varint(data, pos)
+            coords = []
+            for _ in range(num_coords):
+                k, pos = _read_varint(data, pos)
+                coords.append(coords_table[k])
+            coords = tuple(coords)
+        else:
+            coords = None
+        actions.append((action_type, color, bits, coords))
+    if pos != len(data):
+        raise ValueError(f"Unexpected trailing data after encoded Game at {pos}")
+
+    # convert all of the timestamps at once
+    timestamps = struct.unpack(
+        f"<{num_actions}d", struct.pack(f"<{num_actions}q", *(a[2] for a in actions))
+    )
+
+    game: Game = Game.__new__(Game)
+    game.status = _GAME_STATUSES[status]
+    game.turn = _COLORS[turn]
+    game.action_stack = [
+        Action(action_type, color, ts, coords)
+        for (action_type, color, _, coords), ts in zip(actions, timestamps)
+    ]
+    game.board = board
+    game.komi = komi
+    game.prisoners = {Color.white: counts[0], Color.black: counts[1]}
+    game.territory = {Color.white: counts[2], Color.black: counts[3]}
+    game.pending_request = pending_request
+    game.result = result
+    game.superko = bool(flags & _SUPERKO)
+    game._hash = h
+    game._prev_hash = prev_hash
+    game._hash_history = set(hash_history)
+    game._marked_dead = board.marked_dead() if plane_mask & 2 else set()
+    game._reset_transient()
+    return game
@@ -2,8 +2,14 @@ from __future__ import annotations
 from dataclassy import dataclass
 from enum import Enum, auto
 from igo.serialization import JsonifyableBase, JsonifyableBaseDataClass
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Union
 from copy import deepcopy
+import random
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional and only used by count_territories
+    np = None
 
 
 class Color(Enum):
@@ -63,6 +69,21 @@ class ResultType(Enum):
     resignation = auto()
 
 
+Coords = Union[Tuple[int, int], Tuple[Tuple[int, int], ...]]
+
+
+def parse_coords(coords: Optional[List]) -> Optional[Coords]:
+    """Convert coordinates as serialized to JSON, i.e. either a single [i, j]
+    pair or a list of them, into the tuple(s) expected by `Action`, or None if
+    there are none"""
+
+    if not coords:
+        return None
+    if isinstance(coords[0], list):
+        return tuple(tuple(c) for c in coords)
+    return tuple(coords)
+
+
 @dataclass(slots=True)
 class Action:
     """
@@ -76,14 +97,17 @@ class Action:
 
         timestamp: float - server time at which this action was created
 
-        coords: Optional[Tuple[int, int]] - if relevant given action_type,
-        the coordinates of the point on which the action was taken
+        coords: Optional[Coords] - if relevant given action_type, the
+        coordinates of the point on which the action was taken. Marking stones
+        dead additionally accepts a tuple of coordinates, one on each of the
+        groups to be marked, so that an entire endgame's worth of dead groups
+        can be settled in a single request
     """
 
     action_type: ActionType
     color: Color
     timestamp: float
-    coords: Optional[Tuple[int, int]] = None
+    coords: Optional[Coords] = None
 
 
 class Request(JsonifyableBaseDataClass):
@@ -171,7 +195,7 @@ class Point(JsonifyableBaseDataClass):
     def __eq__(self, o: object) -> bool:
         """Color equality only, as this is only for the purpose of detecting ko"""
 
-        if not isinstance(o, Point):
+        if not isinstance(o, (Point, Board._PointView)):
             return False
         return self.color is o.color
 
@@ -197,97 +221,524 @@ class Point(JsonifyableBaseDataClass):
         return Point(self.color, self.marked_dead, self.counted, self.counts_for)
 
 
+_NEIGHBOR_TABLES: Dict[int, List[Tuple[int, ...]]] = {}
+
+
+def neighbor_table(size: int) -> List[Tuple[int, ...]]:
+    """
+    Return the table of orthogonal neighbors on a board of the given size, such
+    that `neighbor_table(size)[k]` holds the flat indices of the in bounds
+    points adjacent to the point at flat index k, where (i, j) is found at flat
+    index `i * size + j`. Tables are built once per size and shared by all
+    games
+    """
+
+    if size not in _NEIGHBOR_TABLES:
+        _NEIGHBOR_TABLES[size] = [
+            tuple(
+                ii * size + jj
+                for ii, jj in ((i - 1, j), (i + 1, j), (i, j - 1), (i, j + 1))
+                if 0 <= ii < size and 0 <= jj < size
+            )
+            for i in range(size)
+            for j in range(size)
+        ]
+    return _NEIGHBOR_TABLES[size]
+
+
+_ZOBRIST_KEYS: Dict[int, List[Tuple[int, int, int]]] = {}
+
+
+def zobrist_keys(size: int) -> List[Tuple[int, int, int]]:
+    """
+    Return the table of random 64-bit keys used to hash positions on a board of
+    the given size, such that `zobrist_keys(size)[k][color.value]` is the key
+    for a stone of `color` at flat index k (see `neighbor_table`), with
+    `zobrist_keys(size)[k][0]` being zero for convenience. The table is seeded
+    by `size` so that hashes are stable across processes, which matters as
+    they are persisted along with games
+    """
+
+    if size not in _ZOBRIST_KEYS:
+        rng = random.Random(size)
+        _ZOBRIST_KEYS[size] = [
+            (0, *(rng.getrandbits(64) for _ in Color)) for _ in range(size * size)
+        ]
+    return _ZOBRIST_KEYS[size]
+
+
+# decoding table for colors as stored in Board's buffer, i.e. by Color.value,
+# with zero standing for empty
+_COLORS: Tuple[Optional[Color], ...] = (None, *Color)
+_SHORT_COLORS: Tuple[str, ...] = ("", *(c.to_short() for c in Color))
+# translation tables between the color plane of Board's buffer and the colors
+# string of its compact JSON representation, in which empty points are "."
+_EMPTY_SHORT = "."
+_COMPACT_COLORS = bytes(
+    ord(_SHORT_COLORS[v] or _EMPTY_SHORT) if v < len(_COLORS) else 0
+    for v in range(256)
+)
+_COMPACT_SHORTS = frozenset((_EMPTY_SHORT, *_SHORT_COLORS[1:]))
+_COMPACT_VALUES = bytes(
+    _SHORT_COLORS.index(chr(b)) if chr(b) in _SHORT_COLORS[1:] else 0
+    for b in range(256)
+)
+
+
+def _compact_index(k: int, n: int) -> int:
+    """Return the index `k` of a point in the compact JSON representation of a
+    board of `n` points, or raise ValueError if it is not one"""
+
+    if k.__class__ is not int or not 0 <= k < n:
+        raise ValueError(f"Invalid compact board index {k!r}")
+    return k
+
+
 class Board(JsonifyableBase):
     """
-    Subscriptable 2d container class for the full board. `Board()[i][j] -> Point`
+    Subscriptable 2d container class for the full board. `Board()[i][j] ->
+    Point`, or rather a lightweight view with the same attributes which reads
+    from and writes to the board
+
+    Rather than holding a `Point` object per point, the board packs all points
+    into a single buffer made up of four planes of `size * size` bytes, one
+    each for color (`Color.value`, zero if empty), marked_dead, counted and
+    counts_for (like color), in which point (i, j) is found at offset
+    `i * size + j`
 
     Attributes:
 
         size: int - the number of points on either side of the board
     """
 
-    class _BoardRow(JsonifyableBase):
+    class _PointView:
+        """Stand-in for `Point` which reads and writes a point of the board"""
+
+        __slots__ = ("_board", "_idx")
+
+        def __init__(self, board: Board, idx: int) -> None:
+            self._board = board
+            self._idx = idx
+
+        @property
+        def color(self) -> Optional[Color]:
+            return _COLORS[self._board._data[self._idx]]
+
+        @color.setter
+        def color(self, color: Optional[Color]) -> None:
+            self._board._data[self._idx] = color.value if color else 0
+            self._board._generation += 1
+
+        @property
+        def marked_dead(self) -> bool:
+            board = self._board
+            return bool(board._data[board.size * board.size + self._idx])
+
+        @marked_dead.setter
+        def marked_dead(self, marked_dead: bool) -> None:
+            board = self._board
+            board._data[board.size * board.size + self._idx] = marked_dead
+
+        @property
+        def counted(self) -> bool:
+            board = self._board
+            return bool(board._data[2 * board.size * board.size + self._idx])
+
+        @counted.setter
+        def counted(self, counted: bool) -> None:
+            board = self._board
+            board._data[2 * board.size * board.size + self._idx] = counted
+
+        @property
+        def counts_for(self) -> Optional[Color]:
+            board = self._board
+            return _COLORS[board._data[3 * board.size * board.size + self._idx]]
+
+        @counts_for.setter
+        def counts_for(self, counts_for: Optional[Color]) -> None:
+            board = self._board
+            board._data[3 * board.size * board.size + self._idx] = (
+                counts_for.value if counts_for else 0
+            )
 
-        __slots__ = "_row"
+        def __repr__(self) -> str:
+            return repr(self.to_point())
+
+        def __str__(self) -> str:
+            return str(self.jsonifyable())
 
-        def __init__(self, size: int) -> None:
-            self._row = [Point() for _ in range(size)]
+        def __eq__(self, o: object) -> bool:
+            """Color equality only, as for `Point`"""
+
+            if not isinstance(o, (Point, Board._PointView)):
+                return False
+            return self.color is o.color
+
+        def to_point(self) -> Point:
+            """Return a detached copy of the point"""
+
+            return Point(self.color, self.marked_dead, self.counted, self.counts_for)
+
+        def jsonifyable(self) -> List:
+            """Return a representation which can be readily JSONified"""
 
-        def __getitem__(self, key: int) -> Point:
-            return self._row[key]
+            return self.to_point().jsonifyable()
+
+        def __deepcopy__(self, memo: Dict) -> Point:
+            return self.to_point()
+
+    class _RowView:
+        """Subscriptable view of a row of the board"""
+
+        __slots__ = ("_board", "_offset")
+
+        def __init__(self, board: Board, offset: int) -> None:
+            self._board = board
+            self._offset = offset
+
+        def __len__(self) -> int:
+            return self._board.size
+
+        def __getitem__(self, key: int) -> Board._PointView:
+            size = self._board.size
+            if key < 0:
+                key += size
+            if not 0 <= key < size:
+                raise IndexError("board index out of range")
+            return Board._PointView(self._board, self._offset + key)
+
+        def __setitem__(self, key: int, point: Point) -> None:
+            size = self._board.size
+            if key < 0:
+                key += size
+            if not 0 <= key < size:
+                raise IndexError("board index out of range")
+            self._board._set_point(*divmod(self._offset + key, size), point)
 
         def __repr__(self) -> str:
-            return str(self._row)
+            return str(list(self))
 
         def __eq__(self, other: object) -> bool:
-            if not isinstance(other, Board._BoardRow):
+            if not isinstance(other, Board._RowView):
                 return False
-            return self._row == other._row
+            size = self._board.size
+            return (
+                size == other._board.size
+                and self._board._data[self._offset : self._offset + size]
+                == other._board._data[other._offset : other._offset + size]
+            )
 
-        def jsonifyable(self) -> List[str]:
+        def jsonifyable(self) -> List[List]:
             """Return a representation which can be readily JSONified"""
 
-            return [p.jsonifyable() for p in self._row]
+            return [p.jsonifyable() for p in self]
 
-        def __deepcopy__(self, memo: Dict) -> Board._BoardRow:
-            dup: Board._BoardRow = self.__new__(self.__class__)
-            dup._row = [deepcopy(p, memo) for p in self._row]
-            return dup
+    class _BoardRow:
+        """Rows of boards pickled before points were packed into a buffer. Only
+        retained so that those can still be unpickled"""
 
-        @classmethod
-        def _deserialize(cls, data: List) -> Board._BoardRow:
-            self: Board._BoardRow = cls.__new__(cls)
-            self._row = [Point.deserialize(p) for p in data]
-            return self
+        __slots__ = "_row"
 
-    __slots__ = ("size", "_rows")
+    __slots__ = ("size", "_data", "_generation")
 
     def __init__(self, size: int = 19) -> None:
         self.size = size
-        self._rows = [Board._BoardRow(size) for _ in range(size)]
+        self._data = bytearray(4 * size * size)
+        # bumped whenever the color of a point is changed. see Game._sync
+        self._generation = 0
+
+    def __setstate__(self, state: Tuple[None, Dict]) -> None:
+        _, slots = state
+        rows: Optional[List[Board._BoardRow]] = slots.pop("_rows", None)
+        for k, v in slots.items():
+            setattr(self, k, v)
+        self._generation = 0
+        if rows is not None:
+            self._data = bytearray(4 * self.size * self.size)
+            for i, row in enumerate(rows):
+                for j, p in enumerate(row._row):
+                    self._set_point(i, j, p)
 
     def __len__(self) -> int:
         return self.size
 
-    def __getitem__(self, key: int) -> Board._BoardRow:
-        return self._rows[key]
+    def __getitem__(self, key: int) -> Board._RowView:
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError("board index out of range")
+        return Board._RowView(self, key * self.size)
 
     def __repr__(self) -> str:
-        return str(self._rows)
+        return str(list(self))
 
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, Board):
             return False
-        return self.size == other.size and all(
-            r == o for r, o in zip(self._rows, other._rows)
-        )
+        n = self.size * self.size
+        return self.size == other.size and self._data[:n] == other._data[:n]
 
-    def jsonifyable(self) -> List[List[str]]:
-        """Return a representation which can be readily JSONified"""
+    def _set_point(self, i: int, j: int, p: Point) -> None:
+        """Copy all attributes of `p` to point (i, j)"""
 
-        return {"size": self.size, "points": [r.jsonifyable() for r in self._rows]}
+        n = self.size * self.size
+        k = i * self.size + j
+        self._data[k] = p.color.value if p.color else 0
+        self._data[n + k] = p.marked_dead
+        self._data[2 * n + k] = p.counted
+        self._data[3 * n + k] = p.counts_for.value if p.counts_for else 0
+        self._generation += 1
+
+    def on_board(self, coords: Tuple[int, int]) -> bool:
+        """Return whether point `coords` is on the board"""
+
+        i, j = coords
+        return 0 <= i < self.size and 0 <= j < self.size
+
+    def territory_map(self) -> bytearray:
+        """Return the owner of every point on the board by flat index. See
+        `territory_map`"""
+
+        return territory_map(self.size, self._data)
+
+    def marked_dead(self) -> Set[int]:
+        """Return the flat indices of the points marked dead"""
+
+        n = self.size * self.size
+        return {k for k in range(n) if self._data[n + k]}
+
+    def zobrist_hash(self) -> int:
+        """Return the Zobrist hash of the stones on the board, i.e. the XOR of
+        the keys of all stones, the empty board hashing to zero"""
+
+        keys = zobrist_keys(self.size)
+        data = self._data
+        h = 0
+        for k in range(self.size * self.size):
+            h ^= keys[k][data[k]]
+        return h
+
+    def jsonifyable(self, compact: bool = False) -> Dict:
+        """Return a representation which can be readily JSONified. If
+        `compact`, the colors of all points are given as a single string, one
+        character per point by flat index (see `neighbor_table`) with "." for
+        empty, and the other attributes as lists of the flat indices of the
+        points for which they are set, which is a fraction of the size for
+        clients that can read it"""
+
+        size, data = self.size, self._data
+        n = size * size
+        if compact:
+            counts_for = {c.to_short(): [] for c in Color}
+            for k, value in enumerate(data[3 * n : 4 * n]):
+                if value:
+                    counts_for[_SHORT_COLORS[value]].append(k)
+            return {
+                "size": size,
+                "colors": data[:n].translate(_COMPACT_COLORS).decode("ascii"),
+                "markedDead": [k for k, v in enumerate(data[n : 2 * n]) if v],
+                "counted": [k for k, v in enumerate(data[2 * n : 3 * n]) if v],
+                "countsFor": counts_for,
+            }
+        return {
+            "size": size,
+            "points": [
+                [
+                    [
+                        _SHORT_COLORS[data[k]],
+                        bool(data[n + k]),
+                        bool(data[2 * n + k]),
+                        _SHORT_COLORS[data[3 * n + k]],
+                    ]
+                    for k in range(i * size, (i + 1) * size)
+                ]
+                for i in range(size)
+            ],
+        }
 
     def __deepcopy__(self, memo: Dict) -> Board:
         """
         NOTE: a naive deepcopy of board was the single most expensive operation
-        the game server was undertaking in profiling runs. implementing
-        __deepcopy__ for Board and its attributes shaves this down by about a
-        factor of 10
+        the game server was undertaking in profiling runs. with all points
+        packed into a single buffer, this is now a single buffer copy
         """
 
         dup: Board = self.__new__(self.__class__)
         dup.size = self.size
-        dup._rows = [deepcopy(r, memo) for r in self._rows]
+        dup._data = bytearray(self._data)
+        dup._generation = 0
         return dup
 
     @classmethod
     def _deserialize(cls, data: Dict) -> Board:
-        self: Board = cls.__new__(cls)
-        self.size = data["size"]
-        self._rows = [Board._BoardRow.deserialize(row) for row in data["points"]]
+        """Accepts either representation given by `jsonifyable`"""
+
+        self: Board = cls(data["size"])
+        if "colors" in data:
+            n = self.size * self.size
+            colors: str = data["colors"]
+            if len(colors) != n or not _COMPACT_SHORTS.issuperset(colors):
+                raise ValueError(f"Invalid compact board colors '{colors}'")
+            self._data[:n] = colors.encode("ascii").translate(_COMPACT_VALUES)
+            # a negative index would otherwise land on another plane
+            for k in data["markedDead"]:
+                self._data[n + _compact_index(k, n)] = True
+            for k in data["counted"]:
+                self._data[2 * n + _compact_index(k, n)] = True
+            for short, indices in data["countsFor"].items():
+                value = Color.from_short(short).value
+                for k in indices:
+                    self._data[3 * n + _compact_index(k, n)] = value
+            return self
+        for i, row in enumerate(data["points"]):
+            for j, p in enumerate(row):
+                self._set_point(i, j, Point.deserialize(p))
+        self._generation = 0
         return self
 
 
+def territory_map(size: int, colors: Sequence[int]) -> bytearray:
+    """
+    Return the owner of every point on a board of the given size, i.e. for
+    each flat index (see `neighbor_table`) the `Color.value` of the player
+    whose territory that point is, or zero if the point is occupied or
+    neutral. `colors` holds the `Color.value` of the stone at each flat
+    index, zero if empty, as does the first plane of `Board`'s buffer
+
+    An empty point belongs to a player if the region of empty points
+    connected to it borders only that player's stones
+    """
+
+    # we label regions by walking the empty points with an explicit stack,
+    # noting the colors on the border of each region as we go. note that for a
+    # single board at standard sizes, this beats a vectorized labeling pass
+    # with numpy, whose per-call overhead dominates. see count_territories
+
+    n = size * size
+    neighbors = neighbor_table(size)
+    owners = bytearray(n)
+    visited = bytearray(n)
+
+    for k in range(n):
+        if not colors[k] and not visited[k]:
+            visited[k] = True
+            stack = [k]
+            region = [k]
+            border = set()
+            while stack:
+                for kk in neighbors[stack.pop()]:
+                    value = colors[kk]
+                    if value:
+                        border.add(value)
+                    elif not visited[kk]:
+                        visited[kk] = True
+                        stack.append(kk)
+                        region.append(kk)
+            if len(border) == 1:
+                owner = border.pop()
+                for kk in region:
+                    owners[kk] = owner
+
+    return owners
+
+
+def count_territories(boards: Sequence[Board]) -> List[Dict[Color, int]]:
+    """
+    Count the territory of each player on each of `boards`, which must all be
+    of the same size, as determined by `territory_map`. This is meant as a
+    scoring primitive for AI rollouts and is vectorized over all boards with
+    numpy if it is installed
+    """
+
+    if not boards:
+        return []
+    size = boards[0].size
+    assert all(b.size == size for b in boards)
+
+    if np is None:
+        res = []
+        for board in boards:
+            owners = territory_map(size, board._data)
+            res.append({c: owners.count(c.value) for c in Color})
+        return res
+
+    # rather than labeling regions, we propagate whether each player's stones
+    # can be reached from each empty point. reaching along a row or column is
+    # done for a whole run of empty points at once: each run gets an id, and a
+    # run is reached if any of its points are. alternating between rows and
+    # columns until nothing changes takes as many passes as the most turns on
+    # a shortest path from a point to a stone, which is small in practice
+    n = size * size
+    colors = np.frombuffer(
+        b"".join(bytes(memoryview(b._data)[:n]) for b in boards), dtype=np.uint8
+    ).reshape(len(boards), size, size)
+    empty = colors == 0
+
+    def run_ids(e: np.ndarray) -> Tuple[np.ndarray, int]:
+        """Return an id for the run of empty points along the last axis that
+        each point belongs to, zero for stones, and the number of ids"""
+
+        starts = e.copy()
+        starts[..., 1:] &= ~e[..., :-1]
+        ids = np.cumsum(starts.ravel()).reshape(e.shape)
+        return np.where(e, ids, 0), int(ids.ravel()[-1]) + 1
+
+    row_ids, num_row_ids = run_ids(empty)
+    col_ids, num_col_ids = run_ids(empty.transpose(0, 2, 1).copy())
+    col_ids = col_ids.transpose(0, 2, 1)
+
+    reached = {}
+    for c in Color:
+        stones = colors == c.value
+        r = np.zeros_like(empty)
+        r[:, 1:] |= stones[:, :-1]
+        r[:, :-1] |= stones[:, 1:]
+        r[..., 1:] |= stones[..., :-1]
+        r[..., :-1] |= stones[..., 1:]
+        r &= empty
+        while True:
+            hit = np.zeros(num_row_ids, dtype=bool)
+            hit[row_ids[r]] = True
+            hit[0] = False
+            spread = hit[row_ids]
+            hit = np.zeros(num_col_ids, dtype=bool)
+            hit[col_ids[spread]] = True
+            hit[0] = False
+            spread = hit[col_ids]
+            if (spread == r).all():
+                break
+            r = spread
+        reached[c] = r
+
+    counts = {
+        c: (reached[c] & ~reached[c.inverse()]).sum(axis=(1, 2)) for c in Color
+    }
+    return [{c: int(counts[c][i]) for c in Color} for i in range(len(boards))]
+
+
+@dataclass(slots=True)
+class Chain:
+    """
+    Container class for chains, i.e. maximal groups of orthogonally connected
+    stones of the same color. Chains are maintained by `Game` across moves and
+    should be treated as read only
+
+    Attributes:
+
+        color: Color - the color of the stones in the chain
+
+        stones: Set[int] - the flat indices (see `neighbor_table`) of the
+        stones in the chain
+
+        liberties: Set[int] - the flat indices of the empty points adjacent to
+        the chain
+    """
+
+    color: Color
+    stones: Set[int]
+    liberties: Set[int]
+
+
 class Game(JsonifyableBase):
     """
     The state and rule logic of a go game
@@ -315,6 +766,10 @@ class Game(JsonifyableBase):
 
         result: Optional[Result] - the result of the game, set only once it
         has been resolved
+
+        superko: bool - if True, enforce the positional superko rule, i.e.
+        forbid any stone placement which recreates an earlier board position,
+        rather than just the simple ko rule
     """
 
     # TODO: Add export to SGF (Smart Game Format). We ought to be able to export
@@ -331,10 +786,35 @@ class Game(JsonifyableBase):
         "territory",
         "pending_request",
         "result",
-        "_prev_board",
+        "superko",
+        "_hash",
+        "_prev_hash",
+        "_hash_history",
+        "_marked_dead",
+        "_chains",
+        "_chains_board",
+        "_board_generation",
+        "_empty",
+        "_legal",
+        "_capturing",
+        "_dirty",
     )
 
-    def __init__(self, size: int = 19, komi: float = 6.5) -> None:
+    # derived state which is rebuilt on demand rather than persisted. see
+    # _reset_transient
+    _TRANSIENT_SLOTS = (
+        "_chains",
+        "_chains_board",
+        "_board_generation",
+        "_empty",
+        "_legal",
+        "_capturing",
+        "_dirty",
+    )
+
+    def __init__(
+        self, size: int = 19, komi: float = 6.5, superko: bool = False
+    ) -> None:
         self.status: GameStatus = GameStatus.play
         self.turn: Color = Color.black
         self.action_stack: List[Action] = []
@@ -344,7 +824,137 @@ class Game(JsonifyableBase):
         self.territory: Dict[Color, int] = {Color.white: 0, Color.black: 0}
         self.pending_request: Optional[Request] = None
         self.result: Optional[Result] = None
-        self._prev_board: Board = None
+        self.superko: bool = superko
+        # ko is detected by comparing Zobrist hashes (see zobrist_keys) rather
+        # than boards. _hash is that of the current position and is maintained
+        # incrementally as stones are placed and removed, _prev_hash is that of
+        # the position before the last stone placement, and _hash_history
+        # contains every position reached so far if superko is enforced
+        self._hash: int = 0
+        self._prev_hash: Optional[int] = None
+        self._hash_history: Set[int] = {self._hash} if superko else set()
+        # the flat indices of the stones marked dead by a pending mark dead
+        # request, so that responding to it need not scan the board
+        self._marked_dead: Set[int] = set()
+        self._reset_transient()
+
+    def _reset_transient(self) -> None:
+        """Drop all derived state, to be rebuilt by the next call to `_sync`"""
+
+        # _chains[k] is the chain containing the stone at flat index k (see
+        # neighbor_table), or None if the point is empty. it is maintained
+        # across stone placements and rebuilt from scratch by _sync whenever
+        # the board may have been modified by other means
+        self._chains: Optional[List[Optional[Chain]]] = None
+        self._chains_board: Optional[Board] = None
+        self._board_generation: int = 0
+        # the flat indices of the empty points, and for each color the subset
+        # of those which were not suicide at the time that they were last
+        # screened along with the subset of those which capture. screening is
+        # lazy: stone placements only add the points whose screening may have
+        # changed to _dirty, which legal_moves then rescreens. see
+        # _screen_placement
+        self._empty: Set[int] = set()
+        self._legal: Dict[Color, Set[int]] = {c: set() for c in Color}
+        self._capturing: Dict[Color, Set[int]] = {c: set() for c in Color}
+        self._dirty: Dict[Color, Set[int]] = {c: set() for c in Color}
+
+    def __getstate__(self) -> Tuple[None, Dict]:
+        return (
+            None,
+            {
+                k: getattr(self, k)
+                for k in Game.__slots__
+                if k not in Game._TRANSIENT_SLOTS
+            },
+        )
+
+    def __setstate__(self, state: Tuple[None, Dict]) -> None:
+        """
+        Restore pickled slot state. Games pickled before ko was detected by
+        hash keep a full copy of the previous board instead, from which we
+        derive the hashes
+        """
+
+        _, slots = state
+        prev_board = slots.pop("_prev_board", None)
+        slots.pop("_prev_board_stale", None)
+        for k, v in slots.items():
+            setattr(self, k, v)
+        if not hasattr(self, "_hash"):
+            self.superko = False
+            self._hash = self.board.zobrist_hash()
+            self._prev_hash = prev_board.zobrist_hash() if prev_board else None
+            self._hash_history = set()
+        if not hasattr(self, "_marked_dead"):
+            self._marked_dead = self.board.marked_dead()
+        self._reset_transient()
+
+    def _snapshot(self) -> Tuple:
+        """Return a compact, immutable record of the game state other than
+        the action stack, from which `_restore` can rebuild the game. See
+        `igo.replay`"""
+
+        return (
+            self.board.size,
+            bytes(self.board._data),
+            self.status,
+            self.turn,
+            tuple(self.prisoners.items()),
+            tuple(self.territory.items()),
+            self.pending_request,
+            self.result,
+            self._hash,
+            self._prev_hash,
+            frozenset(self._hash_history),
+            frozenset(self._marked_dead),
+        )
+
+    @classmethod
+    def _restore(
+        cls,
+        snapshot: Tuple,
+        action_stack: List[Action],
+        komi: float,
+        superko: bool,
+    ) -> Game:
+        """Inverse of `_snapshot`, where `action_stack` holds the actions
+        taken up to the snapshot and is used as is"""
+
+        (
+            size,
+            data,
+            status,
+            turn,
+            prisoners,
+            territory,
+            pending_request,
+            result,
+            h,
+            prev_hash,
+            hash_history,
+            marked_dead,
+        ) = snapshot
+        self: Game = cls.__new__(cls)
+        self.board = Board.__new__(Board)
+        self.board.size = size
+        self.board._data = bytearray(data)
+        self.board._generation = 0
+        self.status = status
+        self.turn = turn
+        self.action_stack = action_stack
+        self.komi = komi
+        self.prisoners = dict(prisoners)
+        self.territory = dict(territory)
+        self.pending_request = pending_request
+        self.result = result
+        self.superko = superko
+        self._hash = h
+        self._prev_hash = prev_hash
+        self._hash_history = set(hash_history)
+        self._marked_dead = set(marked_dead)
+        self._reset_transient()
+        return self
 
     def __repr__(self) -> str:
         return (
@@ -357,7 +967,7 @@ class Game(JsonifyableBase):
             f", territory={self.territory}"
             f", pending_request={self.pending_request}"
             f", result={self.result}"
-            f", _prev_board={self._prev_board})"
+            f", superko={self.superko})"
         )
 
     def __eq__(self, o: object) -> bool:
@@ -374,6 +984,7 @@ class Game(JsonifyableBase):
         return (
             self.board.size == o.board.size
             and self.komi == o.komi
+            and self.superko == o.superko
             and self.action_stack == o.action_stack
         )
 
@@ -425,44 +1036,24 @@ class Game(JsonifyableBase):
         board, score, etc.
         """
 
+        if not self.board.on_board(coords):
+            return (False, f"{coords} is off the board")
         if color is not self.turn:
             return (False, f"It isn't {color.name}'s turn")
 
+        self._sync()
         i, j = coords
-        if self.board[i][j].color:
-            return (False, f"Point {coords} is occupied")
-
-        # we will proceed by copying the board and then placing this stone.
-        # first, we remove any captured stones. if we don't remove anything in
-        # this way, we check if the group that the placed stone is part of is
-        # not surrounded (no suicide rule). finally, we check that the board
-        # has not returned to the last previous board position (simple ko). if
-        # the move is in fact legal, we cycle in the new board position, update
-        # prisoner counts if any stones were captured, and cycle the turn
-        # attribute
-
-        new_board: Board = deepcopy(self.board)
-        new_board[i][j].color = color
-        opponent = color.inverse()
-        captured = 0
-
-        for ii, jj in self._adjacencies(i, j):
-            if new_board[ii][jj].color is opponent:
-                (group, alive) = self._gather(ii, jj, new_board)
-                if not alive:
-                    for iii, jjj in group:
-                        new_board[iii][jjj].color = None
-                    captured += len(group)
-
-        if not captured and not self._gather(i, j, new_board)[1]:
-            return (False, f"Playing at {coords} is suicide")
-
-        if new_board == self._prev_board:
-            return (False, f"Playing at {coords} violates the simple ko rule")
+        k = i * self.board.size + j
+        error, captured, h = self._check_placement(color, k)
+        if error:
+            return (False, error)
 
         if not dry_run:
-            self._prev_board, self.board = self.board, new_board
-            self.prisoners[color] += captured
+            self._apply_placement(color, k, captured)
+            self._prev_hash, self._hash = self._hash, h
+            if self.superko:
+                self._hash_history.add(h)
+            self.prisoners[color] += sum(len(c.stones) for c in captured)
             self.turn = self.turn.inverse()
 
         return (
@@ -470,21 +1061,251 @@ class Game(JsonifyableBase):
             f"Successfully placed a {color.name} stone at {coords}",
         )
 
-    def legal_moves(self, color: Color) -> List[Tuple[int, int]]:
+    def _screen_placement(self, color: Color, k: int) -> Tuple[bool, List[Chain]]:
+        """
+        Return whether placing a stone of `color` at the empty flat index `k`
+        would not be suicide, along with the opponent chains that the placement
+        would capture. This depends only on the chains adjacent to `k`, so that
+        the result only needs to be recomputed when one of them changes.
+        Assumes that the chains are in sync
+        """
+
+        # thanks to the chain registry, everything can be read off of the
+        # neighboring chains. an opponent chain whose only liberty is the point
+        # being played is captured. if nothing is captured, the placement is
+        # suicide unless the point has an empty neighbor or joins a friendly
+        # chain with a liberty elsewhere
+
+        chains = self._chains
+        captured: List[Chain] = []
+        has_liberty = False
+        for kk in neighbor_table(self.board.size)[k]:
+            chain = chains[kk]
+            if chain is None:
+                has_liberty = True
+            elif chain.color is color:
+                has_liberty = has_liberty or len(chain.liberties) > 1
+            elif len(chain.liberties) == 1 and all(c is not chain for c in captured):
+                captured.append(chain)
+        return (has_liberty or bool(captured), captured)
+
+    def _check_placement(
+        self, color: Color, k: int
+    ) -> Tuple[Optional[str], List[Chain], int]:
+        """
+        Work out whether `color` may place a stone at flat index `k` without
+        touching the board. Return an explanatory message if not (None
+        otherwise), the opponent chains that the placement would capture, and
+        the hash of the resulting position. Assumes that the chains are in sync
+        """
+
+        # having ruled out suicide, we check that the board does not return to
+        # the previous board position (simple ko) or, if enforcing superko, any
+        # earlier position
+        #
+        # NOTE: this used to be done by placing the stone and flood filling on a
+        # deepcopy of the board, which accounted for about a third of the game
+        # server's processing time
+
+        size = self.board.size
+        if self._chains[k]:
+            return (f"Point {divmod(k, size)} is occupied", [], self._hash)
+
+        legal, captured = self._screen_placement(color, k)
+        keys = zobrist_keys(size)
+        h = self._hash ^ keys[k][color.value]
+        for chain in captured:
+            value = chain.color.value
+            for kk in chain.stones:
+                h ^= keys[kk][value]
+
+        if not legal:
+            return (f"Playing at {divmod(k, size)} is suicide", [], h)
+
+        # returning to the previous position means undoing the previous
+        # placement, which is only possible by capturing the single stone
+        # placed and having it have captured a single stone at this point
+        if (
+            len(captured) == 1
+            and len(captured[0].stones) == 1
+            and h == self._prev_hash
+        ):
+            return (
+                f"Playing at {divmod(k, size)} violates the simple ko rule",
+                [],
+                h,
+            )
+
+        if self.superko and h in self._hash_history:
+            return (
+                f"Playing at {divmod(k, size)} violates the positional superko rule",
+                [],
+                h,
+            )
+
+        return (None, captured, h)
+
+    def _apply_placement(self, color: Color, k: int, captured: List[Chain]) -> None:
+        """
+        Place a stone of `color` at flat index `k`, merging it with any
+        adjacent friendly chains and removing the `captured` chains as computed
+        by `_check_placement`. The points whose screening may have changed as a
+        result, i.e. the liberties of every chain whose liberties changed, are
+        marked dirty
+        """
+
+        board, chains = self.board, self._chains
+        board._data[k] = color.value
+
+        # join the stone and its friendly neighbors onto the largest of them,
+        # relabeling the stones of the rest (union by size)
+        neighbors = neighbor_table(board.size)[k]
+        friends: List[Chain] = []
+        touched: List[Chain] = []
+        for kk in neighbors:
+            chain = chains[kk]
+            if chain is not None:
+                chain.liberties.discard(k)
+                if chain.color is color:
+                    if all(c is not chain for c in friends):
+                        friends.append(chain)
+                else:
+                    touched.append(chain)
+        if friends:
+            friends.sort(key=lambda c: len(c.stones), reverse=True)
+            merged = friends[0]
+            for chain in friends[1:]:
+                merged.stones |= chain.stones
+                merged.liberties |= chain.liberties
+                for kk in chain.stones:
+                    chains[kk] = merged
+        else:
+            merged = Chain(color, set(), set())
+        merged.stones.add(k)
+        chains[k] = merged
+        merged.liberties.update(kk for kk in neighbors if chains[kk] is None)
+        touched.append(merged)
+        self._empty.discard(k)
+
+        dirty = {k}
+        for chain in captured:
+            touched.extend(self._remove_chain(chain))
+            dirty |= chain.stones
+        for chain in touched:
+            dirty |= chain.liberties
+        for color_dirty in self._dirty.values():
+            color_dirty |= dirty
+
+    def _remove_chain(self, chain: Chain) -> List[Chain]:
+        """Take `chain` off of the board, handing its points to its neighbors
+        as liberties. Return those neighbors"""
+
+        data, chains = self.board._data, self._chains
+        neighbors = neighbor_table(self.board.size)
+        for k in chain.stones:
+            data[k] = 0
+            chains[k] = None
+        self._empty |= chain.stones
+        res: List[Chain] = []
+        for k in chain.stones:
+            for kk in neighbors[k]:
+                neighbor = chains[kk]
+                if neighbor is not None:
+                    neighbor.liberties.add(k)
+                    res.append(neighbor)
+        return res
+
+    def _sync(self) -> None:
+        """
+        Rebuild the chain registry (and the hash of the current position) from
+        scratch if the board may have changed other than by stone placements
+        made through this class, e.g. by modifying the board directly
+        """
+
+        if (
+            self._chains is not None
+            and self._chains_board is self.board
+            and self._board_generation == self.board._generation
+        ):
+            return
+
+        size = self.board.size
+        data = self.board._data
+        neighbors = neighbor_table(size)
+        chains: List[Optional[Chain]] = [None] * (size * size)
+        for k in range(size * size):
+            value = data[k]
+            if not value or chains[k] is not None:
+                continue
+            chain = Chain(_COLORS[value], {k}, set())
+            chains[k] = chain
+            stack = [k]
+            while stack:
+                for kk in neighbors[stack.pop()]:
+                    other = data[kk]
+                    if not other:
+                        chain.liberties.add(kk)
+                    elif other == value and chains[kk] is None:
+                        chain.stones.add(kk)
+                        chains[kk] = chain
+                        stack.append(kk)
+
+        self._chains = chains
+        self._chains_board = self.board
+        self._board_generation = self.board._generation
+        self._hash = self.board.zobrist_hash()
+        self._empty = {k for k in range(size * size) if chains[k] is None}
+        for c in Color:
+            self._legal[c].clear()
+            self._capturing[c].clear()
+            self._dirty[c] = set(self._empty)
+
+    def chain_at(self, coords: Tuple[int, int]) -> Optional[Chain]:
+        """Return the chain containing the stone at `coords`, or None if the
+        point is empty. Raise IndexError if `coords` is off the board"""
+
+        # a flat index computed from coordinates off the board would otherwise
+        # silently land on another point
+        if not self.board.on_board(coords):
+            raise IndexError(f"{coords} is off the board")
+        self._sync()
+        i, j = coords
+        return self._chains[i * self.board.size + j]
+
+    def legal_moves(self, color: Optional[Color] = None) -> List[Tuple[int, int]]:
         """
-        Return a list of all legal moves for `color`
+        Return a list of all legal moves for `color`, which defaults to the
+        player whose turn it is
         """
 
         # TODO: have this be game status-aware, and possibly include passing. it
         # may actually be better for it to return a list of valid *Actions*
         # instead of points
 
-        return [
-            (i, j)
-            for i in range(self.board.size)
-            for j in range(self.board.size)
-            if self._place_stone_base(color, (i, j), True)[0]
-        ]
+        if color is None:
+            color = self.turn
+        if color is not self.turn:
+            return []
+
+        self._sync()
+        legal, capturing = self._legal[color], self._capturing[color]
+        for k in self._dirty[color]:
+            legal.discard(k)
+            capturing.discard(k)
+            if k in self._empty:
+                ok, captured = self._screen_placement(color, k)
+                if ok:
+                    legal.add(k)
+                    if captured:
+                        capturing.add(k)
+        self._dirty[color].clear()
+
+        # the screening rules out suicide, which leaves ko. simple ko requires
+        # a capture, while superko can rule out any placement
+        candidates = legal if self.superko else capturing
+        moves = legal - {k for k in candidates if self._check_placement(color, k)[0]}
+        size = self.board.size
+        return [divmod(k, size) for k in sorted(moves)]
 
     def _pass_turn(self, action: Action) -> Tuple[bool, str]:
         assert action.action_type is ActionType.pass_turn
@@ -526,14 +1347,23 @@ class Game(JsonifyableBase):
                 "Cannot mark stones as dead while a previous request is pending",
             )
 
-        i, j = action.coords
-        if not self.board[i][j].color:
-            return False, (f"There is no group at {action.coords} to mark dead")
-
-        group, _ = self._gather(i, j)
-        for ii, jj in group:
-            assert not self.board[ii][jj].marked_dead
-            self.board[ii][jj].marked_dead = True
+        points = (
+            action.coords if isinstance(action.coords[0], tuple) else (action.coords,)
+        )
+        group: Set[int] = set()
+        for coords in points:
+            if not self.board.on_board(coords):
+                return False, f"{coords} is off the board"
+            chain = self.chain_at(coords)
+            if not chain:
+                return False, (f"There is no group at {coords} to mark dead")
+            group |= chain.stones
+
+        data, n = self.board._data, self.board.size * self.board.size
+        for k in group:
+            assert not data[n + k]
+            data[n + k] = True
+        self._marked_dead = group
 
         self.status = GameStatus.request_pending
         self.pending_request = Request(RequestType.mark_dead, action.color)
@@ -545,47 +1375,51 @@ class Game(JsonifyableBase):
         makes the appropriate assertions for all types of requests. Any other
         usage is undefined"""
 
-        def count_and_clear(just_count: bool = False) -> Tuple[int, Color]:
-            """As only one group at a time can be marked dead, we can simply
-            scan the board for points marked dead, counting and unmarking
-            them as we go. If just_count is False, we will additionally clear
-            the pieces by setting that Point's color to None"""
-
-            num_marked = 0
-            color = None
-
-            for i in range(self.board.size):
-                for j in range(self.board.size):
-                    if self.board[i][j].marked_dead:
-                        if color is None:
-                            color = self.board[i][j].color
-                        elif color is not self.board[i][j].color:
-                            raise RuntimeError(
-                                "More than one color of stones at a time is currently"
-                                " marked dead, which should never happen"
-                            )
-                        self.board[i][j].marked_dead = False
-                        if not just_count:
-                            self.board[i][j].color = None
-                        num_marked += 1
-
-            if not num_marked:
+        def count_and_clear(just_count: bool = False) -> Dict[Color, int]:
+            """Count and unmark the stones marked dead by the pending request,
+            by color. If just_count is False, we will additionally clear the
+            pieces by setting that Point's color to None"""
+
+            if not self._marked_dead:
                 raise RuntimeError(
                     "No stones are marked as dead, but we are handling a response to"
                     " them having been marked"
                 )
 
-            return num_marked, color
+            num_marked = {c: 0 for c in Color}
+            keys = zobrist_keys(self.board.size)
+            data, n = self.board._data, self.board.size * self.board.size
+
+            for k in self._marked_dead:
+                num_marked[_COLORS[data[k]]] += 1
+                data[n + k] = False
+                if not just_count:
+                    self._hash ^= keys[k][data[k]]
+                    data[k] = 0
+            self._marked_dead = set()
+
+            # removing dead stones is rare enough that we simply rebuild the
+            # chains from scratch when next needed
+            if not just_count:
+                self._chains = None
+
+            return num_marked
 
         if action.action_type is ActionType.accept:
-            num_marked, color = count_and_clear()
-            self.prisoners[color.inverse()] += num_marked
+            num_marked = count_and_clear()
+            if self.superko:
+                self._hash_history.add(self._hash)
+            for color in Color:
+                self.prisoners[color.inverse()] += num_marked[color]
             self.status = GameStatus.endgame
         else:  # ActionType.reject
-            num_marked, color = count_and_clear(True)
+            num_marked = count_and_clear(True)
             self.status = GameStatus.play
 
-        return f"request to mark {num_marked} {color.name} stones as dead" + (
+        stones = " and ".join(
+            f"{num_marked[c]} {c.name}" for c in Color if num_marked[c]
+        )
+        return f"request to mark {stones} stones as dead" + (
             ". Returning to play to resolve"
             if action.action_type is ActionType.reject
             else ""
@@ -677,38 +1511,23 @@ class Game(JsonifyableBase):
         return "request to tally the score"
 
     def _count_territory(self) -> None:
-        # We proceed by scanning the board for empty points, keeping track of
-        # those already processed by marking them as counted. When we find an
-        # uncounted empty point, we collect all empty points connected to it
-        # along with the colors of the stones on the group's borders. If there
-        # is only one color on the border, we assign the points to that color
-        # and mark the points as such. Otherwise (zero or two border colors),
-        # we mark the group as neutral and assign no points
-
-        for i in range(self.board.size):
-            for j in range(self.board.size):
-                if self.board[i][j].color is None and not self.board[i][j].counted:
-                    stack = [(i, j)]
-                    colors = set()
-                    group = set()
-                    border = set()
-                    while stack:
-                        ii, jj = stack.pop()
-                        if (ii, jj) in group | border:
-                            continue
-                        color = self.board[ii][jj].color
-                        if color is None:
-                            group.add((ii, jj))
-                            stack.extend(self._adjacencies(ii, jj))
-                        else:
-                            border.add((ii, jj))
-                            colors.add(color)
-                    counts_for = colors.pop() if len(colors) == 1 else None
-                    for ii, jj in group:
-                        self.board[ii][jj].counted = True
-                        self.board[ii][jj].counts_for = counts_for
-                    if counts_for:
-                        self.territory[counts_for] += len(group)
+        # We mark every empty point as counted and as counting for its owner
+        # per territory_map, if any, tallying up the territory of each player
+        # as we go. Points which have already been counted are left alone
+
+        size, data = self.board.size, self.board._data
+        n = size * size
+        owners = self.board.territory_map()
+        counts = [0] * (len(Color) + 1)
+
+        for k in range(n):
+            if not data[k] and not data[2 * n + k]:
+                data[2 * n + k] = True
+                data[3 * n + k] = owners[k]
+                counts[owners[k]] += 1
+
+        for c in Color:
+            self.territory[c] += counts[c.value]
 
     def _respond(self, action: Action) -> Tuple[bool, str]:
         assert action.action_type in (ActionType.accept, ActionType.reject)
@@ -741,45 +1560,6 @@ class Game(JsonifyableBase):
             ),
         )
 
-    def _adjacencies(self, i: int, j: int) -> Set[Tuple[int, int]]:
-        """Utility to return the set of in bounds points adjacent to (i, j)
-        given self.board"""
-
-        return {
-            (ii, jj)
-            for ii, jj in ((i - 1, j), (i + 1, j), (i, j - 1), (i, j + 1))
-            if 0 <= ii < self.board.size and 0 <= jj < self.board.size
-        }
-
-    def _gather(
-        self, i: int, j: int, board: Board = None
-    ) -> Tuple[Set[Tuple[int, int]], bool]:
-        """Gather all of the stones in the same group as board[i][j] and
-        return their coordinates in a set along with an indicator of whether
-        or not they are alive. Note that board is set to self.board if
-        unspecified"""
-
-        if not board:
-            board = self.board
-
-        assert board[i][j].color
-
-        color = board[i][j].color
-        group = {(i, j)}
-        stack = [(i, j)]
-        alive = False
-
-        while stack:
-            adjacencies = self._adjacencies(*stack.pop()) - group
-            alive = alive or any(board[ii][jj].color is None for ii, jj in adjacencies)
-            to_add = [
-                (ii, jj) for ii, jj in adjacencies if board[ii][jj].color is color
-            ]
-            group.update(to_add)
-            stack.extend(to_add)
-
-        return (group, alive)
-
     def ahead_of(self, timestamp: float) -> bool:
         """If the last successful action was after timestamp, return True
         and False if this is a new game or otherwise"""
@@ -825,16 +1605,25 @@ class Game(JsonifyableBase):
 
         # TODO: stub
 
-    def jsonifyable(self) -> Dict:
+    def jsonifyable(self, compact: bool = False) -> Dict:
         """Return a representation which can be readily JSONified. In
         particular, return a dictionary with the board, game status, komi,
         prisoner counts, whose turn it is, territory, any pending request, the
         game result, and the coordinates of the last stone placed, noting that
         some of these are meaningless or unavailable depending on the game
-        state"""
+        state. If `compact`, the board is given in its compact representation
+        (see `Board.jsonifyable`)"""
+
+        return {
+            "board": self.board.jsonifyable(compact),
+            **self.jsonifyable_without_board(),
+        }
+
+    def jsonifyable_without_board(self) -> Dict:
+        """Return `jsonifyable()` less the board, which is by far the largest
+        part of it, for when the board is sent by other means"""
 
         return {
-            "board": self.board.jsonifyable(),
             "status": self.status.name,
             "komi": self.komi,
             "prisoners": {
@@ -855,14 +1644,21 @@ class Game(JsonifyableBase):
 
     @classmethod
     def _deserialize(cls, data: Dict) -> Game:
-        """Note that `Game.jsonifyable` strips out the action stack and previous
-        board. As such, they are not available in the deserialized version
+        """Note that `Game.jsonifyable` strips out the action stack and ko
+        state. As such, they are not available in the deserialized version
         produced by this method, with one exception: if `lastMove` is available,
         a single action will be pushed onto the stack with the last move
         coordinates and a fake timestamp"""
 
+        return cls.deserialize_with_board(Board.deserialize(data["board"]), data)
+
+    @classmethod
+    def deserialize_with_board(cls, board: Board, data: Dict) -> Game:
+        """Inverse of `jsonifyable_without_board`, given the board. The same
+        caveats apply as for `deserialize`"""
+
         self: Game = cls.__new__(cls)
-        self.board = Board.deserialize(data["board"])
+        self.board = board
         self.status = GameStatus[data["status"]]
         self.komi = data["komi"]
         prisoners = data["prisoners"]
@@ -886,5 +1682,10 @@ class Game(JsonifyableBase):
                     tuple(data["lastMove"]),
                 )
             )
-        self._prev_board = None
+        self.superko = False
+        self._hash = self.board.zobrist_hash()
+        self._prev_hash = None
+        self._hash_history = set()
+        self._marked_dead = self.board.marked_dead()
+        self._reset_transient()
         return self
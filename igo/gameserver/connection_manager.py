@@ -1,17 +1,23 @@
-from datetime import datetime
+import asyncio
 from functools import cached_property
 import re
+import signal
+import time
+from .constants import BINARY_SUBPROTOCOL, FEATURES
 from .containers import ErrorContainer
-from typing import Any, NoReturn
+from typing import Any, Dict, List, NoReturn, Optional, Union
 from tornado import httputil
 from .messages import (
     IncomingMessage,
     OutgoingMessage,
     OutgoingMessageType,
 )
+from .engine import EnginePool
 from .game_manager import GameManager
+from .log_events import log_event
 from secrets import token_urlsafe
 import logging
+import tornado.process
 import tornado.web
 import tornado.websocket
 from tornado.options import define, options
@@ -33,6 +39,215 @@ define(
     ),
     type=str,
 )
+define(
+    "max_message_size",
+    default=16 * 1024,
+    help=(
+        "close connections which send messages larger than this many bytes, before"
+        " reading them. the largest valid message is a few KiB"
+    ),
+    type=int,
+)
+define(
+    "rejection_stats_interval",
+    default=60.0,
+    help="log counts of rejected messages every this many seconds, or never if 0",
+    type=float,
+)
+define(
+    "migrate_game_data",
+    default=False,
+    help=(
+        "once started, rewrite all games still stored as pickles by earlier versions"
+        " of the server using the game codec. safe to run while serving"
+    ),
+    type=bool,
+)
+define(
+    "compression",
+    default=True,
+    help="compress messages to clients which support permessage-deflate",
+    type=bool,
+)
+define(
+    "compression_level",
+    default=6,
+    help="the zlib level at which to compress messages, from 1 (fastest) to 9",
+    type=int,
+)
+define(
+    "compression_window_bits",
+    default=15,
+    help=(
+        "the base two logarithm of the compression window size, from 9 to 15."
+        " smaller windows use less memory per connection but compress less"
+    ),
+    type=int,
+)
+define(
+    "compression_threshold",
+    default=128,
+    help="send messages shorter than this many bytes uncompressed",
+    type=int,
+)
+define(
+    "compression_stats_interval",
+    default=60.0,
+    help="log compression statistics every this many seconds, or never if 0",
+    type=float,
+)
+
+
+class CompressionStats:
+    """
+    Counters for permessage-deflate compression across all connections, for
+    tuning the compression options against real load
+
+    Attributes:
+
+        compressed: int - the number of messages compressed
+
+        uncompressed: int - the number of messages sent uncompressed to clients
+        which support compression, because they were below the threshold
+
+        bytes_in: int - the total size of compressed messages before
+        compression
+
+        bytes_out: int - the total size of compressed messages after
+        compression
+
+        cpu_time: float - the CPU time in seconds spent compressing
+    """
+
+    __slots__ = ("compressed", "uncompressed", "bytes_in", "bytes_out", "cpu_time")
+
+    def __init__(self) -> None:
+        self.compressed = 0
+        self.uncompressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+
+    def __str__(self) -> str:
+        saved = self.bytes_in - self.bytes_out
+        return (
+            f"compressed {self.compressed} of"
+            f" {self.compressed + self.uncompressed} messages from"
+            f" {self.bytes_in} to {self.bytes_out} bytes, saving {saved} bytes"
+            f" ({saved / max(self.bytes_in, 1):.1%}) for"
+            f" {self.cpu_time * 1000:.1f}ms of CPU"
+            f" ({self.cpu_time * 1e6 / max(saved / 1024, 1):.1f}us per KiB saved)"
+        )
+
+
+compression_stats = CompressionStats()
+
+
+class RejectionStats:
+    """
+    Counters for incoming messages rejected across all connections, e.g. from
+    broken or hostile clients
+
+    Attributes:
+
+        oversized: int - the number of messages larger than the max message
+        size, which close the connection unread
+
+        invalid: int - the number of messages which were malformed or didn't
+        match the schema of their type (see `IncomingMessage`)
+    """
+
+    __slots__ = ("oversized", "invalid")
+
+    def __init__(self) -> None:
+        self.oversized = 0
+        self.invalid = 0
+
+    def __str__(self) -> str:
+        return (
+            f"rejected {self.oversized} oversized and {self.invalid} invalid"
+            " messages"
+        )
+
+
+rejection_stats = RejectionStats()
+
+
+class _MeasuredCompressor:
+    """Wraps a message compressor to count what it does in `compression_stats`"""
+
+    __slots__ = "_compressor"
+
+    def __init__(self, compressor: Any) -> None:
+        self._compressor = compressor
+
+    def compress(self, data: bytes) -> bytes:
+        start = time.process_time()
+        res = self._compressor.compress(data)
+        compression_stats.cpu_time += time.process_time() - start
+        compression_stats.compressed += 1
+        compression_stats.bytes_in += len(data)
+        compression_stats.bytes_out += len(res)
+        return res
+
+
+class _IgoWebSocketProtocol(tornado.websocket.WebSocketProtocol13):
+    """
+    The websocket protocol, but with compression as configured by the
+    compression options, and counting oversized messages in `rejection_stats`.
+    tornado doesn't expose the window size, a size threshold or why it closes
+    connections, so this reaches into its implementation a little
+    """
+
+    def close(self, code: Optional[int] = None, reason: Optional[str] = None) -> None:
+        # tornado closes with this code, "message too big", as soon as it reads
+        # the length of a message larger than the max message size
+        if code == 1009:
+            rejection_stats.oversized += 1
+        super().close(code, reason)
+
+    def _get_compressor_options(
+        self,
+        side: str,
+        agreed_parameters: Dict[str, Any],
+        compression_options: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        res = super()._get_compressor_options(
+            side, agreed_parameters, compression_options
+        )
+        if side == "server":
+            # a smaller window than agreed is always fine with the client, but
+            # the client's own window is up to it
+            res["max_wbits"] = min(res["max_wbits"], options.compression_window_bits)
+        return res
+
+    def _create_compressors(
+        self,
+        side: str,
+        agreed_parameters: Dict[str, Any],
+        compression_options: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        super()._create_compressors(side, agreed_parameters, compression_options)
+        self._compressor = _MeasuredCompressor(self._compressor)
+
+    def write_message(
+        self, message: Union[str, bytes, Dict[str, Any]], binary: bool = False
+    ) -> "asyncio.Future[None]":
+        compressor = self._compressor
+        if (
+            compressor is None
+            or isinstance(message, dict)
+            or len(message) >= options.compression_threshold
+        ):
+            return super().write_message(message, binary)
+        # compression is per message, so small messages, which would barely
+        # shrink, may be sent as is without disturbing the compression context
+        compression_stats.uncompressed += 1
+        self._compressor = None
+        try:
+            return super().write_message(message, binary)
+        finally:
+            self._compressor = compressor
 
 
 class IgoWebSocket(tornado.websocket.WebSocketHandler):
@@ -48,7 +263,7 @@ class IgoWebSocket(tornado.websocket.WebSocketHandler):
         super().__init__(application, request, **kwargs)
 
     @classmethod
-    async def init(cls, origin_suffix: str):
+    async def init(cls, origin_suffix: str, engine: Optional[EnginePool] = None):
         """
         Must be called before use. We want tornado to have priority setting
         up, so this is best called immediately before starting the event loop
@@ -60,7 +275,9 @@ class IgoWebSocket(tornado.websocket.WebSocketHandler):
         preempted with the default logger settings
         """
 
-        cls.game_manager: GameManager = await GameManager(os.environ["DATABASE_URL"])
+        cls.game_manager: GameManager = await GameManager(
+            os.environ["DATABASE_URL"], engine=engine
+        )
         match_expr = (
             f"{'' if origin_suffix.startswith('^') else '.*'}{origin_suffix}(:\d+)?$"
         )
@@ -82,26 +299,66 @@ class IgoWebSocket(tornado.websocket.WebSocketHandler):
             else self.request.remote_ip
         ) + f" ({self.request.headers['Sec-Websocket-Key'][:7]})"
 
+    def get_compression_options(self) -> Optional[Dict[str, Any]]:
+        if not options.compression:
+            return None
+        return {"compression_level": options.compression_level}
+
+    def get_websocket_protocol(self) -> Optional[tornado.websocket.WebSocketProtocol]:
+        protocol = super().get_websocket_protocol()
+        if isinstance(protocol, tornado.websocket.WebSocketProtocol13):
+            return _IgoWebSocketProtocol(self, False, protocol.params)
+        return protocol
+
+    def select_subprotocol(self, subprotocols: List[str]) -> Optional[str]:
+        # browsers speak JSON, so binary is only used by clients which ask
+        return BINARY_SUBPROTOCOL if BINARY_SUBPROTOCOL in subprotocols else None
+
     def open(self):
-        logging.info(f"New connection opened from {self.id}")
+        # optional wire protocol features requested by the client. see FEATURES
+        self.features = frozenset(
+            f for f in self.get_query_argument(FEATURES, "").split(",") if f
+        )
+        # whether messages are sent and received in binary. see wire
+        self.binary = self.selected_subprotocol == BINARY_SUBPROTOCOL
+        logging.info(
+            f"New connection opened from {self.id}"
+            + (f" with features {sorted(self.features)}" if self.features else "")
+            + (f" using subprotocol {BINARY_SUBPROTOCOL}" if self.binary else "")
+        )
 
-    async def on_message(self, json: str):
-        start_time = datetime.now()
-        logging.info(f"Received message from {self.id}: {json}")
+    async def on_message(self, message: Union[str, bytes]):
+        start_time = time.perf_counter()
 
         try:
-            await self.game_manager.route_message(IncomingMessage(json, self))
+            msg = IncomingMessage(message, self)
+        except ValueError as e:
+            # the client is broken or hostile, so do as little as possible. in
+            # particular, don't log the whole message or a traceback
+            rejection_stats.invalid += 1
+            logging.warning(f"Rejected message from {self.id}: {e}")
+            await OutgoingMessage(
+                OutgoingMessageType.error, ErrorContainer(e), self
+            ).send()
+            return
+
+        log_event("received", message_type=msg.message_type, client=self.id)
+        logging.debug("Message data: %s", msg.data)
+        try:
+            await self.game_manager.route_message(msg)
 
         except Exception as e:
-            logging.exception(f"Encountered exception while processing message {json}")
+            logging.exception(f"Encountered exception while processing message {msg}")
             await OutgoingMessage(
                 OutgoingMessageType.error, ErrorContainer(e), self
             ).send()
 
         else:
-            logging.info(
-                f"Processed message {json} in"
-                f" {(datetime.now() - start_time).total_seconds()}s"
+            log_event(
+                "processed",
+                message_type=msg.message_type,
+                client=self.id,
+                seconds=time.perf_counter() - start_time,
             )
 
     def on_close(self):
@@ -120,7 +377,7 @@ class IgoWebSocket(tornado.websocket.WebSocketHandler):
             )
 
     def on_pong(self, data: bytes) -> None:
-        logging.info(f"Received pong from {self.id}")
+        log_event("pong", client=self.id)
 
 
 class Application(tornado.web.Application):
@@ -133,6 +390,7 @@ class Application(tornado.web.Application):
             # of 3 pings or 30 seconds by default, hence max(10*3, 30) = 30
             # seconds here. note also that heroku's idle timeout is 55 seconds
             websocket_ping_interval=10,
+            websocket_max_message_size=options.max_message_size,
         )
         super().__init__(handlers, **settings)
 
@@ -140,9 +398,81 @@ class Application(tornado.web.Application):
 def start_server() -> NoReturn:
     uvloop.install()
     options.parse_command_line()
+    if not 1 <= options.compression_level <= 9:
+        raise ValueError(f"Invalid compression level {options.compression_level}")
+    if not 9 <= options.compression_window_bits <= 15:
+        raise ValueError(
+            f"Invalid compression window bits {options.compression_window_bits}"
+        )
+    if options.processes != 1:
+        # the children start here, and the parent never returns, restarting
+        # any which die under the same task id (see DbManager). each listens
+        # on its own socket, which the kernel balances connections across
+        tornado.process.fork_processes(options.processes)
+    # forked before anything else is set up, see EnginePool
+    engine = (
+        EnginePool(os.environ["DATABASE_URL"], options.engine_workers)
+        if options.engine_workers > 0
+        else None
+    )
     app = Application()
-    app.listen(options.port)
+    app.listen(options.port, reuse_port=options.processes != 1)
     io_loop = tornado.ioloop.IOLoop.current()
-    io_loop.run_sync(lambda: IgoWebSocket.init(options.origin_suffix))
-    logging.info(f"Listening on port {options.port}")
+    io_loop.run_sync(lambda: IgoWebSocket.init(options.origin_suffix, engine))
+    task_id = tornado.process.task_id()
+    logging.info(
+        f"Listening on port {options.port}"
+        + (f" as process {task_id}" if task_id is not None else "")
+    )
+    if options.compression and options.compression_stats_interval > 0:
+        tornado.ioloop.PeriodicCallback(
+            lambda: logging.info(f"Compression: {compression_stats}"),
+            options.compression_stats_interval * 1000,
+        ).start()
+    if options.rejection_stats_interval > 0:
+        tornado.ioloop.PeriodicCallback(
+            lambda: logging.info(f"Rejections: {rejection_stats}"),
+            options.rejection_stats_interval * 1000,
+        ).start()
+
+    if options.migrate_game_data and not task_id:
+        # only one process need do so
+
+        async def migrate_game_data() -> None:
+            try:
+                await IgoWebSocket.game_manager.migrate_game_data()
+            except Exception:
+                logging.exception("Failed to migrate game data")
+
+        io_loop.spawn_callback(migrate_game_data)
+
+    parent_watch: Optional[tornado.ioloop.PeriodicCallback] = None
+
+    async def shutdown() -> None:
+        logging.info("Shutting down")
+        if parent_watch is not None:
+            parent_watch.stop()
+        try:
+            await IgoWebSocket.game_manager.close()
+            if engine is not None:
+                engine.close()
+        finally:
+            io_loop.stop()
+
+    # write out anything unwritten, see GameStore, before exiting
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        io_loop.asyncio_loop.add_signal_handler(
+            sig, lambda: io_loop.spawn_callback(shutdown)
+        )
+    if task_id is not None:
+        # the parent restarts processes which die, but doesn't pass signals on
+        # to them, so shut down along with it
+        parent = os.getppid()
+
+        def watch_parent() -> None:
+            if os.getppid() != parent:
+                io_loop.spawn_callback(shutdown)
+
+        parent_watch = tornado.ioloop.PeriodicCallback(watch_parent, 1000)
+        parent_watch.start()
     io_loop.start()
@@ -1,4 +1,7 @@
 KEY_LEN = 10
+# limits on the values in incoming messages. see INCOMING_VALIDATORS
+MAX_BOARD_SIZE = 25
+MAX_CHAT_MESSAGE_LEN = 1000
 TYPE = "type"
 KEY = "key"
 VS = "vs"
@@ -9,3 +12,11 @@ ACTION_TYPE = "action_type"
 COORDS = "coords"
 MESSAGE = "message"
 AI_SECRET = "ai_secret"
+# optional wire protocol features, requested by clients per connection as a
+# comma separated list in the FEATURES query argument of the websocket url
+FEATURES = "features"
+FEATURE_DELTA = "delta"
+FEATURE_COMPACT = "compact"
+FEATURE_BATCH = "batch"
+# websocket subprotocol under which messages are sent in binary. see wire
+BINARY_SUBPROTOCOL = "igo.binary.v2"
@@ -1,8 +1,10 @@
 from __future__ import annotations
+import asyncio
 from .chat import ChatThread
-from typing import Dict, Optional
+from copy import deepcopy
+from typing import Dict, List, Optional, Set, Tuple
 from dataclassy import dataclass
-from igo.game import Color, Game
+from igo.game import Color, Game, Point
 from igo.serialization import JsonifyableBase, JsonifyableBaseDataClass
 
 
@@ -61,6 +63,46 @@ class KeyContainer(JsonifyableBase):
         return self._keys_w if color is Color.white else self._keys_b
 
 
+@dataclass(slots=True)
+class GameEntry:
+    """
+    GameEntry is the in-memory state of a single game, shared by the clients of
+    both players whenever they are connected to the same game server.
+
+    Attributes:
+
+        game: Optional[Game] = None - the current game
+
+        time_played: Optional[float] = None - the time in seconds that the game
+        has been actively played thus far
+
+        player_keys: Set[str] = set() - the keys of the players of the game
+        connected to this game server
+
+        written_version: int = 0 - the version of the game last written to or
+        read from the database. in write-behind mode (see `GameStore`), the game
+        may be several actions ahead of it
+
+        lock: asyncio.Lock - held while an action is taken and written, such
+        that actions on the game are taken and written in order
+    """
+
+    game: Optional[Game] = None
+    time_played: Optional[float] = None
+    player_keys: Set[str] = set()
+    written_version: int = 0
+    lock: Optional[asyncio.Lock] = None
+
+    def __post_init__(self) -> None:
+        self.lock = asyncio.Lock()
+
+    def num_unwritten(self) -> int:
+        """Return the number of actions taken on the game but not yet written
+        to the database"""
+
+        return 0 if self.game is None else self.game.version() - self.written_version
+
+
 @dataclass(slots=True)
 class ClientData:
     """
@@ -73,27 +115,56 @@ class ClientData:
 
         color: Color - the client's color
 
-        game: Optional[Game] = None - the current game
-
-        time_played: Optional[float] = None - the time in seconds that the game
-        has been actively played thus far
+        entry: GameEntry - the current game, shared with the client's opponent
+        if they are connected to the same game server. `game` and `time_played`
+        are shorthand for its attributes
 
         chat_thread: Optional[ChatThread] = None - the chat thread associated
         with the current game
 
         opponent_connected: Optional[bool] = None - whether or not the client's
         opponent in the current game is connected to a game server
+
+        sent_version: Optional[int] = None - the version of the last game
+        status sent to the client, if it is to be sent deltas
+
+        sent_board: Optional[bytes] = None - the packed board state (see
+        `Board`) of the last game status sent to the client, if it is to be sent
+        deltas
+
+        game_key: Optional[str] = None - an identifier of the game shared by
+        the clients of both players, namely the white player key
     """
 
     keys: KeyPair
     color: Color
-    game: Optional[Game] = None
-    time_played: Optional[float] = None
+    entry: GameEntry = None
     chat_thread: Optional[ChatThread] = None
     opponent_connected: Optional[bool] = None
+    sent_version: Optional[int] = None
+    sent_board: Optional[bytes] = None
+    game_key: Optional[str] = None
 
     def __post_init__(self) -> None:
         self.chat_thread = ChatThread(is_complete=True)
+        if self.entry is None:
+            self.entry = GameEntry()
+
+    @property
+    def game(self) -> Optional[Game]:
+        return self.entry.game
+
+    @game.setter
+    def game(self, game: Optional[Game]) -> None:
+        self.entry.game = game
+
+    @property
+    def time_played(self) -> Optional[float]:
+        return self.entry.time_played
+
+    @time_played.setter
+    def time_played(self, time_played: Optional[float]) -> None:
+        self.entry.time_played = time_played
 
 
 class ResponseContainer(JsonifyableBaseDataClass):
@@ -247,18 +318,131 @@ class OpponentConnectedContainer(JsonifyableBaseDataClass):
 class GameStatusContainer(JsonifyableBaseDataClass):
     """
     A container for transmitting game status which implements jsonifyable.
-    Combines a Game object with its time played value.
+    Combines a Game object with its time played value and optionally its
+    version, i.e. the length of its action stack. The version is included when
+    the client is to be sent `GameStatusDeltaContainer`s based on this status,
+    as it cannot otherwise be recovered from the deserialized game. If
+    `compact`, the board is given in its compact representation (see
+    `Board.jsonifyable`)
     """
 
     game: Game
     time_played: float
+    version: Optional[int] = None
+    compact: bool = False
 
     def jsonifyable(self) -> Dict:
-        return {**self.game.jsonifyable(), "timePlayed": self.time_played}
+        res = {**self.game.jsonifyable(self.compact), "timePlayed": self.time_played}
+        if self.version is not None:
+            res["version"] = self.version
+        return res
 
     @staticmethod
     def _deserialize(data: Dict) -> GameStatusContainer:
-        return GameStatusContainer(Game.deserialize(data), data["timePlayed"])
+        return GameStatusContainer(
+            Game.deserialize(data),
+            data["timePlayed"],
+            data.get("version"),
+            "colors" in data["board"],
+        )
+
+    def apply_delta(
+        self, delta: GameStatusDeltaContainer
+    ) -> Optional[GameStatusContainer]:
+        """Return the game status resulting from applying `delta` to this one,
+        or None if `delta` is not based on this status' version, in which case
+        the client should request a full game status"""
+
+        if self.version is None or self.version != delta.base_version:
+            return None
+        board = deepcopy(self.game.board)
+        for i, j, point in delta.changes:
+            board[i][j] = point
+        return GameStatusContainer(
+            Game.deserialize_with_board(board, delta.fields),
+            delta.time_played,
+            delta.version,
+            self.compact,
+        )
+
+
+class GameStatusDeltaContainer(JsonifyableBaseDataClass):
+    """
+    A container for transmitting the changes to a game status since an earlier
+    version of it which implements jsonifyable. As a move only changes a
+    handful of points, this is a small fraction of the size of a full
+    `GameStatusContainer`. See `GameStatusContainer.apply_delta`
+
+    Attributes:
+
+        base_version: int - the version of the game status to which the
+        changes apply
+
+        version: int - the version of the game status after the changes
+
+        changes: List[Tuple[int, int, Point]] - the row, column and new value
+        of each point on the board which changed
+
+        fields: Dict - the game fields other than the board, as given by
+        `Game.jsonifyable_without_board`
+
+        time_played: float - the time in seconds that the game has been played
+    """
+
+    base_version: int
+    version: int
+    changes: List[Tuple[int, int, Point]]
+    fields: Dict
+    time_played: float
+
+    @staticmethod
+    def from_boards(
+        game: Game, time_played: float, base_version: int, base_board: bytes
+    ) -> GameStatusDeltaContainer:
+        """Return the delta from a game status of `base_version`, the board of
+        which had the packed state `base_board` (see `Board`), to `game`"""
+
+        board = game.board
+        size = board.size
+        n = size * size
+        data = board._data
+        changes = []
+        for k in range(n):
+            if (
+                data[k] != base_board[k]
+                or data[n + k] != base_board[n + k]
+                or data[2 * n + k] != base_board[2 * n + k]
+                or data[3 * n + k] != base_board[3 * n + k]
+            ):
+                i, j = divmod(k, size)
+                changes.append((i, j, board[i][j].to_point()))
+        return GameStatusDeltaContainer(
+            base_version,
+            game.version(),
+            changes,
+            game.jsonifyable_without_board(),
+            time_played,
+        )
+
+    def jsonifyable(self) -> Dict:
+        return {
+            **self.fields,
+            "baseVersion": self.base_version,
+            "version": self.version,
+            "changes": [[i, j, p.jsonifyable()] for i, j, p in self.changes],
+            "timePlayed": self.time_played,
+        }
+
+    @staticmethod
+    def _deserialize(data: Dict) -> GameStatusDeltaContainer:
+        data = dict(data)
+        base_version = data.pop("baseVersion")
+        version = data.pop("version")
+        changes = [(i, j, Point.deserialize(p)) for i, j, p in data.pop("changes")]
+        time_played = data.pop("timePlayed")
+        return GameStatusDeltaContainer(
+            base_version, version, changes, data, time_played
+        )
 
 
 class ErrorContainer(JsonifyableBaseDataClass):
@@ -3,8 +3,10 @@ import string
 from collections import defaultdict
 from enum import Enum, auto
 from .constants import KEY_LEN
+from igo.codec import LEGACY_PREFIX, decode_game, encode_game
 from igo.game import Color, Game
 from .chat import ChatMessage, ChatThread
+from .log_events import log_event
 from typing import (
     Callable,
     Coroutine,
@@ -16,12 +18,31 @@ from typing import (
 )
 from asyncinit import asyncinit
 import asyncpg
+import tornado.process
 from uuid import uuid4
 from hashlib import sha256
 import asyncio
-import pickle
 import logging
 import aiofiles
+from tornado.options import define, options
+
+define(
+    "processes",
+    default=1,
+    help=(
+        "run the given number of game server processes, or one per core if 0, all"
+        " listening on the port. each manages its own connections in the database"
+    ),
+    type=int,
+)
+
+
+def _task_manager_id(host_id: str, task_id: int) -> str:
+    """Return the manager id of the game server process with the given task id
+    on the host with the given id. All share the host's prefix, so that those
+    of processes which no longer run can be found"""
+
+    return host_id[:56] + f"{task_id:08x}"
 
 
 class JoinResult(Enum):
@@ -90,7 +111,7 @@ class DbManager:
         "_listening_channels",
         "_listener_lock",
         "_connection_pool",
-        "_machine_id",
+        "_manager_id",
         "_update_queue",
         "_game_status_callback",
         "_chat_callback",
@@ -161,7 +182,16 @@ class DbManager:
         # machine-id is a reboot persistent unique identifier that should not be
         # shared externally. the following mimics sd_id128_get_machine_app_specific()
         async with aiofiles.open("/etc/machine-id", "rb") as r:
-            self._machine_id = sha256((await r.readline()).strip()).hexdigest()
+            machine_id: bytes = (await r.readline()).strip()
+        # when several game server processes run on the host (see the processes
+        # option), each manages its own connections, identified by its task id.
+        # task ids survive restarts of the processes, which is what lets each
+        # clean up after itself below
+        task_id: Optional[int] = tornado.process.task_id()
+        host_id = sha256(machine_id).hexdigest()
+        self._manager_id: str = (
+            host_id if task_id is None else _task_manager_id(host_id, task_id)
+        )
 
         if do_setup:
             try:
@@ -194,7 +224,10 @@ class DbManager:
         # orphaned without manual intervention. this could be commonplace in
         # certain environments, where some external janitorial watcher would
         # need to be present. for now, we are assuming that the worst that
-        # happens to any game server is an unexpected restart
+        # happens to any game server is an unexpected restart. the only or
+        # first process on the host also cleans up after any which ran on it
+        # before but no longer do, i.e. a single process game server, or those
+        # beyond the number of processes now running
         try:
             conn: asyncpg.Connection
             async with self._connection_pool.acquire() as conn:
@@ -203,8 +236,23 @@ class DbManager:
                         """
                         CALL do_cleanup($1);
                         """,
-                        self._machine_id,
+                        self._manager_id,
                     )
+                    if not task_id:
+                        await conn.execute(
+                            """
+                            CALL do_cleanup_retired($1, $2);
+                            """,
+                            host_id[:56],
+                            [self._manager_id]
+                            if task_id is None
+                            else [
+                                _task_manager_id(host_id, t)
+                                for t in range(
+                                    options.processes or tornado.process.cpu_count()
+                                )
+                            ],
+                        )
 
         except Exception as e:
             raise Exception("Failed to execute restart database cleanup") from e
@@ -302,11 +350,11 @@ class DbManager:
                         """
                         CALL new_game($1, $2, $3, $4, $5, $6, $7, $8);
                         """,
-                        pickle.dumps(game),
+                        encode_game(game),
                         key_w,
                         key_b,
                         player_color.name if player_color else None,
-                        self._machine_id,
+                        self._manager_id,
                         key_to_unsubscribe,
                         ai_secret_w,
                         ai_secret_b,
@@ -368,7 +416,7 @@ class DbManager:
                         SELECT * FROM join_game($1, $2, $3, $4);
                         """,
                         player_key,
-                        self._machine_id,
+                        self._manager_id,
                         key_to_unsubscribe,
                         ai_secret,
                     )
@@ -420,6 +468,47 @@ class DbManager:
                 f"Failed to trigger update all for player key {player_key}"
             ) from e
 
+    async def get_all(self, player_key: str) -> Tuple[Game, float, ChatThread, bool]:
+        """
+        Return everything that `trigger_update_all` would trigger updates of,
+        i.e. the game and time played, the complete chat thread, and whether the
+        opponent is connected, for callers which would rather have it all at
+        once than as separate notifications
+        """
+
+        try:
+            conn: asyncpg.Connection
+            async with self._connection_pool.acquire() as conn:
+                # all from the same snapshot of the database
+                async with conn.transaction(isolation="repeatable_read", readonly=True):
+                    game_data, time_played, _ = await conn.fetchrow(
+                        """
+                        SELECT * FROM get_game_status($1);
+                        """,
+                        player_key,
+                    )
+                    rows: List[asyncpg.Record] = await conn.fetch(
+                        """
+                        SELECT * FROM get_chat_updates($1);
+                        """,
+                        player_key,
+                    )
+                    connected: bool = await conn.fetchval(
+                        """
+                        SELECT * FROM get_opponent_connected($1);
+                        """,
+                        player_key,
+                    )
+            game: Game = decode_game(game_data)
+
+        except Exception as e:
+            raise Exception(f"Failed to get all for player key {player_key}") from e
+
+        thread = ChatThread(is_complete=True)
+        for id, timestamp, color, message in rows:
+            thread.append(ChatMessage(timestamp, Color[color], message, id))
+        return game, time_played, thread, connected
+
     async def _subscribe_to_updates(self, player_key: str) -> None:
         """
         Subscribe to the update channels corresponding to `player_key` and
@@ -504,6 +593,15 @@ class DbManager:
             self._update_queue.task_done()
 
     async def _game_status_consumer(self, player_key: str) -> None:
+        game, time_played = await self.get_game(player_key)
+        await self._game_status_callback(player_key, game, time_played)
+
+    async def get_game(self, player_key: str) -> Tuple[Game, float]:
+        """
+        Return the game associated with `player_key` and the time in seconds
+        that it has been played thus far, or raise an Exception on failure
+        """
+
         try:
             game_data: bytes
             time_played: float
@@ -515,7 +613,7 @@ class DbManager:
                     """,
                     player_key,
                 )
-            game: Game = pickle.loads(game_data)
+            game: Game = decode_game(game_data)
 
         except Exception as e:
             raise Exception(
@@ -523,7 +621,7 @@ class DbManager:
             ) from e
 
         else:
-            await self._game_status_callback(player_key, game, time_played)
+            return game, time_played
 
     async def _chat_consumer(self, player_key: str, payload: str) -> None:
         message_id = int(payload) if payload else None
@@ -573,16 +671,26 @@ class DbManager:
 
         await self._opponent_connected_callback(player_key, connected)
 
-    async def write_game(self, player_key: str, game: Game) -> Optional[float]:
+    async def write_game(
+        self,
+        player_key: str,
+        game: Game,
+        notify_opponent: bool = True,
+        base_version: Optional[int] = None,
+    ) -> Optional[float]:
         """
         Attempt to write `game` and increment its version in the database.
         Return the updated time played on success and None on failure, i.e. when
         the write has been preempted from another source, or raise an Exception
-        otherwise
+        otherwise. Unless `notify_opponent` is False, e.g. because the opponent
+        is connected to this game server and has been updated directly, a
+        notification is issued on the opponent's game status channel.
+
+        The write replaces the version before `game`'s, or `base_version` if
+        given, for games which are written several actions at a time
         """
 
         version = game.version()
-        log_text = f"game for player key {player_key} to version {version}"
 
         try:
             conn: asyncpg.Connection
@@ -590,23 +698,75 @@ class DbManager:
                 async with conn.transaction():
                     time_played: Optional[float] = await conn.fetchval(
                         """
-                        SELECT * FROM write_game($1, $2, $3);
+                        SELECT * FROM write_game($1, $2, $3, $4, $5);
                         """,
                         player_key,
-                        pickle.dumps(game),
+                        encode_game(game),
                         version,
+                        notify_opponent,
+                        base_version,
                     )
 
         except Exception as e:
-            raise Exception(f"Failed to update {log_text}") from e
+            raise Exception(
+                f"Failed to update game for player key {player_key} to version"
+                f" {version}"
+            ) from e
 
         else:
-            if time_played is not None:
-                logging.info(f"Successfully updated {log_text}")
-            else:
-                logging.info(f"Preempted attempting to update {log_text}")
+            log_event(
+                "game_written" if time_played is not None else "game_write_preempted",
+                player_key=player_key,
+                version=version,
+            )
             return time_played
 
+    async def migrate_game_data(self, batch_size: int = 100) -> int:
+        """
+        Rewrite all games still stored as pickles, as written by earlier
+        versions of the server, using `igo.codec`. Return the number of games
+        migrated, or raise an Exception on failure.
+
+        Migration is not required for correctness, as pickled games are still
+        read (and are rewritten in the new format the next time they are
+        written), but it is safe to run while serving. A game which is written
+        to while it is being migrated is left alone
+        """
+
+        num_migrated = 0
+        last_batch_size = batch_size
+        try:
+            conn: asyncpg.Connection
+            async with self._connection_pool.acquire() as conn:
+                # games which fail to be migrated because they were written to
+                # concurrently drop out of the next batch, so this terminates
+                while last_batch_size == batch_size:
+                    rows = await conn.fetch(
+                        """
+                        SELECT * FROM get_games_to_migrate($1, $2);
+                        """,
+                        LEGACY_PREFIX,
+                        batch_size,
+                    )
+                    last_batch_size = len(rows)
+                    async with conn.transaction():
+                        for game_id, game_data, version in rows:
+                            num_migrated += await conn.fetchval(
+                                """
+                                SELECT * FROM migrate_game($1, $2, $3);
+                                """,
+                                game_id,
+                                encode_game(decode_game(game_data)),
+                                version,
+                            )
+
+        except Exception as e:
+            raise Exception("Failed to migrate game data") from e
+
+        else:
+            logging.info(f"Migrated {num_migrated} pickled games to the game codec")
+            return num_migrated
+
     async def write_chat(self, player_key: str, message: ChatMessage) -> bool:
         """
         Attempt to write `message` to the database. Return True on success,
@@ -634,9 +794,7 @@ class DbManager:
 
         else:
             if res:
-                logging.info(
-                    f"Successfully wrote chat message from {player_key}: '{message}'"
-                )
+                log_event("chat_written", player_key=player_key, color=message.color)
             else:
                 logging.warning(
                     f"When attempting to write chat message '{message}' from player key"
@@ -682,7 +840,7 @@ class DbManager:
                                 SELECT * FROM unsubscribe($1, $2);
                                 """,
                                 player_key,
-                                self._machine_id,
+                                self._manager_id,
                             )
 
                 # even if the db somehow doesn't reflect that we were managing
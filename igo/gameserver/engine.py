@@ -0,0 +1,224 @@
+"""
+Engine workers, which encode games and write them to the database in child
+processes on behalf of `GameStore`, with `--engine_workers=N`. Encoding games
+and talking to the database are the bulk of the CPU time which the game server
+spends on each action, so moving them into worker processes leaves the game
+server process to route messages and results, and lets one game server use
+more than one core
+
+Games are sharded by key across the workers, each of which holds the encoded
+action log (see `igo.codec.ActionLog`) of the games it last wrote in memory.
+The game server takes each action only once, on its own copy of the game, as
+it validates actions and sends game statuses. For each write it sends only the
+new actions and the game's state as encoded by `igo.codec.encode_state`, which
+doesn't grow with the length of the game, and the worker appends the actions to
+its log and writes the whole. Pickling whole games instead would cost more than
+it saves (see perf.txt). Each worker takes its writes one at a time in the
+order submitted, so that the actions on a game are written in the order they
+were taken
+"""
+
+from __future__ import annotations
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import signal
+from typing import Dict, List, Optional
+import zlib
+import asyncpg
+from igo.codec import ActionLog, decode_game
+from igo.game import Action
+from .log_events import log_event
+from tornado.options import define
+
+define(
+    "engine_workers",
+    default=0,
+    help=(
+        "encode games and write them to the database in the given number of"
+        " worker processes, sharded by game, rather than in the game server"
+        " process"
+    ),
+    type=int,
+)
+
+# the state of an engine worker process, see _init_worker
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_dsn: Optional[str] = None
+_connection: Optional[asyncpg.Connection] = None
+# { game_key: action_log, ... } for each game as last written by the worker
+_logs: Dict[str, ActionLog] = {}
+
+
+def _init_worker(dsn: str) -> None:
+    global _loop, _dsn
+    # the game server writes out its games through us on shutdown, so leave it
+    # to stop us once it has
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, signal.SIG_IGN)
+    _loop = asyncio.new_event_loop()
+    _dsn = dsn
+
+
+def _started() -> None:
+    # a no-op, submitted only to force the executor to fork its process
+    pass
+
+
+async def _connect() -> asyncpg.Connection:
+    global _connection
+    if _connection is None or _connection.is_closed():
+        _connection = await asyncpg.connect(_dsn)
+    return _connection
+
+
+async def _write_game(
+    game_key: str,
+    player_key: str,
+    state: bytes,
+    actions: List[Action],
+    base_version: int,
+    notify_opponent: bool,
+) -> Optional[float]:
+    conn = await _connect()
+    log = _logs.pop(game_key, None)
+    if log is None or log.num_actions != base_version:
+        game = decode_game(
+            await conn.fetchval(
+                """
+                SELECT game_data FROM get_game_status($1);
+                """,
+                game_key,
+            )
+        )
+        if game.version() != base_version:
+            # written by another game server since
+            return None
+        log = ActionLog(game.board.size, game.action_stack)
+
+    log.extend(actions)
+    # a single statement is its own transaction
+    time_played: Optional[float] = await conn.fetchval(
+        """
+        SELECT * FROM write_game($1, $2, $3, $4, $5);
+        """,
+        player_key,
+        log.encode_game(state),
+        log.num_actions,
+        notify_opponent,
+        base_version,
+    )
+    if time_played is not None:
+        _logs[game_key] = log
+    return time_played
+
+
+def _run_write_game(*args) -> Optional[float]:
+    return _loop.run_until_complete(_write_game(*args))
+
+
+def _forget(game_key: str) -> None:
+    _logs.pop(game_key, None)
+
+
+def _close_worker() -> None:
+    if _connection is not None:
+        _loop.run_until_complete(_connection.close())
+
+
+class EnginePool:
+    """
+    A pool of engine worker processes, each of which writes the games in its
+    shard. The workers are forked from the calling process on creation, so the
+    pool must be created before the event loop is started
+
+    Attributes:
+
+        num_workers: int - the number of worker processes
+    """
+
+    __slots__ = ("num_workers", "_executors")
+
+    def __init__(self, dsn: str, num_workers: int) -> None:
+        assert num_workers > 0, "An engine pool needs at least one worker"
+
+        self.num_workers = num_workers
+        context = mp.get_context("fork")
+        # one process per executor, so that each shard is written in order
+        self._executors: List[ProcessPoolExecutor] = [
+            ProcessPoolExecutor(1, context, _init_worker, (dsn,))
+            for _ in range(num_workers)
+        ]
+        # executors start their processes on first use, which would otherwise
+        # fork the running event loop
+        for executor in self._executors:
+            executor.submit(_started).result()
+
+    def shard(self, game_key: str) -> int:
+        """Return the index of the worker which writes the game identified by
+        `game_key`"""
+
+        return zlib.crc32(game_key.encode()) % self.num_workers
+
+    async def write_game(
+        self,
+        game_key: str,
+        player_key: str,
+        state: bytes,
+        actions: List[Action],
+        base_version: int,
+        notify_opponent: bool = True,
+    ) -> Optional[float]:
+        """
+        Write the game identified by `game_key`, i.e. the game as of
+        `base_version` followed by `actions`, whose state once they are taken is
+        `state` as encoded by `igo.codec.encode_state`, in place of that version
+        as `player_key`. Return as `DbManager.write_game`, i.e. None if the game
+        has been written since `base_version`
+        """
+
+        version = base_version + len(actions)
+        try:
+            loop = asyncio.get_running_loop()
+            time_played: Optional[float] = await loop.run_in_executor(
+                self._executors[self.shard(game_key)],
+                _run_write_game,
+                game_key,
+                player_key,
+                state,
+                actions,
+                base_version,
+                notify_opponent,
+            )
+
+        except Exception as e:
+            raise Exception(
+                f"Failed to update game for player key {player_key} to version"
+                f" {version}"
+            ) from e
+
+        else:
+            log_event(
+                "game_written" if time_played is not None else "game_write_preempted",
+                player_key=player_key,
+                version=version,
+            )
+            return time_played
+
+    async def forget(self, game_key: str) -> None:
+        """Drop the action log of the game identified by `game_key` from its
+        worker's memory, once it has no clients connected to this game server"""
+
+        await asyncio.get_running_loop().run_in_executor(
+            self._executors[self.shard(game_key)], _forget, game_key
+        )
+
+    def close(self) -> None:
+        """Stop the workers once they have finished their writes. Call after
+        closing the `GameManager`"""
+
+        # so that the workers finish their writes concurrently
+        for executor in self._executors:
+            executor.submit(_close_worker)
+        for executor in self._executors:
+            executor.shutdown()
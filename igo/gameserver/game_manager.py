@@ -1,10 +1,14 @@
-from enum import Enum, auto
 from igo.aiserver import start_ai_player
+import asyncio
+from collections import defaultdict
 from .constants import (
     ACTION_TYPE,
     AI_SECRET,
     COLOR,
     COORDS,
+    FEATURE_BATCH,
+    FEATURE_COMPACT,
+    FEATURE_DELTA,
     KEY,
     KOMI,
     MESSAGE,
@@ -12,13 +16,21 @@ from .constants import (
     VS,
 )
 import logging
+from .log_events import log_event
 from .chat import ChatMessage, ChatThread
-from igo.game import Action, ActionType, Color, Game
-from typing import Callable, Coroutine, Dict, Optional
+from igo.game import Action, ActionType, Board, Color, Coords, Game, parse_coords
+from igo.codec import encode_state
+from .engine import EnginePool
+from .journal import Journal
+from typing import Callable, Coroutine, DefaultDict, Dict, List, Optional, Tuple
+from tornado.options import define, options
+import tornado.process
 from tornado.websocket import WebSocketHandler
 from .messages import (
     IncomingMessage,
     IncomingMessageType,
+    MessageBatch,
+    OppponentType,
     OutgoingMessage,
     OutgoingMessageType,
 )
@@ -27,17 +39,72 @@ from .db_manager import DbManager, JoinResult
 from .containers import (
     ActionResponseContainer,
     GameStatusContainer,
+    GameStatusDeltaContainer,
     JoinGameResponseContainer,
     KeyContainer,
     ClientData,
+    GameEntry,
     NewGameResponseContainer,
     OpponentConnectedContainer,
 )
 
 
-class OppponentType(Enum):
-    human = auto()
-    computer = auto()
+define(
+    "write_behind",
+    default=False,
+    help=(
+        "acknowledge game actions once they are journaled locally, and write games"
+        " to the database in the background. games are still written before"
+        " acknowledging actions whenever the opponent is connected to another game"
+        " server"
+    ),
+    type=bool,
+)
+define(
+    "write_behind_moves",
+    default=16,
+    help="in write-behind mode, write a game once it has this many unwritten actions",
+    type=int,
+)
+define(
+    "write_behind_interval",
+    default=1.0,
+    help="in write-behind mode, write all games every this many seconds",
+    type=float,
+)
+define(
+    "journal_path",
+    default="./igo.journal",
+    help=(
+        "in write-behind mode, the path of the journal of unwritten actions, less a"
+        " segment number. it must be on local disk, and unique to this game server."
+        " each of several processes (see the processes option) appends its task id"
+    ),
+    type=str,
+)
+define(
+    "journal_fsync",
+    default=True,
+    help=(
+        "in write-behind mode, sync the journal to disk before acknowledging"
+        " actions. otherwise, a crash of the host, though not of the game server,"
+        " may lose actions which have been acknowledged"
+    ),
+    type=bool,
+)
+
+
+# how many times to rebase and retry a game write which conflicts with one from
+# another game server before giving up. see GameStore._write_game
+MAX_WRITE_ATTEMPTS = 5
+
+
+def _on_board(coords: Coords, board: Board) -> bool:
+    """Return whether all of `coords` are on `board`. Incoming messages are only
+    validated against the largest possible board"""
+
+    points = coords if isinstance(coords[0], tuple) else (coords,)
+    return all(board.on_board(p) for p in points)
 
 
 @asyncinit
@@ -46,19 +113,50 @@ class GameStore:
     GameStore is the guts of the in-memory storage and management of games. It
     maps connected clients, identified by their web socket handler, one-to-one
     to all of the data they are concerned with, routes messages, and issues
-    responses on the client socket. Although it is possible and indeed likely
-    that two clients playing the same game will be connected to the same game
-    server, no attempt is made to share data between them above the database
-    level.
+    responses on the client socket. It is possible and indeed likely that two
+    clients playing the same game will be connected to the same game server, in
+    which case they share one `GameEntry`, and each is updated directly when the
+    other takes an action. The database notifies clients of actions only when
+    their opponent is connected to another game server
+
+    In write-behind mode (see the write_behind option), actions are acknowledged
+    once they are appended to a local `Journal` rather than once the game is
+    written to the database. Games are written every write_behind_moves actions,
+    every write_behind_interval seconds, when a client unsubscribes and on
+    shutdown, which bounds how far the database may be behind. Should the game
+    server crash, the journaled actions are written out on restart. A game is
+    still written before acknowledging each action whenever the opponent is
+    connected to another game server, which reads it from the database
+
+    Actions on a game are taken and written in the order received, one at a
+    time, by holding the lock of its entry. Should a write conflict with one
+    from another game server, the actions not yet written are retaken on the
+    game as written by the other server and the write is retried, so that
+    players see a conflict only when their action is no longer valid
+
+    Given an `EnginePool`, games are written by its worker processes rather
+    than by this one
     """
 
-    __slots__ = ("_clients", "_player_keys", "_db_manager")
+    __slots__ = (
+        "_clients",
+        "_player_keys",
+        "_games",
+        "_db_manager",
+        "_journal",
+        "_engine",
+    )
 
     async def __init__(
-        self, store_dsn: str, run_db_setup_scripts: bool = False
+        self,
+        store_dsn: str,
+        run_db_setup_scripts: bool = False,
+        engine: Optional[EnginePool] = None,
     ) -> None:
         self._clients: Dict[WebSocketHandler, ClientData] = {}
         self._player_keys: Dict[str, WebSocketHandler] = {}
+        # { game_key: entry, ... } for every game with a connected client
+        self._games: Dict[str, GameEntry] = {}
         self._db_manager: DbManager = await DbManager(
             self._get_game_updater(),
             self._get_chat_updater(),
@@ -66,6 +164,129 @@ class GameStore:
             store_dsn,
             run_db_setup_scripts,
         )
+        self._engine = engine
+        self._journal: Optional[Journal] = None
+        if options.write_behind:
+            task_id = tornado.process.task_id()
+            self._journal = Journal(
+                options.journal_path
+                if task_id is None
+                else f"{options.journal_path}-{task_id}",
+                options.journal_fsync,
+            )
+            await self._recover()
+            asyncio.create_task(self._write_behind())
+
+    async def _recover(self) -> None:
+        """
+        Write out the actions which were journaled but not written to the
+        database before the last shutdown, i.e. by a crash, and then discard
+        them from the journal. The actions of a game are only replayed if those
+        journaled up to the version in the database agree with it, as otherwise
+        another game server has written a different history since
+        """
+
+        actions: DefaultDict[str, List[Tuple[int, Action]]] = defaultdict(list)
+        for game_key, version, action in self._journal.records():
+            game_actions = actions[game_key]
+            # a record supersedes those of the same or later versions, which
+            # were journaled before the game was rebased (see _journal_rebased)
+            while game_actions and game_actions[-1][0] >= version:
+                game_actions.pop()
+            game_actions.append((version, action))
+
+        for game_key, game_actions in actions.items():
+            game, _ = await self._db_manager.get_game(game_key)
+            base_version = game.version()
+            # those up to base_version were written before the crash
+            if game_actions[0][0] > base_version + 1 or any(
+                game.action_stack[version - 1] != action
+                for version, action in game_actions
+                if version <= base_version
+            ):
+                logging.error(
+                    f"Dropping the journaled actions of game {game_key}, as it has"
+                    " been written by another game server since"
+                )
+                continue
+            try:
+                for version, action in game_actions:
+                    if version <= base_version:
+                        continue
+                    success, explanation = game.take_action(action)
+                    if not success:
+                        logging.error(
+                            f"Failed to replay journaled action {action} on game"
+                            f" {game_key}: {explanation}"
+                        )
+                        break
+            except AssertionError:
+                # its preconditions, e.g. that the game is in play, don't hold
+                logging.exception(
+                    f"Failed to replay journaled action {action} on game {game_key}"
+                )
+            if game.version() == base_version:
+                continue
+            if (
+                await self._db_manager.write_game(
+                    game_key, game, base_version=base_version
+                )
+                is not None
+            ):
+                logging.info(
+                    f"Recovered {game.version() - base_version} journaled actions of"
+                    f" game {game_key}"
+                )
+            else:
+                logging.error(
+                    f"Failed to recover the journaled actions of game {game_key}, as"
+                    " it has been written to since"
+                )
+        self._journal.discard(self._journal.segment)
+
+    async def _write_behind(self) -> None:
+        """Write all games with unwritten actions every write_behind_interval
+        seconds"""
+
+        while True:
+            await asyncio.sleep(options.write_behind_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception(
+                    "Failed to write games behind. The journal retains their actions"
+                )
+
+    async def flush(self) -> None:
+        """
+        In write-behind mode, write all games with unwritten actions to the
+        database and then discard the journal up to now. Otherwise, do nothing
+        """
+
+        if self._journal is None:
+            return
+        segment = await self._journal.rotate()
+        for game_key, entry in list(self._games.items()):
+            async with entry.lock:
+                await self._write_unwritten(game_key, entry)
+            # the game of players who have both left, which failed to be written
+            # when they did
+            if not entry.player_keys and self._games.get(game_key) is entry:
+                await self._forget(game_key)
+        self._journal.discard(segment)
+
+    async def close(self) -> None:
+        """Write out all games with unwritten actions. Call before shutdown"""
+
+        if self._journal is not None:
+            await self.flush()
+            await self._journal.close()
+
+    async def migrate_game_data(self) -> int:
+        """Rewrite all games still stored as pickles using the game codec. See
+        `DbManager.migrate_game_data`"""
+
+        return await self._db_manager.migrate_game_data()
 
     async def new_game(self, msg: IncomingMessage) -> None:
         """
@@ -97,18 +318,22 @@ class GameStore:
             await self.unsubscribe(client, True)
 
         client_keys = keys[requested_color]
+        game_key = keys[Color.white].player_key
+        entry = self._games[game_key] = GameEntry(
+            game, time_played, {client_keys.player_key}
+        )
         self._clients[client] = ClientData(
             client_keys,
             requested_color,
-            game,
-            time_played,
+            entry,
             chat_thread,
             opponent_connected,
+            game_key=game_key,
         )
         self._player_keys[client_keys.player_key] = client
         ai_will_oppose = keys[requested_color.inverse()].ai_secret is not None
 
-        await OutgoingMessage(
+        response = OutgoingMessage(
             OutgoingMessageType.new_game_response,
             NewGameResponseContainer(
                 True,
@@ -136,19 +361,20 @@ class GameStore:
                 requested_color,
             ),
             client,
-        ).send()
-
-        await OutgoingMessage(
-            OutgoingMessageType.game_status,
-            GameStatusContainer(game, time_played),
-            client,
-        ).send()
-        await OutgoingMessage(OutgoingMessageType.chat, chat_thread, client).send()
-        await OutgoingMessage(
-            OutgoingMessageType.opponent_connected,
-            OpponentConnectedContainer(opponent_connected),
+        )
+        await self._send(
             client,
-        ).send()
+            [
+                response,
+                self._game_status_message(client),
+                OutgoingMessage(OutgoingMessageType.chat, chat_thread, client),
+                OutgoingMessage(
+                    OutgoingMessageType.opponent_connected,
+                    OpponentConnectedContainer(opponent_connected),
+                    client,
+                ),
+            ],
+        )
 
         if ai_will_oppose:
             await start_ai_player(keys[requested_color.inverse()])
@@ -163,17 +389,202 @@ class GameStore:
 
         async def callback(player_key: str, game: Game, time_played: float) -> None:
             client = self._updater_callback_preamble(player_key)
-            self._clients[client].game = game
-            self._clients[client].time_played = time_played
-            logging.info(f"Successfully updated game for player key {player_key}")
+            entry = self._clients[client].entry
+            async with entry.lock:
+                await self._update_game(
+                    self._clients[client].game_key, entry, game, time_played, client
+                )
+            log_event("game_updated", player_key=player_key, version=game.version())
+
+            await self._send_game_status(client)
+
+        return callback
+
+    async def _update_game(
+        self,
+        game_key: str,
+        entry: GameEntry,
+        game: Game,
+        time_played: float,
+        client: WebSocketHandler,
+    ) -> None:
+        """
+        Rebase the game in `entry` onto `game` as fetched from the database for
+        `client` (see `_rebase`), unless it is no later than the version last
+        written. A client connected to this game server may have written a later
+        version to the shared entry since it was fetched. Should acknowledged
+        actions which were not yet written have to be dropped, the entry's other
+        clients are sent the game as rebased, while sending it to `client` is
+        left to the caller. Must be called holding the entry's lock
+        """
+
+        if entry.game is not None and game.version() <= entry.written_version:
+            return
+        base_version = entry.written_version
+        rejournal = entry.game is not None and entry.num_unwritten()
+        failed = self._rebase(entry, game, time_played)
+        if rejournal:
+            await self._journal_rebased(game_key, entry, base_version)
+        if not failed:
+            return
+
+        # only possible in write-behind mode, if the opponent connected to
+        # another game server and took an action before we wrote ours
+        logging.error(
+            f"Updating game {game_key} to version {game.version()} dropped"
+            f" acknowledged actions: {failed}"
+        )
+        for player_key in entry.player_keys:
+            other = self._player_keys[player_key]
+            if other is not client:
+                await self._send_game_status(other)
+
+    @staticmethod
+    def _rebase(
+        entry: GameEntry, game: Game, time_played: float
+    ) -> List[Tuple[Action, str]]:
+        """
+        Replace the game in `entry` with `game` as written to the database, and
+        retake on it the actions taken on the entry's game but not yet written.
+        Return those actions which are no longer valid, and why. Must be called
+        holding the entry's lock
+        """
+
+        unwritten = []
+        if entry.game is not None:
+            unwritten = entry.game.action_stack[entry.written_version :]
+        entry.game = game
+        entry.time_played = time_played
+        entry.written_version = game.version()
+        failed = []
+        for action in unwritten:
+            retaken = action
+            if game.action_stack and game.action_stack[-1].timestamp > action.timestamp:
+                # the other game server received its actions later
+                retaken = Action(
+                    action.action_type,
+                    action.color,
+                    game.action_stack[-1].timestamp,
+                    action.coords,
+                )
+            try:
+                success, explanation = game.take_action(retaken)
+            except AssertionError:
+                # its preconditions, e.g. that the game is in play, no longer hold
+                success = False
+                explanation = f"Game action is invalid once {game.status.name}"
+            if not success:
+                failed.append((action, explanation))
+        return failed
+
+    async def _journal_rebased(
+        self, game_key: str, entry: GameEntry, base_version: int
+    ) -> None:
+        """
+        In write-behind mode, journal the actions of the game in `entry` after
+        `base_version`, the version last written before it was rebased (see
+        `_rebase`). These supersede the records of the actions which were
+        unwritten, whose versions no longer match the game's history (see
+        `_recover`). Must be called holding the entry's lock
+        """
+
+        if self._journal is None:
+            return
+        action_stack = entry.game.action_stack
+        for version in range(base_version + 1, len(action_stack) + 1):
+            await self._journal.append(game_key, version, action_stack[version - 1])
+
+    def _local_opponent(self, client_data: ClientData) -> Optional[WebSocketHandler]:
+        """Return the client of the opponent if they are connected to this game
+        server, or None otherwise"""
 
+        for player_key in client_data.entry.player_keys:
+            if player_key != client_data.keys.player_key:
+                return self._player_keys[player_key]
+        return None
+
+    async def _send(
+        self, client: WebSocketHandler, messages: List[OutgoingMessage]
+    ) -> None:
+        """
+        Send `messages` to the client in order, all in one batch message if the
+        client requested the batch feature (see FEATURES)
+        """
+
+        if len(messages) > 1 and FEATURE_BATCH in getattr(client, "features", ()):
             await OutgoingMessage(
+                OutgoingMessageType.batch, MessageBatch(messages), client
+            ).send()
+        else:
+            for msg in messages:
+                await msg.send()
+
+    async def _send_game_status(
+        self, client: WebSocketHandler, cacheable: bool = True
+    ) -> None:
+        """Send the client its game status. See `_game_status_message`"""
+
+        await self._game_status_message(client, cacheable).send()
+
+    def _game_status_message(
+        self, client: WebSocketHandler, cacheable: bool = True
+    ) -> OutgoingMessage:
+        """
+        Return the client's game status message, which the caller must send.
+        Clients which requested the delta feature (see FEATURES) are sent only
+        the changes since the last game status that they were sent, unless they
+        haven't been sent one yet. Clients which requested the compact feature
+        are sent the board in its compact representation
+
+        As long as `cacheable`, i.e. the client's game is known to be as
+        written to the database, the serialized message is cached by game and
+        version (see `OutgoingMessage.cache_key`), such that sending the same
+        status to the other player or again on reconnect costs nothing. A game
+        with unwritten actions, in write-behind mode, is never known to be, as
+        it may yet be rebased onto another history of the same versions
+        """
+
+        client_data = self._clients[client]
+        cacheable = cacheable and not client_data.entry.num_unwritten()
+        game = client_data.game
+        version = game.version()
+        time_played = client_data.time_played
+        cache_key = (
+            (client_data.game_key, version, time_played)
+            if cacheable and client_data.game_key
+            else None
+        )
+        features = getattr(client, "features", ())
+        compact = FEATURE_COMPACT in features
+        if FEATURE_DELTA not in features:
+            return OutgoingMessage(
                 OutgoingMessageType.game_status,
-                GameStatusContainer(game, time_played),
+                GameStatusContainer(game, time_played, compact=compact),
                 client,
-            ).send()
+                cache_key=cache_key and (*cache_key, compact, False),
+            )
 
-        return callback
+        if client_data.sent_version is not None and client_data.sent_version <= version:
+            msg = OutgoingMessage(
+                OutgoingMessageType.game_status_delta,
+                GameStatusDeltaContainer.from_boards(
+                    game, time_played, client_data.sent_version, client_data.sent_board
+                ),
+                client,
+                # the client may have been sent a board since rebased away
+                cache_key=cache_key
+                and (*cache_key, client_data.sent_version, client_data.sent_board),
+            )
+        else:
+            msg = OutgoingMessage(
+                OutgoingMessageType.game_status,
+                GameStatusContainer(game, time_played, version, compact),
+                client,
+                cache_key=cache_key and (*cache_key, compact, True),
+            )
+        client_data.sent_version = version
+        client_data.sent_board = bytes(game.board._data)
+        return msg
 
     def _get_chat_updater(self) -> Callable[[str, ChatThread], Coroutine]:
         """
@@ -185,9 +596,7 @@ class GameStore:
         async def callback(player_key: str, thread: ChatThread) -> None:
             client = self._updater_callback_preamble(player_key)
             self._clients[client].chat_thread.extend(thread)
-            logging.info(
-                f"Successfully updated chat thread for player key {player_key}"
-            )
+            log_event("chat_updated", player_key=player_key, num_messages=len(thread))
 
             await OutgoingMessage(OutgoingMessageType.chat, thread, client).send()
 
@@ -202,10 +611,29 @@ class GameStore:
 
         async def callback(player_key: str, opponent_connected: bool) -> None:
             client = self._updater_callback_preamble(player_key)
-            self._clients[client].opponent_connected = opponent_connected
-            logging.info(
-                "Successfully updated opponent connected status to"
-                f" {opponent_connected} for player key {player_key}"
+            client_data = self._clients[client]
+            client_data.opponent_connected = opponent_connected
+            if (
+                opponent_connected
+                and self._journal is not None
+                and self._local_opponent(client_data) is None
+            ):
+                # the opponent is connected to another game server, which reads
+                # the game from the database
+                try:
+                    async with client_data.entry.lock:
+                        await self._write_unwritten(
+                            client_data.game_key, client_data.entry
+                        )
+                except Exception:
+                    logging.exception(
+                        f"Failed to write game {client_data.game_key} behind. The"
+                        " journal retains its actions"
+                    )
+            log_event(
+                "opponent_connected_updated",
+                player_key=player_key,
+                opponent_connected=opponent_connected,
             )
 
             await OutgoingMessage(
@@ -293,11 +721,19 @@ class GameStore:
                 color = (
                     Color.white if keys[Color.white].player_key == key else Color.black
                 )
-                self._clients[client] = ClientData(keys[color], color)
+                # share the opponent's game, if they are connected here
+                game_key = keys[Color.white].player_key
+                if game_key not in self._games:
+                    self._games[game_key] = GameEntry()
+                entry = self._games[game_key]
+                entry.player_keys.add(key)
+                self._clients[client] = ClientData(
+                    keys[color], color, entry, game_key=game_key
+                )
                 self._player_keys[key] = client
                 ai_will_oppose = keys[color.inverse()].ai_secret is not None
 
-                await OutgoingMessage(
+                response = OutgoingMessage(
                     OutgoingMessageType.join_game_response,
                     JoinGameResponseContainer(
                         True,
@@ -311,9 +747,44 @@ class GameStore:
                         color,
                     ),
                     client,
-                ).send()
+                )
 
-                await self._db_manager.trigger_update_all(key)
+                if FEATURE_BATCH in getattr(client, "features", ()):
+                    # rather than have the database notify us of each of these
+                    # in turn, fetch them all and send them in one batch
+                    client_data = self._clients[client]
+                    (
+                        game,
+                        time_played,
+                        client_data.chat_thread,
+                        client_data.opponent_connected,
+                    ) = await self._db_manager.get_all(key)
+                    async with entry.lock:
+                        await self._update_game(
+                            game_key, entry, game, time_played, client
+                        )
+                    await self._send(
+                        client,
+                        [
+                            response,
+                            self._game_status_message(client),
+                            OutgoingMessage(
+                                OutgoingMessageType.chat,
+                                client_data.chat_thread,
+                                client,
+                            ),
+                            OutgoingMessage(
+                                OutgoingMessageType.opponent_connected,
+                                OpponentConnectedContainer(
+                                    client_data.opponent_connected
+                                ),
+                                client,
+                            ),
+                        ],
+                    )
+                else:
+                    await response.send()
+                    await self._db_manager.trigger_update_all(key)
 
                 if ai_will_oppose:
                     await start_ai_player(keys[color.inverse()])
@@ -337,42 +808,16 @@ class GameStore:
         color = client_data.color
 
         if msg.message_type is IncomingMessageType.game_action:
-            success, explanation = client_data.game.take_action(
-                Action(
-                    ActionType[msg.data[ACTION_TYPE]],
-                    color,
-                    msg.timestamp,
-                    tuple(msg.data[COORDS])
-                    if COORDS in msg.data and msg.data[COORDS]
-                    else None,
-                )
-            )
-            logging.info(
-                f"Took action with result success={success}, explanation={explanation}"
-            )
-
-            if success:
-                time_played: Optional[float] = await self._db_manager.write_game(
-                    client_data.keys.player_key, client_data.game
-                )
-                if time_played is None:
-                    success = False
-                    explanation = "Game action was preempted by other player"
-                else:
-                    client_data.time_played = time_played
-
-            await OutgoingMessage(
-                OutgoingMessageType.game_action_response,
-                ActionResponseContainer(success, explanation),
-                client,
-            ).send()
-
-            if success:
-                await OutgoingMessage(
-                    OutgoingMessageType.game_status,
-                    GameStatusContainer(client_data.game, time_played),
-                    client,
-                ).send()
+            # the game may be shared with the opponent, whose actions must not
+            # be taken while ours is being written, nor before ours is sent
+            async with client_data.entry.lock:
+                await self._take_action(client, msg)
+        elif msg.message_type is IncomingMessageType.resync_game:
+            # the client's game status is stale, so forget what we last sent
+            # it and send it in full. its game may have been rebased since (see
+            # GameStore._rebase), so it isn't cacheable
+            client_data.sent_version = None
+            await self._send_game_status(client, False)
         elif msg.message_type is IncomingMessageType.chat_message:
             message_text = msg.data[MESSAGE]
             await self._db_manager.write_chat(
@@ -382,6 +827,179 @@ class GameStore:
         else:
             raise TypeError(f"Cannot handle messages of type {msg.message_type}")
 
+    async def _take_action(
+        self, client: WebSocketHandler, msg: IncomingMessage
+    ) -> None:
+        """
+        Take the action in `msg` from `client`, write the game out, and send the
+        response and game status to the client, and the game status to its
+        opponent if connected to this game server. Must be called holding the
+        lock of the client's game entry
+        """
+
+        key = msg.data[KEY]
+        client_data = self._clients[client]
+        coords = parse_coords(msg.data.get(COORDS))
+        action = Action(
+            ActionType[msg.data[ACTION_TYPE]], client_data.color, msg.timestamp, coords
+        )
+        if coords is None or _on_board(coords, client_data.game.board):
+            success, explanation = client_data.game.take_action(action)
+        else:
+            success, explanation = False, f"{coords} is off the board"
+        log_event(
+            "action",
+            player_key=key,
+            action_type=msg.data[ACTION_TYPE],
+            success=success,
+            explanation=explanation,
+        )
+
+        opponent = self._local_opponent(client_data)
+        entry = client_data.entry
+        # whether the game isn't as the client last saw it, even after the action
+        replaced = False
+        if success and self._journal is not None and (
+            opponent is not None or client_data.opponent_connected is False
+        ):
+            # no other game server needs to know of the action yet
+            await self._journal.append(
+                client_data.game_key, entry.game.version(), action
+            )
+            if entry.num_unwritten() >= options.write_behind_moves:
+                try:
+                    await self._write_unwritten(client_data.game_key, entry)
+                except Exception:
+                    logging.exception(
+                        f"Failed to write game {client_data.game_key} behind. The"
+                        " journal retains its actions"
+                    )
+        elif success:
+            # an opponent connected here shares the game, so we need only send
+            # them the game status rather than have the database notify us
+            written, failed = await self._write_game(
+                client_data.game_key, entry, key, notify_opponent=opponent is None
+            )
+            for failed_action, failed_explanation in failed:
+                if failed_action is action:
+                    success, explanation = False, failed_explanation
+            if not written:
+                success = False
+                explanation = "Game action was preempted by other player"
+            replaced = bool(failed) or not written
+
+        messages = [
+            OutgoingMessage(
+                OutgoingMessageType.game_action_response,
+                ActionResponseContainer(success, explanation),
+                client,
+            )
+        ]
+        if success or replaced:
+            messages.append(self._game_status_message(client))
+        await self._send(client, messages)
+        if (success or replaced) and opponent is not None:
+            await self._send_game_status(opponent)
+
+    async def _write_game(
+        self, game_key: str, entry: GameEntry, player_key: str, notify_opponent: bool
+    ) -> Tuple[bool, List[Tuple[Action, str]]]:
+        """
+        Write the game in `entry` out as `player_key`, replacing the version
+        last written, along with any other actions not yet written. Should the
+        write conflict with one from another game server, rebase the game onto
+        that one (see `_rebase`) and retry, up to MAX_WRITE_ATTEMPTS times.
+        Return whether the write succeeded, and the actions which had to be
+        dropped when rebasing, and why. If the write didn't succeed, all
+        unwritten actions are dropped. Must be called holding the entry's lock
+        """
+
+        failed = []
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            if not entry.num_unwritten():
+                # all dropped
+                return True, failed
+            if self._engine is None:
+                time_played: Optional[float] = await self._db_manager.write_game(
+                    player_key,
+                    entry.game,
+                    notify_opponent=notify_opponent,
+                    base_version=entry.written_version,
+                )
+            else:
+                time_played = await self._engine.write_game(
+                    game_key,
+                    player_key,
+                    encode_state(entry.game),
+                    entry.game.action_stack[entry.written_version :],
+                    entry.written_version,
+                    notify_opponent,
+                )
+            if time_played is not None:
+                entry.time_played = time_played
+                entry.written_version = entry.game.version()
+                return True, failed
+
+            game, time_played = await self._db_manager.get_game(game_key)
+            log_event(
+                "write_conflict",
+                logging.WARNING,
+                game_key=game_key,
+                attempt=attempt + 1,
+                version=game.version(),
+            )
+            base_version = entry.written_version
+            failed += self._rebase(entry, game, time_played)
+            await self._journal_rebased(game_key, entry, base_version)
+
+        logging.error(
+            f"Failed to write game {game_key} after {MAX_WRITE_ATTEMPTS} attempts,"
+            f" dropping {entry.num_unwritten()} actions"
+        )
+        entry.game, entry.time_played = await self._db_manager.get_game(game_key)
+        entry.written_version = entry.game.version()
+        return False, failed
+
+    async def _forget(self, game_key: str) -> None:
+        """Forget the game identified by `game_key`, once it has no clients
+        connected to this game server"""
+
+        del self._games[game_key]
+        if self._engine is not None:
+            await self._engine.forget(game_key)
+
+    async def _write_unwritten(self, game_key: str, entry: GameEntry) -> None:
+        """
+        In write-behind mode, write the game in `entry` if it has any unwritten
+        actions. Should any acknowledged actions have to be dropped (see
+        `_write_game`), the clients are sent the game as written. Must be
+        called holding the entry's lock
+        """
+
+        num_unwritten = entry.num_unwritten()
+        if not num_unwritten:
+            return
+        # an opponent connected here shares the game, while any other is
+        # notified. any key will do once both players have left
+        player_key = next(iter(entry.player_keys), game_key)
+        written, failed = await self._write_game(
+            game_key, entry, player_key, len(entry.player_keys) < 2
+        )
+        if written and not failed:
+            log_event(
+                "game_written_behind", game_key=game_key, num_actions=num_unwritten
+            )
+            return
+
+        # only possible if the opponent connected to another game server and
+        # took an action before we learned of it
+        logging.error(
+            f"Writing game {game_key} behind conflicted, dropping acknowledged"
+            f" actions: {failed if written else 'all'}"
+        )
+        for player_key in entry.player_keys:
+            await self._send_game_status(self._player_keys[player_key])
+
     async def unsubscribe(
         self, socket: WebSocketHandler, listeners_only: bool = False
     ) -> None:
@@ -395,9 +1013,30 @@ class GameStore:
             subscription = self._clients[socket]
             keys = subscription.keys
             player_key = keys.player_key
+            entry = subscription.entry
+            game_key = subscription.game_key
+            if self._journal is not None:
+                try:
+                    async with entry.lock:
+                        await self._write_unwritten(game_key, entry)
+                except Exception:
+                    # it is written by the next flush instead
+                    logging.exception(
+                        f"Failed to write game {game_key} behind on unsubscribe. The"
+                        " journal retains its actions"
+                    )
             await self._db_manager.unsubscribe(player_key, listeners_only)
             del self._clients[socket]
             del self._player_keys[player_key]
+            # forget the game once neither player is connected here, and it has
+            # been written
+            entry.player_keys.discard(player_key)
+            if (
+                not entry.player_keys
+                and self._games.get(game_key) is entry
+                and not entry.num_unwritten()
+            ):
+                await self._forget(game_key)
             logging.info(f"Unsubscribed client from key {player_key}")
             if keys.ai_secret is not None:
                 await start_ai_player(keys, previous_subscription=subscription)
@@ -419,15 +1058,34 @@ class GameManager:
     __slots__ = "store"
 
     async def __init__(
-        self, store_dsn: str, run_db_setup_scripts: bool = False
+        self,
+        store_dsn: str,
+        run_db_setup_scripts: bool = False,
+        engine: Optional[EnginePool] = None,
     ) -> None:
         """
         Arguments:
 
             store_dsn: str - the data source name url of the store database
+
+            engine: Optional[EnginePool] - the engine workers to write games,
+            if any
         """
 
-        self.store: GameStore = await GameStore(store_dsn, run_db_setup_scripts)
+        self.store: GameStore = await GameStore(
+            store_dsn, run_db_setup_scripts, engine
+        )
+
+    async def close(self) -> None:
+        """Write out any unwritten games. Call before shutdown"""
+
+        await self.store.close()
+
+    async def migrate_game_data(self) -> int:
+        """Rewrite all games still stored as pickles using the game codec.
+        Return the number of games migrated"""
+
+        return await self.store.migrate_game_data()
 
     async def unsubscribe(self, socket: WebSocketHandler) -> None:
         """Unsubscribe the socket from its key if it is subscribed, otherwise
@@ -445,6 +1103,7 @@ class GameManager:
         elif msg.message_type in (
             IncomingMessageType.game_action,
             IncomingMessageType.chat_message,
+            IncomingMessageType.resync_game,
         ):
             await self.store.route_message(msg)
         else:
@@ -0,0 +1,170 @@
+"""
+The local journal of game actions which have been acknowledged to clients but
+not yet written to the database, as used by the write-behind mode of
+`GameStore`. Actions are appended one JSON line each, and are durable once
+`Journal.append` returns. Concurrent appends share one fsync, so that the
+journal costs far less than a database write per action
+
+The journal is made up of numbered segment files, `<path>.<number>`. Once every
+game is written to the database, the journal is rotated to a new segment and
+the older ones are discarded. On start up, the actions in any segments left
+behind by a crash are replayed onto the games as last written, see
+`GameStore`
+"""
+
+from __future__ import annotations
+import asyncio
+import glob
+import json
+import logging
+import os
+from typing import IO, Iterator, List, Optional, Tuple
+from igo.game import Action, ActionType, Color, parse_coords
+
+
+class Journal:
+    """
+    An append-only journal of game actions, by game key (see `ClientData`)
+    and the game version which each action results in
+
+    Attributes:
+
+        path: str - the path of the journal, less the segment number
+
+        fsync: bool - whether appends wait for the journal to be synced to
+        disk, rather than just written to the OS
+
+        segment: int - the number of the segment being appended to
+    """
+
+    __slots__ = ("path", "fsync", "segment", "_file", "_waiters", "_sync_task")
+
+    def __init__(self, path: str, fsync: bool = True) -> None:
+        self.path = path
+        self.fsync = fsync
+        existing = self._segments()
+        self.segment = existing[-1] + 1 if existing else 0
+        self._file: IO[str] = self._open()
+        # appends waiting on the next sync, which all share it
+        self._waiters: List[asyncio.Future] = []
+        self._sync_task: Optional[asyncio.Task] = None
+
+    def _segments(self) -> List[int]:
+        """Return the numbers of all segments on disk, in order"""
+
+        res = []
+        for fn in glob.glob(glob.escape(self.path) + ".*"):
+            suffix = fn[len(self.path) + 1 :]
+            if suffix.isdigit():
+                res.append(int(suffix))
+        return sorted(res)
+
+    def _open(self) -> IO[str]:
+        return open(f"{self.path}.{self.segment}", "a", encoding="ascii")
+
+    def records(self) -> Iterator[Tuple[str, int, Action]]:
+        """
+        Yield the game key, version and action of each record in the segments
+        before the current one, in the order appended. A record torn by a
+        crash while it was being appended is skipped
+        """
+
+        for segment in self._segments():
+            if segment >= self.segment:
+                break
+            with open(f"{self.path}.{segment}", "r", encoding="ascii") as r:
+                for line in r:
+                    try:
+                        key, version, action_type, color, timestamp, coords = (
+                            json.loads(line)
+                        )
+                    except ValueError:
+                        logging.warning(
+                            f"Skipping torn record in journal segment {segment}"
+                        )
+                        continue
+                    yield key, version, Action(
+                        ActionType[action_type],
+                        Color[color],
+                        timestamp,
+                        parse_coords(coords),
+                    )
+
+    async def append(self, game_key: str, version: int, action: Action) -> None:
+        """Append `action`, which brought the game identified by `game_key` to
+        `version`, and return once it is durable"""
+
+        self._file.write(
+            json.dumps(
+                [
+                    game_key,
+                    version,
+                    action.action_type.name,
+                    action.color.name,
+                    action.timestamp,
+                    action.coords,
+                ],
+                separators=(",", ":"),
+            )
+            + "\n"
+        )
+        if not self.fsync:
+            # enough to survive a crash of the game server, if not of the host
+            self._file.flush()
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(self._sync())
+        await waiter
+
+    async def _sync(self) -> None:
+        """Sync the journal until no appends are waiting. Those appended while
+        a sync is in progress wait for, and share, the next one"""
+
+        loop = asyncio.get_running_loop()
+        while self._waiters:
+            waiters, self._waiters = self._waiters, []
+            try:
+                self._file.flush()
+                await loop.run_in_executor(None, os.fsync, self._file.fileno())
+            except Exception as e:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+            else:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+
+    async def rotate(self) -> int:
+        """
+        Start appending to a new segment, and return its number. Once all
+        actions appended so far are written to the database, the older segments
+        may be discarded with `discard`
+        """
+
+        await self._synced()
+        self._file.close()
+        self.segment += 1
+        self._file = self._open()
+        return self.segment
+
+    def discard(self, before: int) -> None:
+        """Delete the segments numbered below `before`"""
+
+        for segment in self._segments():
+            if segment >= before:
+                break
+            os.remove(f"{self.path}.{segment}")
+
+    async def _synced(self) -> None:
+        """Wait until no sync is in progress"""
+
+        # appends made while waiting may start another
+        while self._sync_task is not None and not self._sync_task.done():
+            await self._sync_task
+
+    async def close(self) -> None:
+        await self._synced()
+        self._file.close()
@@ -4,13 +4,19 @@ from .containers import (
     ActionResponseContainer,
     ErrorContainer,
     GameStatusContainer,
+    GameStatusDeltaContainer,
     JoinGameResponseContainer,
     NewGameResponseContainer,
     OpponentConnectedContainer,
 )
 from .constants import (
     ACTION_TYPE,
+    AI_SECRET,
     COLOR,
+    COORDS,
+    KEY_LEN,
+    MAX_BOARD_SIZE,
+    MAX_CHAT_MESSAGE_LEN,
     MESSAGE,
     SIZE,
     VS,
@@ -18,12 +24,26 @@ from .constants import (
     KEY,
     TYPE,
 )
+from . import serializers, wire
+from .log_events import log_event
+from collections import OrderedDict
 from datetime import datetime
 from enum import Enum, auto
 import json
-from typing import Dict, List, Optional, Union
+import math
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 import logging
 from tornado.websocket import WebSocketHandler, WebSocketClosedError
+from igo.game import ActionType, Color
 from igo.serialization import JsonifyableBase, JsonifyableBaseDataClass
 
 
@@ -32,6 +52,7 @@ class IncomingMessageType(Enum):
     join_game = auto()
     game_action = auto()
     chat_message = auto()
+    resync_game = auto()
 
 
 """Dictionary of keys required to be in the data attribute of an IncomingMessage
@@ -41,6 +62,97 @@ INCOMING_REQUIRED_KEYS: Dict[IncomingMessageType, List[str]] = {
     IncomingMessageType.join_game: [KEY],
     IncomingMessageType.game_action: [KEY, ACTION_TYPE],
     IncomingMessageType.chat_message: [KEY, MESSAGE],
+    IncomingMessageType.resync_game: [KEY],
+}
+
+
+class OppponentType(Enum):
+    human = auto()
+    computer = auto()
+
+
+def _is_key(value: Any) -> bool:
+    return value.__class__ is str and len(value) == KEY_LEN
+
+
+def _is_member(enum: type) -> Callable[[Any], bool]:
+    names = frozenset(enum.__members__)
+    return lambda value: value.__class__ is str and value in names
+
+
+def _is_size(value: Any) -> bool:
+    return value.__class__ is int and 1 <= value <= MAX_BOARD_SIZE
+
+
+def _is_komi(value: Any) -> bool:
+    return value.__class__ in (int, float) and math.isfinite(value)
+
+
+def _is_point(value: Any) -> bool:
+    return (
+        value.__class__ is list
+        and len(value) == 2
+        and value[0].__class__ is int
+        and value[1].__class__ is int
+        and 0 <= value[0] < MAX_BOARD_SIZE
+        and 0 <= value[1] < MAX_BOARD_SIZE
+    )
+
+
+def _is_coords(value: Any) -> bool:
+    # a single point, a list of them (only for marking dead, see
+    # IncomingMessage), or nothing
+    if not value:
+        return value is None or value == []
+    if value.__class__ is not list:
+        return False
+    if value[0].__class__ is int:
+        return _is_point(value)
+    return len(value) <= MAX_BOARD_SIZE * MAX_BOARD_SIZE and all(
+        _is_point(v) for v in value
+    )
+
+
+def _is_chat_message(value: Any) -> bool:
+    return value.__class__ is str and len(value) <= MAX_CHAT_MESSAGE_LEN
+
+
+"""Dictionary of keys which may be in the data attribute of an IncomingMessage
+with the specified message_type, but aren't required. Any other keys are
+ignored"""
+INCOMING_OPTIONAL_KEYS: Dict[IncomingMessageType, List[str]] = {
+    IncomingMessageType.join_game: [AI_SECRET],
+    IncomingMessageType.game_action: [COORDS],
+}
+
+"""Dictionary of validators of the values in the data attribute of an
+IncomingMessage, by key. Coordinates are only checked to be on the largest
+possible board here, as the size of the board isn't known"""
+INCOMING_VALIDATORS: Dict[str, Callable[[Any], bool]] = {
+    KEY: _is_key,
+    AI_SECRET: _is_key,
+    VS: _is_member(OppponentType),
+    COLOR: _is_member(Color),
+    SIZE: _is_size,
+    KOMI: _is_komi,
+    ACTION_TYPE: _is_member(ActionType),
+    COORDS: _is_coords,
+    MESSAGE: _is_chat_message,
+}
+
+# the keys of each type of message and their validators, with whether or not
+# they are required, so that validating a message is a single pass over them
+_INCOMING_SCHEMAS: Dict[
+    IncomingMessageType, Tuple[Tuple[str, Callable[[Any], bool], bool], ...]
+] = {
+    t: (
+        *((k, INCOMING_VALIDATORS[k], True) for k in INCOMING_REQUIRED_KEYS[t]),
+        *(
+            (k, INCOMING_VALIDATORS[k], False)
+            for k in INCOMING_OPTIONAL_KEYS.get(t, [])
+        ),
+    )
+    for t in IncomingMessageType
 }
 
 
@@ -52,6 +164,23 @@ class OutgoingMessageType(Enum):
     chat = auto()
     opponent_connected = auto()
     error = auto()
+    game_status_delta = auto()
+    batch = auto()
+
+
+# the number of serialized outgoing messages kept in the serialization cache.
+# see OutgoingMessage.cache_key
+SERIALIZATION_CACHE_SIZE = 256
+_serialization_cache: OrderedDict[
+    Tuple[OutgoingMessageType, Hashable, bool], Union[str, bytes]
+] = OrderedDict()
+
+
+# the start of each type of outgoing message as JSON, up to its data. see
+# OutgoingMessage.to_json
+_JSON_PREFIXES: Dict[OutgoingMessageType, str] = {
+    t: f'{{"messageType": "{t.name}", "data": ' for t in OutgoingMessageType
+}
 
 
 class Message:
@@ -90,18 +219,48 @@ class IncomingMessage(Message):
         message_type: IncomingMessageType - the type of the message
 
         data: Dict[str, object] - a dictionary of the message data
+
+    Messages are received as JSON text or, from clients using the binary
+    subprotocol, as bytes (see `wire`). Raise ValueError if the message is
+    malformed or doesn't match the schema of its type (see
+    INCOMING_VALIDATORS), in which case the error doesn't include the message
+    itself, which may be large
     """
 
     __slots__ = ("message_type", "data")
 
-    def __init__(self, json_str: str, *args, **kwargs) -> None:
-        self.data: Dict[str, object] = json.loads(json_str)
-        self.message_type: IncomingMessageType = IncomingMessageType[self.data[TYPE]]
-        del self.data[TYPE]
-        for rk in INCOMING_REQUIRED_KEYS[self.message_type]:
-            assert (
-                rk in self.data
-            ), f"Required key {rk} not found in incoming message {self.data}"
+    def __init__(self, raw: Union[str, bytes], *args, **kwargs) -> None:
+        try:
+            data = wire.decode(raw) if isinstance(raw, bytes) else json.loads(raw)
+        except (ValueError, RecursionError) as e:
+            raise ValueError(f"Malformed incoming message: {e}")
+        if data.__class__ is not dict:
+            raise ValueError("Incoming messages must be objects")
+        message_type = data.pop(TYPE, None)
+        if message_type.__class__ is not str:
+            raise ValueError("Incoming message type must be a string")
+        if message_type not in IncomingMessageType.__members__:
+            raise ValueError(f"Unknown incoming message type {message_type[:32]!r}")
+        self.message_type: IncomingMessageType = IncomingMessageType[message_type]
+        for key, validator, required in _INCOMING_SCHEMAS[self.message_type]:
+            if key in data:
+                if not validator(data[key]):
+                    raise ValueError(
+                        f"Invalid value for {key} in {message_type} message"
+                    )
+            elif required:
+                raise ValueError(
+                    f"Required key {key} not found in {message_type} message"
+                )
+        if (
+            self.message_type is IncomingMessageType.game_action
+            and data.get(COORDS)
+            and data[COORDS][0].__class__ is list
+            and data[ACTION_TYPE] != ActionType.mark_dead.name
+        ):
+            # only marking dead takes more than one point
+            raise ValueError(f"Invalid value for {COORDS} in {message_type} message")
+        self.data: Dict[str, object] = data
 
         super().__init__(*args, **kwargs)
 
@@ -135,6 +294,15 @@ class OutgoingMessage(JsonifyableBaseDataClass):
         websocket_handler: Optional[WebSocketHandler] - the vehicle by which to
         send the message
 
+        cache_key: Optional[Hashable] - if given, an identifier for the data
+        such that any message of the same type and cache key has the same data,
+        e.g. the game and version of a game status. The serialized message is
+        then cached, so that sending it again, to this or any other client,
+        doesn't serialize it again. This takes the place of writing one message
+        to many clients at once, as no message is sent to more than one client
+        as is: game statuses differ by client features and delta base, and chat
+        and other updates arrive for each player separately
+
     Serialization note: the `websocket_handler` attribute is not included during
     serialization and is thus not available for deserialization
     """
@@ -142,6 +310,7 @@ class OutgoingMessage(JsonifyableBaseDataClass):
     message_type: OutgoingMessageType
     data: Union[JsonifyableBase, JsonifyableBaseDataClass]
     websocket_handler: Optional[WebSocketHandler] = None
+    cache_key: Optional[Hashable] = None
 
     def jsonifyable(self) -> Dict:
         return {"messageType": self.message_type.name, "data": self.data.jsonifyable()}
@@ -164,27 +333,66 @@ class OutgoingMessage(JsonifyableBaseDataClass):
             deserialized_data = OpponentConnectedContainer.deserialize(raw_data)
         elif msg_type is OutgoingMessageType.error:
             deserialized_data = ErrorContainer.deserialize(raw_data)
+        elif msg_type is OutgoingMessageType.game_status_delta:
+            deserialized_data = GameStatusDeltaContainer.deserialize(raw_data)
+        elif msg_type is OutgoingMessageType.batch:
+            deserialized_data = MessageBatch.deserialize(raw_data)
         else:
             raise TypeError(
                 f"Unrecognized outgoing message type {msg_type} encountered"
             )
         return OutgoingMessage(msg_type, deserialized_data)
 
+    def serialize(self, binary: bool = False) -> Union[str, bytes]:
+        """
+        Return `self.jsonifyable()` as JSON or, if `binary`, in binary (see
+        `wire`), from the serialization cache if the message has a cache key
+        """
+
+        if self.message_type is OutgoingMessageType.batch:
+            return self.data.serialize(binary)
+        if self.cache_key is None:
+            return wire.encode(self.jsonifyable()) if binary else self.to_json()
+
+        key = (self.message_type, self.cache_key, binary)
+        res = _serialization_cache.get(key)
+        if res is None:
+            res = wire.encode(self.jsonifyable()) if binary else self.to_json()
+            _serialization_cache[key] = res
+            if len(_serialization_cache) > SERIALIZATION_CACHE_SIZE:
+                _serialization_cache.popitem(last=False)
+        else:
+            _serialization_cache.move_to_end(key)
+        return res
+
+    def to_json(self) -> str:
+        """
+        Return `json.dumps(self.jsonifyable())`, but written directly where
+        there is a fast path serializer for the data (see `serializers`)
+        """
+
+        return _JSON_PREFIXES[self.message_type] + serializers.dumps(self.data) + "}"
+
     async def send(self) -> bool:
         """
-        Write `self.jsonifyable()` to `self.websocket_handler`. Return True on
-        success and False otherwise
+        Write the message to `self.websocket_handler`, as JSON or, if the
+        handler is using the binary subprotocol, in binary (see `wire`). Return
+        True on success and False otherwise
         """
 
         assert (
             self.websocket_handler is not None
         ), "Cannot send outgoing messages without specifying a WebSocket"
 
-        msg = json.dumps(self.jsonifyable())
+        msg = self.serialize(getattr(self.websocket_handler, "binary", False))
         try:
-            await self.websocket_handler.write_message(msg)
-            logging.info(
-                f"Sent a message of type {self.message_type}"
+            if isinstance(msg, bytes):
+                await self.websocket_handler.write_message(msg, binary=True)
+            else:
+                await self.websocket_handler.write_message(msg)
+            log_event(
+                "sent",
+                message_type=self.message_type,
                 # this is kind of a fudge. it's actually IgoWebSocket that has
                 # an id property, not WebSocketHandler, but importing
                 # connection_manager would create a circular dependency. I
@@ -194,9 +402,10 @@ class OutgoingMessage(JsonifyableBaseDataClass):
                 # circular dep if I stick this file's contents in
                 # connection_manager, etc...), and it's so easy to just be lazy
                 # instead
-                f" to {self.websocket_handler.id}"
+                client=self.websocket_handler.id,
+                size=len(msg),
             )
-            logging.debug(f"Message data: {msg}")
+            logging.debug("Message data: %s", msg)
             return True
         except WebSocketClosedError as e:
             # this is known to happen after a period of database inavailability and
@@ -206,3 +415,48 @@ class OutgoingMessage(JsonifyableBaseDataClass):
                 f" {e.__class__.__name__}"
             )
             return False
+
+
+class MessageBatch(JsonifyableBaseDataClass):
+    """
+    A container for several outgoing messages which are sent together as one
+    batch message, and so in one websocket frame. See `FEATURE_BATCH`
+
+    Attributes:
+
+        messages: List[OutgoingMessage] - the messages, in the order in which
+        they would otherwise have been sent
+    """
+
+    messages: List[OutgoingMessage]
+
+    def jsonifyable(self) -> List[Dict]:
+        return [msg.jsonifyable() for msg in self.messages]
+
+    @classmethod
+    def _deserialize(cls, data: List[Dict]) -> MessageBatch:
+        return MessageBatch([OutgoingMessage.deserialize(msg) for msg in data])
+
+    def serialize(self, binary: bool = False) -> Union[str, bytes]:
+        """
+        Return the batch message as `OutgoingMessage.serialize` would, but
+        built from the serializations of the messages, so that those which are
+        cached are not serialized again
+        """
+
+        if binary:
+            return wire.encode(
+                {
+                    "messageType": OutgoingMessageType.batch.name,
+                    "data": [
+                        wire.Encoded(msg.serialize(True)) for msg in self.messages
+                    ],
+                }
+            )
+        # the same separators as json.dumps
+        return (
+            _JSON_PREFIXES[OutgoingMessageType.batch]
+            + "["
+            + ", ".join(msg.serialize() for msg in self.messages)
+            + "]}"
+        )
@@ -3,13 +3,14 @@ Replays the sample game concurrently from multiple processes to measure the
 server's ability to scale
 """
 
+from collections import defaultdict, deque
 from datetime import datetime, timedelta
 from .containers import (
     ActionResponseContainer,
     JoinGameResponseContainer,
     NewGameResponseContainer,
 )
-from typing import Dict, List
+from typing import DefaultDict, Deque, Dict, List, Union
 from .messages import (
     IncomingMessageType,
     OutgoingMessage,
@@ -20,9 +21,12 @@ from igo.game import Action, Game, Color
 from tornado.websocket import WebSocketClientConnection, websocket_connect
 from tornado.options import define, options
 import json
+from . import wire
 from .constants import (
     ACTION_TYPE,
+    BINARY_SUBPROTOCOL,
     COORDS,
+    FEATURES,
     KEY,
     TYPE,
     VS,
@@ -63,10 +67,30 @@ define(
     help="the path to a custom sample game to play repeatedly",
     type=str,
 )
+define(
+    "binary",
+    default=False,
+    help="speak the binary websocket subprotocol rather than JSON",
+    type=bool,
+)
+define(
+    "compression",
+    default=False,
+    help="offer permessage-deflate compression to the server",
+    type=bool,
+)
+define(
+    "features",
+    default="",
+    help="request the given comma-separated wire protocol features, e.g. 'compact'",
+    type=str,
+)
 
 options.parse_command_line()
 
-SERVER_URL_TEMPLATE = f"ws://{options.host}:%s/websocket"
+SERVER_URL_TEMPLATE = f"ws://{options.host}:%s/websocket" + (
+    f"?{FEATURES}={options.features}" if options.features else ""
+)
 PORTS: List[int] = [int(p) for p in options.port.split(",")]
 NUM_PROCESSES: int = options.num_processes
 WORKERS_PER_PROCESS: int = options.workers_per_process
@@ -75,6 +99,40 @@ with open(options.sample_game_path, "rb") as reader:
     sample_game: Game = pickle.load(reader)
 
 
+async def connect(server_url: str) -> WebSocketClientConnection:
+    return await websocket_connect(
+        server_url,
+        compression_options={} if options.compression else None,
+        subprotocols=[BINARY_SUBPROTOCOL] if options.binary else None,
+    )
+
+
+async def write(player: WebSocketClientConnection, message: Dict) -> None:
+    if options.binary:
+        await player.write_message(wire.encode(message), binary=True)
+    else:
+        await player.write_message(json.dumps(message))
+
+
+# messages received in a batch which have yet to be read, by connection
+unread: DefaultDict[WebSocketClientConnection, Deque[OutgoingMessage]] = defaultdict(
+    deque
+)
+
+
+async def read(player: WebSocketClientConnection) -> OutgoingMessage:
+    if unread[player]:
+        return unread[player].popleft()
+    msg: Union[str, bytes] = await player.read_message()
+    res = OutgoingMessage.deserialize(
+        wire.decode(msg) if isinstance(msg, bytes) else msg
+    )
+    if res.message_type is OutgoingMessageType.batch:
+        unread[player].extend(res.data.messages)
+        return unread[player].popleft()
+    return res
+
+
 def many_processes() -> List[List[timedelta]]:
     with mp.Pool(NUM_PROCESSES) as pool:
         return pool.map(
@@ -114,29 +172,28 @@ async def play_once(id: int) -> timedelta:
     # our first task is to open two connections, create a new game with one, and
     # join that game with the other
 
-    black: WebSocketClientConnection = await websocket_connect(server_url)
-    await black.write_message(
-        json.dumps(
-            {
-                TYPE: IncomingMessageType.new_game.name,
-                VS: "human",
-                COLOR: Color.black.name,
-                SIZE: sample_game.board.size,
-                KOMI: sample_game.komi,
-            }
-        )
+    black: WebSocketClientConnection = await connect(server_url)
+    await write(
+        black,
+        {
+            TYPE: IncomingMessageType.new_game.name,
+            VS: "human",
+            COLOR: Color.black.name,
+            SIZE: sample_game.board.size,
+            KOMI: sample_game.komi,
+        },
     )
-    response: OutgoingMessage = OutgoingMessage.deserialize(await black.read_message())
+    response: OutgoingMessage = await read(black)
     assert response.message_type is OutgoingMessageType.new_game_response
     data: NewGameResponseContainer = response.data
     assert data.success
-    keys: Dict[Color, str] = data.keys
+    keys: Dict[Color, str] = {c: data.keys[c].player_key for c in Color}
 
-    white: WebSocketClientConnection = await websocket_connect(server_url)
-    await white.write_message(
-        json.dumps({TYPE: IncomingMessageType.join_game.name, KEY: keys[Color.white]})
+    white: WebSocketClientConnection = await connect(server_url)
+    await write(
+        white, {TYPE: IncomingMessageType.join_game.name, KEY: keys[Color.white]}
     )
-    response = OutgoingMessage.deserialize(await white.read_message())
+    response = await read(white)
     assert response.message_type is OutgoingMessageType.join_game_response
     data: JoinGameResponseContainer = response.data
     assert data.success
@@ -146,9 +203,9 @@ async def play_once(id: int) -> timedelta:
     # to have three (join game status messages)
 
     for _ in range(4):
-        await black.read_message()
+        await read(black)
     for _ in range(3):
-        await white.read_message()
+        await read(white)
 
     # now that the game is set up, start a consumer task for each player and
     # wait for both to finish
@@ -166,6 +223,7 @@ async def play_once(id: int) -> timedelta:
 
     black.close()
     white.close()
+    del unread[black], unread[white]
 
     return datetime.now() - start_time
 
@@ -186,28 +244,32 @@ async def play_consumer(
     for i in range(len(sample_game.action_stack)):
         action: Action = sample_game.action_stack[i]
         if action.color is player_color:
-            await player.write_message(
-                json.dumps(
-                    {
-                        TYPE: IncomingMessageType.game_action.name,
-                        KEY: key,
-                        ACTION_TYPE: action.action_type.name,
-                        COORDS: action.coords,
-                    }
-                )
+            await write(
+                player,
+                {
+                    TYPE: IncomingMessageType.game_action.name,
+                    KEY: key,
+                    ACTION_TYPE: action.action_type.name,
+                    COORDS: action.coords,
+                },
             )
-            response = OutgoingMessage.deserialize(await player.read_message())
+            response = await read(player)
             assert response.message_type is OutgoingMessageType.game_action_response
             data: ActionResponseContainer = response.data
             assert data.success
 
-        response = OutgoingMessage.deserialize(await player.read_message())
-        assert response.message_type is OutgoingMessageType.game_status
+        response = await read(player)
+        assert response.message_type in (
+            OutgoingMessageType.game_status,
+            OutgoingMessageType.game_status_delta,
+        )
 
 
 print(
     f"Starting run against {options.host}:{options.port} in {options.num_processes}"
-    f" process(es) with {options.workers_per_process} worker(s) per process."
+    f" process(es) with {options.workers_per_process} worker(s) per process"
+    f" using {BINARY_SUBPROTOCOL if options.binary else 'JSON'}"
+    f"{' with compression' if options.compression else ''}."
 )
 print("This may take some time... ", end="")
 
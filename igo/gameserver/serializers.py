@@ -0,0 +1,293 @@
+"""
+Fast path JSON serialization of outgoing message data. `json.dumps` is quick
+once it has a structure to encode, but building that structure with
+`jsonifyable` is not, e.g. a full board is a list of lists of lists of 361
+points, each of which is thrown away as soon as it is encoded. Instead, the
+serializers here write each container straight to a string, with the enum
+names and the JSON of each possible board point computed up front
+
+NOTE: the output must be byte for byte the same as
+`json.dumps(data.jsonifyable())`, as clients (and the serialization cache)
+can't tell which was used. Whenever a `jsonifyable` method changes, change its
+serializer too. Anything which isn't registered in `_SERIALIZERS`, including
+subclasses of the registered types, falls back to `json.dumps`
+"""
+
+from __future__ import annotations
+from .chat import ChatMessage, ChatThread
+from .containers import (
+    ActionResponseContainer,
+    ErrorContainer,
+    GameStatusContainer,
+    GameStatusDeltaContainer,
+    JoinGameResponseContainer,
+    KeyContainer,
+    NewGameResponseContainer,
+    OpponentConnectedContainer,
+)
+from itertools import product
+import json
+from json.encoder import encode_basestring_ascii
+from typing import Any, Callable, Dict, List, Tuple, Union
+from igo.game import Board, Color, Game, Point, _COMPACT_COLORS, _SHORT_COLORS
+from igo.serialization import JsonifyableBase, JsonifyableBaseDataClass
+
+_INFINITY = float("inf")
+
+
+def _float(value: float) -> str:
+    # as json.dumps does, which doesn't produce valid JSON for these
+    if value != value:
+        return "NaN"
+    if value == _INFINITY:
+        return "Infinity"
+    if value == -_INFINITY:
+        return "-Infinity"
+    return float.__repr__(value)
+
+
+def _list(value: Union[List, Tuple]) -> str:
+    return "[" + ", ".join([_value(v) for v in value]) + "]"
+
+
+def _dict(value: Dict) -> str:
+    parts = []
+    for k, v in value.items():
+        if k.__class__ is not str:
+            # json.dumps coerces keys, which we don't bother with
+            return json.dumps(value)
+        parts.append(encode_basestring_ascii(k) + ": " + _value(v))
+    return "{" + ", ".join(parts) + "}"
+
+
+_WRITERS: Dict[type, Callable[[Any], str]] = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    float: _float,
+    bool: lambda value: "true" if value else "false",
+    type(None): lambda value: "null",
+    list: _list,
+    tuple: _list,
+    dict: _dict,
+}
+
+
+def _value(value: Any) -> str:
+    """Return `json.dumps(value)` for any JSON-able `value`"""
+
+    writer = _WRITERS.get(value.__class__)
+    return json.dumps(value) if writer is None else writer(value)
+
+
+# quoted enum member names, and null for None
+_COLOR_NAMES: Dict[Any, str] = {None: "null", **{c: f'"{c.name}"' for c in Color}}
+
+# the JSON of each board point, by its color, marked dead, counted and counts
+# for values in `Board._data`. see `Board.jsonifyable`
+_POINTS: Dict[Tuple[int, int, int, int], str] = {
+    (c, m, k, f): (
+        f"[{encode_basestring_ascii(_SHORT_COLORS[c])}"
+        f", {'true' if m else 'false'}"
+        f", {'true' if k else 'false'}"
+        f", {encode_basestring_ascii(_SHORT_COLORS[f])}]"
+    )
+    for c, m, k, f in product(
+        range(len(_SHORT_COLORS)), (0, 1), (0, 1), range(len(_SHORT_COLORS))
+    )
+}
+
+
+# the value in `Board._data` of each color
+_COLOR_VALUES: Dict[Any, int] = {
+    None: 0,
+    **{c: _SHORT_COLORS.index(c.to_short()) for c in Color},
+}
+
+
+def _point(point: Point) -> str:
+    if (
+        point.__class__ is Point
+        and point.marked_dead.__class__ is bool
+        and point.counted.__class__ is bool
+    ):
+        return _POINTS[
+            _COLOR_VALUES[point.color],
+            point.marked_dead,
+            point.counted,
+            _COLOR_VALUES[point.counts_for],
+        ]
+    return json.dumps(point.jsonifyable())
+
+
+def _indices(plane: bytes) -> str:
+    # planes other than the colors are usually empty, which is quick to check
+    if not plane.strip(b"\x00"):
+        return "[]"
+    return "[" + ", ".join([str(k) for k, v in enumerate(plane) if v]) + "]"
+
+
+def _board(board: Board, compact: bool) -> str:
+    if board.__class__ is not Board:
+        return json.dumps(board.jsonifyable(compact))
+    size, data = board.size, bytes(board._data)
+    n = size * size
+    if compact:
+        counts_for: Dict[str, List[str]] = {c.to_short(): [] for c in Color}
+        plane = data[3 * n : 4 * n]
+        if plane.strip(b"\x00"):
+            for k, value in enumerate(plane):
+                if value:
+                    counts_for[_SHORT_COLORS[value]].append(str(k))
+        colors = data[:n].translate(_COMPACT_COLORS).decode("ascii")
+        return (
+            f'{{"size": {size}'
+            f', "colors": {encode_basestring_ascii(colors)}'
+            f', "markedDead": {_indices(data[n : 2 * n])}'
+            f', "counted": {_indices(data[2 * n : 3 * n])}'
+            ', "countsFor": {'
+            + ", ".join(
+                [f'"{c}": [' + ", ".join(ks) + "]" for c, ks in counts_for.items()]
+            )
+            + "}}"
+        )
+    try:
+        points = [
+            _POINTS[p]
+            for p in zip(
+                data[:n], data[n : 2 * n], data[2 * n : 3 * n], data[3 * n : 4 * n]
+            )
+        ]
+    except KeyError:
+        # not a state that Board ever writes, but json.dumps would manage
+        return json.dumps(board.jsonifyable(compact))
+    return (
+        f'{{"size": {size}, "points": ['
+        + ", ".join(
+            ["[" + ", ".join(points[k : k + size]) + "]" for k in range(0, n, size)]
+        )
+        + "]}"
+    )
+
+
+def _game_fields(game: Game) -> str:
+    """Return the JSON of `game.jsonifyable_without_board()` less the braces"""
+
+    pending_request, result = game.pending_request, game.result
+    return (
+        f'"status": "{game.status.name}"'
+        f', "komi": {_value(game.komi)}'
+        f', "prisoners": {{"white": {_value(game.prisoners[Color.white])}'
+        f', "black": {_value(game.prisoners[Color.black])}}}'
+        f', "turn": "{game.turn.name}"'
+        f', "territory": {{"white": {_value(game.territory[Color.white])}'
+        f', "black": {_value(game.territory[Color.black])}}}'
+        ', "pendingRequest": '
+        + (
+            f'{{"requestType": "{pending_request.request_type.name}"'
+            f', "initiator": "{pending_request.initiator.name}"}}'
+            if pending_request
+            else "null"
+        )
+        + ', "result": '
+        + (
+            f'{{"resultType": "{result.result_type.name}"'
+            f", \"winner\": {_COLOR_NAMES[result.winner]}}}"
+            if result
+            else "null"
+        )
+        + f', "lastMove": {_value(game.last_move())}'
+    )
+
+
+def _game_status(data: GameStatusContainer) -> str:
+    if data.game.__class__ is not Game:
+        return json.dumps(data.jsonifyable())
+    return (
+        f'{{"board": {_board(data.game.board, data.compact)}'
+        f", {_game_fields(data.game)}"
+        f', "timePlayed": {_value(data.time_played)}'
+        + ("}" if data.version is None else f', "version": {_value(data.version)}}}')
+    )
+
+
+def _game_status_delta(data: GameStatusDeltaContainer) -> str:
+    # the fields are already a dict, which json.dumps itself is quickest at
+    fields = json.dumps(data.fields)
+    return (
+        (fields[:-1] + ", " if data.fields else "{")
+        + f'"baseVersion": {_value(data.base_version)}'
+        f', "version": {_value(data.version)}'
+        ', "changes": ['
+        + ", ".join(
+            [
+                f"[{_value(i)}, {_value(j)}, {_point(p)}]"
+                for i, j, p in data.changes
+            ]
+        )
+        + f'], "timePlayed": {_value(data.time_played)}}}'
+    )
+
+
+def _keys(data: KeyContainer) -> str:
+    return (
+        f'{{"white": {_value(data[Color.white].player_key)}'
+        f', "black": {_value(data[Color.black].player_key)}}}'
+    )
+
+
+def _response(data: ActionResponseContainer) -> str:
+    return (
+        f'{{"success": {_value(data.success)}'
+        f', "explanation": {_value(data.explanation)}}}'
+    )
+
+
+def _game_response(data: NewGameResponseContainer) -> str:
+    return (
+        f'{{"keys": {_keys(data.keys) if data.keys else "null"}'
+        f", \"yourColor\": {_COLOR_NAMES[data.your_color]}"
+        f', "success": {_value(data.success)}'
+        f', "explanation": {_value(data.explanation)}}}'
+    )
+
+
+def _chat_message(data: ChatMessage) -> str:
+    return (
+        f'{{"timestamp": {_value(data.timestamp)}'
+        f', "color": "{data.color.name}"'
+        f', "message": {_value(data.message)}'
+        f', "id": {_value(data.id)}}}'
+    )
+
+
+def _chat(data: ChatThread) -> str:
+    return (
+        '{"thread": ['
+        + ", ".join([_chat_message(msg) for msg in data.thread])
+        + f'], "isComplete": {_value(data.is_complete)}}}'
+    )
+
+
+_SERIALIZERS: Dict[type, Callable[[Any], str]] = {
+    NewGameResponseContainer: _game_response,
+    JoinGameResponseContainer: _game_response,
+    ActionResponseContainer: _response,
+    GameStatusContainer: _game_status,
+    GameStatusDeltaContainer: _game_status_delta,
+    ChatThread: _chat,
+    OpponentConnectedContainer: (
+        lambda data: f'{{"opponentConnected": {_value(data.opponent_connected)}}}'
+    ),
+    ErrorContainer: lambda data: f'{{"errorMessage": {_value(str(data.exception))}}}',
+    KeyContainer: _keys,
+}
+
+
+def dumps(data: Union[JsonifyableBase, JsonifyableBaseDataClass]) -> str:
+    """Return `json.dumps(data.jsonifyable())`, without building the
+    jsonifyable representation where there is a serializer for `data`"""
+
+    serializer = _SERIALIZERS.get(data.__class__)
+    if serializer is None:
+        return json.dumps(data.jsonifyable())
+    return serializer(data)
@@ -0,0 +1,345 @@
+"""
+Binary encoding of messages for clients which negotiate the binary websocket
+subprotocol (see BINARY_SUBPROTOCOL), as an alternative to JSON text. Rather
+than define a layout per container, which would have to be kept in sync with
+`jsonifyable` and `_deserialize` by hand, we encode the same JSON-able values
+that those produce, so that every container supports both transports for
+free. Values are tagged with a single byte, and integers and lengths are
+varints. What makes this pay off is the shared schema of `SYMBOLS`: all of the
+field names and enum member names on the wire, each of which is sent as a
+single byte instead of a quoted string
+
+NOTE: `SYMBOLS` is part of the subprotocol. Only ever append to it, and bump
+the subprotocol version when doing so, as older peers cannot decode symbols
+which they don't know about
+"""
+
+from __future__ import annotations
+import struct
+from typing import Any, Callable, Dict, List, Tuple
+
+# tags, each of which begins an encoded value. tags at or above _SMALL_SYMBOL
+# carry their payload in the tag byte itself
+_NONE = 0
+_FALSE = 1
+_TRUE = 2
+_INT = 3
+_NEG_INT = 4
+_FLOAT = 5
+_STR = 6
+_SYMBOL = 7
+_LIST = 8
+_DICT = 9
+# a list of integers in [0, 255], e.g. coordinates or flat indices into a
+# board, packed one to a byte
+_BYTE_LIST = 10
+# symbols below 64 and integers below 128 are encoded as 0x40 + symbol and
+# 0x80 + integer respectively
+_SMALL_SYMBOL = 0x40
+_SMALL_INT = 0x80
+
+SYMBOLS: Tuple[str, ...] = (
+    # message envelopes
+    "type",
+    "messageType",
+    "data",
+    # incoming message keys
+    "key",
+    "vs",
+    "color",
+    "size",
+    "komi",
+    "action_type",
+    "coords",
+    "message",
+    "ai_secret",
+    # IncomingMessageType
+    "new_game",
+    "join_game",
+    "game_action",
+    "chat_message",
+    "resync_game",
+    # OutgoingMessageType
+    "new_game_response",
+    "join_game_response",
+    "game_action_response",
+    "game_status",
+    "chat",
+    "opponent_connected",
+    "error",
+    "game_status_delta",
+    # container fields
+    "success",
+    "explanation",
+    "keys",
+    "yourColor",
+    "opponentConnected",
+    "errorMessage",
+    "timePlayed",
+    "version",
+    "baseVersion",
+    "changes",
+    # game fields
+    "board",
+    "status",
+    "prisoners",
+    "turn",
+    "territory",
+    "pendingRequest",
+    "result",
+    "lastMove",
+    "requestType",
+    "initiator",
+    "resultType",
+    "winner",
+    # board fields
+    "points",
+    "colors",
+    "markedDead",
+    "counted",
+    "countsFor",
+    # chat fields
+    "thread",
+    "isComplete",
+    "id",
+    "timestamp",
+    # Color, and its short names
+    "white",
+    "black",
+    "w",
+    "b",
+    "",
+    # GameStatus
+    "play",
+    "endgame",
+    "complete",
+    "request_pending",
+    # ActionType
+    "place_stone",
+    "pass_turn",
+    "mark_dead",
+    "request_draw",
+    "resign",
+    "request_tally_score",
+    "accept",
+    "reject",
+    # RequestType and ResultType, less those above
+    "draw",
+    "tally_score",
+    "standard_win",
+    "resignation",
+    # opponent types
+    "human",
+    "computer",
+    # added in v2
+    "batch",
+)
+_SYMBOL_IDS: Dict[str, int] = {s: k for k, s in enumerate(SYMBOLS)}
+assert len(_SYMBOL_IDS) == len(SYMBOLS), "Duplicate wire symbols"
+
+_DOUBLE = struct.Struct("<d")
+
+
+class Encoded(bytes):
+    """A value which is already encoded, e.g. a cached serialized message, to
+    be written as is when it is part of a larger value"""
+
+    __slots__ = ()
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    """Append non-negative `value` to `out` as a LEB128 varint"""
+
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _encode_str(out: bytearray, value: str) -> None:
+    k = _SYMBOL_IDS.get(value)
+    if k is None:
+        data = value.encode("utf-8")
+        out.append(_STR)
+        _write_varint(out, len(data))
+        out += data
+    elif k < _SMALL_INT - _SMALL_SYMBOL:
+        out.append(_SMALL_SYMBOL + k)
+    else:
+        out.append(_SYMBOL)
+        _write_varint(out, k)
+
+
+def _encode_int(out: bytearray, value: int) -> None:
+    if 0 <= value < 0x80:
+        out.append(_SMALL_INT + value)
+    elif value >= 0:
+        out.append(_INT)
+        _write_varint(out, value)
+    else:
+        out.append(_NEG_INT)
+        _write_varint(out, -value)
+
+
+def _encode_float(out: bytearray, value: float) -> None:
+    out.append(_FLOAT)
+    out += _DOUBLE.pack(value)
+
+
+def _encode_bool(out: bytearray, value: bool) -> None:
+    out.append(_TRUE if value else _FALSE)
+
+
+def _encode_none(out: bytearray, value: None) -> None:
+    out.append(_NONE)
+
+
+def _encode_list(out: bytearray, value: List) -> None:
+    if value and all(v.__class__ is int for v in value):
+        try:
+            packed = bytes(value)
+        except ValueError:
+            pass
+        else:
+            out.append(_BYTE_LIST)
+            _write_varint(out, len(packed))
+            out += packed
+            return
+    out.append(_LIST)
+    _write_varint(out, len(value))
+    for v in value:
+        _ENCODERS[v.__class__](out, v)
+
+
+def _encode_encoded(out: bytearray, value: Encoded) -> None:
+    out += value
+
+
+def _encode_dict(out: bytearray, value: Dict) -> None:
+    out.append(_DICT)
+    _write_varint(out, len(value))
+    for k, v in value.items():
+        _encode_str(out, k)
+        _ENCODERS[v.__class__](out, v)
+
+
+_ENCODERS: Dict[type, Callable[[bytearray, Any], None]] = {
+    str: _encode_str,
+    int: _encode_int,
+    float: _encode_float,
+    bool: _encode_bool,
+    type(None): _encode_none,
+    list: _encode_list,
+    tuple: _encode_list,
+    dict: _encode_dict,
+    Encoded: _encode_encoded,
+}
+
+
+def encode(value: Any) -> bytes:
+    """Return the binary encoding of `value`, which is anything that
+    `json.dumps` would accept, e.g. the result of a `jsonifyable` method. Raise
+    TypeError if it contains anything else"""
+
+    out = bytearray()
+    try:
+        _ENCODERS[value.__class__](out, value)
+    except KeyError as e:
+        raise TypeError(f"Cannot encode values of type {e.args[0].__name__}")
+    return bytes(out)
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    """Return the varint starting at `pos` in `data` and the position
+    following it"""
+
+    value = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _read_length(data: bytes, pos: int) -> Tuple[int, int]:
+    """Return the length of the list or dict starting at `pos` in `data` and the
+    position following it. As each of its items takes at least a byte, a length
+    beyond the rest of `data` is malformed, and is rejected before anything is
+    allocated for it"""
+
+    n, pos = _read_varint(data, pos)
+    if n > len(data) - pos:
+        raise ValueError(f"Length {n} at {pos} exceeds the binary message")
+    return n, pos
+
+
+def _decode(data: bytes, pos: int) -> Tuple[Any, int]:
+    """Return the value starting at `pos` in `data` and the position following
+    it"""
+
+    tag = data[pos]
+    pos += 1
+    if tag >= _SMALL_INT:
+        return tag - _SMALL_INT, pos
+    if tag >= _SMALL_SYMBOL:
+        return SYMBOLS[tag - _SMALL_SYMBOL], pos
+    if tag == _DICT:
+        n, pos = _read_length(data, pos)
+        res = {}
+        for _ in range(n):
+            k, pos = _decode(data, pos)
+            if k.__class__ is not str:
+                raise ValueError(f"Non-string key in binary message at {pos}")
+            res[k], pos = _decode(data, pos)
+        return res, pos
+    if tag == _LIST:
+        n, pos = _read_length(data, pos)
+        res = [None] * n
+        for k in range(n):
+            res[k], pos = _decode(data, pos)
+        return res, pos
+    if tag == _STR or tag == _BYTE_LIST:
+        n, pos = _read_varint(data, pos)
+        if pos + n > len(data):
+            raise IndexError(f"{n} bytes at {pos} out of range")
+        if tag == _STR:
+            return data[pos : pos + n].decode("utf-8"), pos + n
+        return list(data[pos : pos + n]), pos + n
+    if tag == _NONE:
+        return None, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _TRUE:
+        return True, pos
+    if tag == _INT:
+        return _read_varint(data, pos)
+    if tag == _NEG_INT:
+        value, pos = _read_varint(data, pos)
+        return -value, pos
+    if tag == _FLOAT:
+        return _DOUBLE.unpack_from(data, pos)[0], pos + 8
+    if tag == _SYMBOL:
+        k, pos = _read_varint(data, pos)
+        return SYMBOLS[k], pos
+    raise ValueError(f"Unknown wire tag {tag} at {pos - 1}")
+
+
+def decode(data: bytes) -> Any:
+    """Inverse of `encode`. Raise ValueError if `data` is malformed"""
+
+    try:
+        value, pos = _decode(data, 0)
+    except (
+        IndexError,
+        struct.error,
+        UnicodeDecodeError,
+        TypeError,
+        MemoryError,
+        RecursionError,
+    ) as e:
+        raise ValueError(f"Malformed binary message: {e}")
+    if pos != len(data):
+        raise ValueError(f"Unexpected trailing data after binary message at {pos}")
+    return value
@@ -0,0 +1,165 @@
+"""
+Random access to the positions of a game. Rebuilding the position after the
+k-th action of a game otherwise means replaying its action stack from the
+start, which adds up when stepping back and forth through a long game, e.g.
+when investigating a dispute. `Replay` instead keeps a compact snapshot of the
+game state every `interval` actions, so that any position is at most
+`interval - 1` actions away from one
+"""
+
+from __future__ import annotations
+from igo.game import Action, Game
+from typing import Iterable, List, Tuple
+
+DEFAULT_INTERVAL = 16
+
+
+class Replay:
+    """
+    A replayable record of a game, with a cursor which can be moved to any
+    position. Position k is the state of the game after its first k actions,
+    such that position 0 is the empty board and position `len(replay)` is the
+    final state
+
+    Attributes:
+
+        actions: List[Action] - the actions of the game, in order
+
+        size: int - the board size
+
+        komi: float - the komi
+
+        superko: bool - whether the game enforces superko
+
+        interval: int - the number of actions between snapshots
+    """
+
+    __slots__ = (
+        "actions",
+        "size",
+        "komi",
+        "superko",
+        "interval",
+        "_snapshots",
+        "_game",
+        "_position",
+    )
+
+    def __init__(
+        self,
+        actions: List[Action],
+        size: int = 19,
+        komi: float = 6.5,
+        superko: bool = False,
+        interval: int = DEFAULT_INTERVAL,
+    ) -> None:
+        """Replay `actions` once, taking snapshots along the way, and leave
+        the cursor at the final position. Raise ValueError if any action is
+        invalid"""
+
+        if interval < 1:
+            raise ValueError(f"Snapshot interval must be positive, got {interval}")
+        self.actions = actions
+        self.size = size
+        self.komi = komi
+        self.superko = superko
+        self.interval = interval
+
+        game = Game(size, komi, superko)
+        # _snapshots[s] is the state at position s * interval
+        self._snapshots: List[Tuple] = [game._snapshot()]
+        for k, action in enumerate(actions, 1):
+            success, msg = game.take_action(action)
+            if not success:
+                raise ValueError(f"Action {k - 1} cannot be replayed: {msg}")
+            if k % interval == 0:
+                self._snapshots.append(game._snapshot())
+        self._game = game
+        self._position = len(actions)
+
+    @classmethod
+    def from_game(cls, game: Game, interval: int = DEFAULT_INTERVAL) -> Replay:
+        """Return a replay of `game`'s action stack"""
+
+        return cls(
+            list(game.action_stack),
+            game.board.size,
+            game.komi,
+            game.superko,
+            interval,
+        )
+
+    def __len__(self) -> int:
+        return len(self.actions)
+
+    @property
+    def position(self) -> int:
+        """The position of the cursor"""
+
+        return self._position
+
+    @property
+    def game(self) -> Game:
+        """The game at the cursor. It is owned by the replay and modified as
+        the cursor moves, so callers should copy it (or use `position_at`) if
+        they need to hold on to it or modify it"""
+
+        return self._game
+
+    def _restore(self, k: int) -> Game:
+        """Return a new game at the latest snapshot at or before position k"""
+
+        s = min(k // self.interval, len(self._snapshots) - 1)
+        return Game._restore(
+            self._snapshots[s],
+            self.actions[: s * self.interval],
+            self.komi,
+            self.superko,
+        )
+
+    def _check_position(self, k: int) -> None:
+        if not 0 <= k <= len(self.actions):
+            raise IndexError(
+                f"Position {k} is out of range for a replay of"
+                f" {len(self.actions)} actions"
+            )
+
+    def position_at(self, k: int) -> Game:
+        """Return a new game in position k, leaving the cursor where it is"""
+
+        self._check_position(k)
+        game = self._restore(k)
+        for action in self.actions[len(game.action_stack) : k]:
+            game.take_action(action)
+        return game
+
+    def seek(self, k: int) -> Game:
+        """Move the cursor to position k, and return the game there"""
+
+        self._check_position(k)
+        # replaying forwards from the cursor beats restoring a snapshot only
+        # if the cursor is past that snapshot
+        if k < self._position or k - self._position > k % self.interval:
+            self._game = self._restore(k)
+            self._position = len(self._game.action_stack)
+        for action in self.actions[self._position : k]:
+            self._game.take_action(action)
+        self._position = k
+        return self._game
+
+    def step_forward(self) -> Game:
+        """Move the cursor forward by one action, and return the game there"""
+
+        return self.seek(self._position + 1)
+
+    def step_back(self) -> Game:
+        """Move the cursor back by one action, and return the game there"""
+
+        return self.seek(self._position - 1)
+
+
+def replay_all(games: Iterable[Game], interval: int = DEFAULT_INTERVAL) -> List[Replay]:
+    """Return replays of many games at once, e.g. as loaded from the
+    database in bulk"""
+
+    return [Replay.from_game(game, interval) for game in games]
@@ -108,10 +108,19 @@ BEGIN
   RETURN;
 END $$;
 
+-- superseded by the version below, with which calls would otherwise be ambiguous
+DROP FUNCTION IF EXISTS write_game(char(10), bytea, integer);
+DROP FUNCTION IF EXISTS write_game(char(10), bytea, integer, boolean);
+
+-- base_version is the version which data_to_write is expected to replace, by
+-- default the version just before it. a game may be written several actions at
+-- a time, see the write-behind mode of GameStore
 CREATE OR REPLACE FUNCTION write_game(
   key_to_write char(10),
   data_to_write bytea,
-  version_to_write integer
+  version_to_write integer,
+  notify_opponent boolean DEFAULT true,
+  base_version integer DEFAULT null
 )
   RETURNS double precision
   LANGUAGE plpgsql
@@ -125,12 +134,18 @@ BEGIN
   SELECT extract(epoch from now())
   INTO epoch_now;
 
+  -- a game written behind may be written once no players are connected, when
+  -- the write load timestamp is null and no time is being played
   UPDATE game
   SET data = data_to_write
     , version = version_to_write
-    , time_played = time_played + (epoch_now - write_load_timestamp)
-    , write_load_timestamp = epoch_now
-  WHERE version = version_to_write - 1
+    , time_played = time_played + COALESCE(epoch_now - write_load_timestamp, 0)
+    , write_load_timestamp =
+        CASE WHEN write_load_timestamp IS NULL
+        THEN null
+        ELSE epoch_now
+        END
+  WHERE version = COALESCE(base_version, version_to_write - 1)
     AND id = (
       SELECT game_id
       FROM player_key
@@ -140,11 +155,15 @@ BEGIN
   INTO updated_time_played;
 
   if found then
-    PERFORM pg_notify((
-      SELECT CONCAT('game_status_', opponent_key)
-      FROM player_key
-      WHERE key = key_to_write
-    ), '');
+    -- the writer may have updated an opponent connected to the same game server
+    -- itself
+    if notify_opponent then
+      PERFORM pg_notify((
+        SELECT CONCAT('game_status_', opponent_key)
+        FROM player_key
+        WHERE key = key_to_write
+      ), '');
+    end if;
 
     RETURN updated_time_played;
   end if;
@@ -335,4 +354,48 @@ BEGIN
   end if;
 
   RETURN opponent_connected;
-END $$;
\ No newline at end of file
+END $$;
+
+CREATE OR REPLACE FUNCTION get_games_to_migrate(
+  legacy_prefix bytea,
+  max_games integer
+)
+  RETURNS TABLE (
+    game_id integer,
+    game_data bytea,
+    version integer
+  )
+  LANGUAGE plpgsql
+AS
+$$
+BEGIN
+  RETURN QUERY
+    SELECT g.id, g.data, g.version
+    FROM game g
+    WHERE substring(g.data from 1 for length(legacy_prefix)) = legacy_prefix
+    ORDER BY g.id
+    LIMIT max_games;
+
+  RETURN;
+END $$;
+
+CREATE OR REPLACE FUNCTION migrate_game(
+  target_game_id integer,
+  game_data bytea,
+  expected_version integer
+)
+  RETURNS boolean
+  LANGUAGE plpgsql
+AS
+$$
+BEGIN
+  -- the data is rewritten in place without touching anything else, but only
+  -- if the game hasn't been written to since it was read for migration. if it
+  -- has been, it was written in the new format anyways
+  UPDATE game
+  SET data = game_data
+  WHERE id = target_game_id
+    AND version = expected_version;
+
+  RETURN found;
+END $$;
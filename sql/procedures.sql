@@ -27,6 +27,25 @@ BEGIN
   WHERE managed_by = manager_id;
 END $$;
 
+CREATE OR REPLACE PROCEDURE do_cleanup_retired(
+  host_prefix text,
+  live_manager_ids char(64)[]
+)
+  LANGUAGE plpgsql
+AS
+$$
+DECLARE
+  retired_id char(64);
+BEGIN
+  for retired_id in SELECT DISTINCT managed_by
+                     FROM player_key
+                     WHERE starts_with(managed_by, host_prefix)
+                       and managed_by <> ALL(live_manager_ids)
+  loop
+    CALL do_cleanup(retired_id);
+  end loop;
+END $$;
+
 CREATE OR REPLACE PROCEDURE new_game(
   game_data bytea,
   key_w char(10),
@@ -7,19 +7,30 @@ from igo.gameserver.containers import (
     ActionResponseContainer,
     ErrorContainer,
     GameStatusContainer,
+    GameStatusDeltaContainer,
     JoinGameResponseContainer,
     KeyContainer,
     OpponentConnectedContainer,
 )
+from copy import deepcopy
 import json
 from dataclasses import dataclass
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Union
 from igo.aiserver.websocket_client import Client
 import unittest
 from unittest.mock import AsyncMock, patch
-from igo.gameserver.constants import ACTION_TYPE, COORDS, KEY, TYPE, AI_SECRET
+from igo.gameserver import wire
+from igo.gameserver.constants import (
+    ACTION_TYPE,
+    BINARY_SUBPROTOCOL,
+    COORDS,
+    KEY,
+    TYPE,
+    AI_SECRET,
+)
 from igo.gameserver.messages import (
     IncomingMessageType,
+    MessageBatch,
     OutgoingMessage,
     OutgoingMessageType,
 )
@@ -48,15 +59,21 @@ class MockWebsocketConnection:
     read and write methods are called, it verifies that the next action in the
     queue is what is being requested and returns an appropriate response, if any.
     This allows us to simulate a remote game server that the AI server can talk
-    back and forth to, allowing us to verify its read/response pattern
+    back and forth to, allowing us to verify its read/response pattern. If
+    `binary`, the server speaks the binary subprotocol rather than JSON
     """
 
     def __init__(
-        self, test_case: unittest.TestCase, actions: List[ConnectionAction]
+        self,
+        test_case: unittest.TestCase,
+        actions: List[ConnectionAction],
+        binary: bool = False,
     ) -> None:
         self.test_case = test_case
         self.actions = actions
         self.action_idx = 0
+        self.binary = binary
+        self.selected_subprotocol = BINARY_SUBPROTOCOL if binary else None
 
     def append(self, action: ConnectionAction) -> None:
         self.actions.append(action)
@@ -71,23 +88,28 @@ class MockWebsocketConnection:
             "Tried to take more actions than were specified in the test",
         )
 
-    async def read_message(self) -> str:
+    async def read_message(self) -> Union[str, bytes]:
         self._assert_actions_left()
         action = self.actions[self.action_idx]
         self.action_idx += 1
         tc = self.test_case
         tc.assertIs(action.action_type, ConnectionActionType.read)
         tc.assertIsNotNone(action.return_val)
+        if self.binary:
+            return wire.encode(action.return_val.jsonifyable())
         return json.dumps(action.return_val.jsonifyable())
 
-    async def write_message(self, message: str) -> None:
+    async def write_message(
+        self, message: Union[str, bytes], binary: bool = False
+    ) -> None:
         self._assert_actions_left()
         action = self.actions[self.action_idx]
         self.action_idx += 1
         tc = self.test_case
         tc.assertIs(action.action_type, ConnectionActionType.write)
         tc.assertIsNotNone(action.expected_in)
-        msg_deserialized: Dict = json.loads(message)
+        tc.assertEqual(binary, self.binary)
+        msg_deserialized: Dict = wire.decode(message) if binary else json.loads(message)
         for key in action.expected_in.keys() | msg_deserialized.keys():
             tc.assertIn(key, action.expected_in)
             tc.assertIn(key, msg_deserialized)
@@ -257,6 +279,123 @@ class TestWebSocketClient(unittest.IsolatedAsyncioTestCase):
         )
         await self.run_client(False)
 
+    async def test_game_status_delta(self):
+        # test resyncs on a delta without a base, and takes an action on its
+        # turn given a delta with one
+        game = Game()
+        game.take_action(Action(ActionType.place_stone, Color.black, 0, (3, 3)))
+        base_status = GameStatusContainer(game, 1.0, game.version())
+        base_board = bytes(game.board._data)
+        game.take_action(Action(ActionType.place_stone, Color.white, 1, (15, 15)))
+        delta = GameStatusDeltaContainer.from_boards(
+            game, 2.0, base_status.version, base_board
+        )
+        self.test_mock.extend(
+            [
+                ConnectionAction(
+                    ConnectionActionType.read,
+                    return_val=OutgoingMessage(
+                        OutgoingMessageType.game_status_delta, delta
+                    ),
+                ),
+                ConnectionAction(
+                    ConnectionActionType.write,
+                    {
+                        TYPE: IncomingMessageType.resync_game.name,
+                        KEY: self.player_key,
+                    },
+                ),
+                # opponent's turn
+                ConnectionAction(
+                    ConnectionActionType.read,
+                    return_val=OutgoingMessage(
+                        OutgoingMessageType.game_status, base_status
+                    ),
+                ),
+                # client's turn
+                ConnectionAction(
+                    ConnectionActionType.read,
+                    return_val=OutgoingMessage(
+                        OutgoingMessageType.game_status_delta, delta
+                    ),
+                ),
+                ConnectionAction(
+                    ConnectionActionType.write,
+                    {
+                        TYPE: IncomingMessageType.game_action.name,
+                        KEY: self.player_key,
+                        ACTION_TYPE: ActionType.place_stone.name,
+                        COORDS: WILDCARD,
+                    },
+                ),
+            ]
+        )
+        await self.run_client()
+
+    async def test_binary(self):
+        # test that the client speaks binary if the server agrees to it
+        self.test_mock.binary = True
+        self.test_mock.selected_subprotocol = BINARY_SUBPROTOCOL
+        self.test_mock.extend(
+            [
+                ConnectionAction(
+                    ConnectionActionType.read,
+                    return_val=OutgoingMessage(
+                        OutgoingMessageType.game_status,
+                        GameStatusContainer(Game(), 1.0, 0, True),
+                    ),
+                ),
+                ConnectionAction(
+                    ConnectionActionType.write,
+                    {
+                        TYPE: IncomingMessageType.game_action.name,
+                        KEY: self.player_key,
+                        ACTION_TYPE: ActionType.place_stone.name,
+                        COORDS: WILDCARD,
+                    },
+                ),
+            ]
+        )
+        await self.run_client()
+        self.assertEqual(
+            self.connect_mock.call_args.kwargs["subprotocols"], [BINARY_SUBPROTOCOL]
+        )
+
+    async def test_batch(self):
+        # test that the messages in a batch are each handled in turn
+        self.test_mock.extend(
+            [
+                ConnectionAction(
+                    ConnectionActionType.read,
+                    return_val=OutgoingMessage(
+                        OutgoingMessageType.batch,
+                        MessageBatch(
+                            [
+                                OutgoingMessage(
+                                    OutgoingMessageType.game_action_response,
+                                    ActionResponseContainer(True, "success"),
+                                ),
+                                OutgoingMessage(
+                                    OutgoingMessageType.game_status,
+                                    GameStatusContainer(Game(), 1.0, 0, True),
+                                ),
+                            ]
+                        ),
+                    ),
+                ),
+                ConnectionAction(
+                    ConnectionActionType.write,
+                    {
+                        TYPE: IncomingMessageType.game_action.name,
+                        KEY: self.player_key,
+                        ACTION_TYPE: ActionType.place_stone.name,
+                        COORDS: WILDCARD,
+                    },
+                ),
+            ]
+        )
+        await self.run_client()
+
     async def test_chat(self):
         # test that chat is ignored
         self.test_mock.append(
@@ -323,3 +462,98 @@ class TestWebSocketClient(unittest.IsolatedAsyncioTestCase):
             ]
         )
         await self.run_client()
+
+
+class GameStatusUpdateTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.client: Client = await Client("0123456789", "9876543210", RandomPolicy)
+        self.server_game = Game(5)
+        self.client._update_game_status(self.status_message())
+
+    @staticmethod
+    def received(message: OutgoingMessage) -> OutgoingMessage:
+        """Return `message` as received by the client"""
+
+        return OutgoingMessage.deserialize(json.dumps(message.jsonifyable()))
+
+    def status_message(self) -> OutgoingMessage:
+        game = self.server_game
+        return self.received(
+            OutgoingMessage(
+                OutgoingMessageType.game_status,
+                GameStatusContainer(game, 1.0, game.version(), True),
+            )
+        )
+
+    def take_action(self, action: Action) -> OutgoingMessage:
+        """Take `action` on the server's game and return the delta for it"""
+
+        game = self.server_game
+        base_version = game.version()
+        base_board = bytes(game.board._data)
+        self.assertTrue(game.take_action(action)[0])
+        delta = GameStatusDeltaContainer.from_boards(
+            game, 1.0, base_version, base_board
+        )
+        return self.received(
+            OutgoingMessage(OutgoingMessageType.game_status_delta, delta)
+        )
+
+    def test_ko(self):
+        # test that the client's game follows the server's through a ko, and so
+        # knows that the immediate recapture is illegal, unlike a game rebuilt
+        # from the status
+        game = self.client.game_status.game
+        for i, (color, coords) in enumerate(
+            [
+                (Color.black, (0, 1)),
+                (Color.white, (0, 2)),
+                (Color.black, (1, 0)),
+                (Color.white, (1, 3)),
+                (Color.black, (2, 1)),
+                (Color.white, (2, 2)),
+                (Color.black, (4, 4)),
+                (Color.white, (1, 1)),
+            ]
+        ):
+            message = self.take_action(Action(ActionType.place_stone, color, i, coords))
+            self.assertTrue(self.client._update_game_status(message))
+        base_status = deepcopy(self.client.game_status)
+        message = self.take_action(
+            Action(ActionType.place_stone, Color.black, 8, (1, 2))
+        )
+        self.assertTrue(self.client._update_game_status(message))
+
+        self.assertIs(self.client.game_status.game, game)
+        self.assertEqual(self.client.game_status.version, self.server_game.version())
+        self.assertEqual(game.board._data, self.server_game.board._data)
+        self.assertEqual(game.prisoners[Color.black], 1)
+        self.assertNotIn((1, 1), game.legal_moves())
+        self.assertIn((1, 1), base_status.apply_delta(message.data).game.legal_moves())
+
+        # a pass, and a resync of the status we already have, keep the game too
+        message = self.take_action(Action(ActionType.pass_turn, Color.white, 9))
+        self.assertTrue(self.client._update_game_status(message))
+        self.assertTrue(self.client._update_game_status(self.status_message()))
+        self.assertIs(self.client.game_status.game, game)
+        self.assertIs(game.turn, Color.black)
+
+    def test_mismatch(self):
+        # test that the server's status is adopted whenever ours disagrees with
+        # it, and that stale deltas are rejected
+        game = self.client.game_status.game
+        message = self.take_action(
+            Action(ActionType.place_stone, Color.black, 0, (2, 2))
+        )
+        message.data.fields["prisoners"][Color.black.name] = 3
+        self.assertTrue(self.client._update_game_status(message))
+        self.assertIsNot(self.client.game_status.game, game)
+        self.assertEqual(self.client.game_status.game.prisoners[Color.black], 3)
+
+        message = self.take_action(Action(ActionType.resign, Color.white, 1))
+        game = self.client.game_status.game
+        self.assertTrue(self.client._update_game_status(message))
+        self.assertIsNot(self.client.game_status.game, game)
+        self.assertIs(self.client.game_status.game.status, GameStatus.complete)
+
+        self.assertFalse(self.client._update_game_status(message))
@@ -1,10 +1,171 @@
+import json
+import re
 import unittest
+from unittest.mock import AsyncMock, patch
+from igo.gameserver import connection_manager, wire
+from igo.gameserver.connection_manager import IgoWebSocket
+from igo.gameserver.constants import KEY, TYPE
+from igo.gameserver.messages import (
+    IncomingMessageType,
+    OutgoingMessage,
+    OutgoingMessageType,
+)
+from tornado.options import options
+from tornado.testing import AsyncHTTPTestCase, gen_test
+import tornado.web
+from tornado.websocket import websocket_connect
 
 # NOTE: It isn't immediately clear how to test tornado application, but the
 # code is almost trivial, so we'll trust in the correctness of the tornado lib
 # and leave it untested for now. https://www.tornadoweb.org/en/stable/testing.html
-# provides some hints should we choose to revisit later
+# provides some hints should we choose to revisit later. the exception is
+# compression, which reaches into tornado's internals
+
+
+class EchoWebSocket(IgoWebSocket):
+    """An IgoWebSocket which echoes messages instead of handling them"""
+
+    game_manager = None
+    origin_matcher = re.compile(".*")
+
+    def open(self):
+        super().open()
+        # for inspection by tests
+        EchoWebSocket.last_protocol = self.ws_connection
+
+    def on_message(self, message):
+        self.write_message(message, isinstance(message, bytes))
+
+
+class MockedWebSocket(IgoWebSocket):
+    """An IgoWebSocket which handles messages, but with a mock game manager"""
+
+    game_manager = AsyncMock()
+    origin_matcher = re.compile(".*")
 
 
 class ConnectionManagerTestCase(unittest.TestCase):
-    pass
\ No newline at end of file
+    pass
+
+
+class CompressionTestCase(AsyncHTTPTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        patcher = patch.object(
+            connection_manager,
+            "compression_stats",
+            connection_manager.CompressionStats(),
+        )
+        self.addCleanup(patcher.stop)
+        self.stats = patcher.start()
+
+    def get_app(self) -> tornado.web.Application:
+        return tornado.web.Application([(r"/websocket", EchoWebSocket)])
+
+    async def echo(self, messages, compression: bool = True):
+        conn = await websocket_connect(
+            self.get_url("/websocket").replace("http", "ws"),
+            compression_options={} if compression else None,
+        )
+        for msg in messages:
+            conn.write_message(msg)
+            self.assertEqual(await conn.read_message(), msg)
+        conn.close()
+
+    @gen_test
+    async def test_compression(self):
+        small = "x" * (options.compression_threshold - 1)
+        large = '{"points": [' + ", ".join(['[null, false, false, null]'] * 361) + "]}"
+        await self.echo([small, large, small, large])
+        # only the large messages are compressed, and they compress very well
+        self.assertEqual(self.stats.compressed, 2)
+        self.assertEqual(self.stats.uncompressed, 2)
+        self.assertEqual(self.stats.bytes_in, 2 * len(large))
+        self.assertLess(self.stats.bytes_out, len(large) / 20)
+        self.assertGreater(self.stats.cpu_time, 0)
+        self.assertIn("compressed 2 of 4 messages", str(self.stats))
+
+        # unless the client doesn't support it
+        await self.echo([large], False)
+        self.assertEqual(self.stats.compressed, 2)
+        self.assertEqual(self.stats.uncompressed, 2)
+
+    @gen_test
+    async def test_options(self):
+        large = "abcdefgh" * 1024
+        with patch.object(options.mockable(), "compression", False):
+            await self.echo([large])
+        self.assertEqual(self.stats.compressed, 0)
+
+        with patch.object(options.mockable(), "compression_window_bits", 9):
+            await self.echo([large])
+        self.assertEqual(self.stats.compressed, 1)
+        compressor = EchoWebSocket.last_protocol._compressor._compressor
+        self.assertEqual(compressor._max_wbits, 9)
+
+
+class RejectionTestCase(AsyncHTTPTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        patcher = patch.object(
+            connection_manager, "rejection_stats", connection_manager.RejectionStats()
+        )
+        self.addCleanup(patcher.stop)
+        self.stats = patcher.start()
+        MockedWebSocket.game_manager.reset_mock()
+
+    def get_app(self) -> tornado.web.Application:
+        return tornado.web.Application(
+            [(r"/websocket", MockedWebSocket)],
+            websocket_max_message_size=options.max_message_size,
+        )
+
+    @gen_test
+    async def test_rejection(self):
+        conn = await websocket_connect(self.get_url("/websocket").replace("http", "ws"))
+        route_message = MockedWebSocket.game_manager.route_message
+
+        valid = {TYPE: IncomingMessageType.join_game.name, KEY: "0123456789"}
+        for msg in ("not json", json.dumps({**valid, KEY: "too short"})):
+            conn.write_message(msg)
+            res = OutgoingMessage.deserialize(await conn.read_message())
+            self.assertIs(res.message_type, OutgoingMessageType.error)
+        self.assertEqual(self.stats.invalid, 2)
+        route_message.assert_not_called()
+
+        conn.write_message(json.dumps(valid))
+        conn.write_message(json.dumps(valid))
+        await conn.write_message(" " * (options.max_message_size + 1))
+        # the connection is closed on reading the size of the oversized message
+        self.assertIsNone(await conn.read_message())
+        self.assertEqual(self.stats.oversized, 1)
+        self.assertEqual(self.stats.invalid, 2)
+        self.assertEqual(route_message.call_count, 2)
+        self.assertEqual(route_message.call_args[0][0].data, {KEY: "0123456789"})
+        self.assertIn("rejected 1 oversized and 2 invalid", str(self.stats))
+
+    @gen_test
+    async def test_binary_rejection(self):
+        conn = await websocket_connect(self.get_url("/websocket").replace("http", "ws"))
+        for msg in (
+            # a list claiming 50 million items
+            bytes([8, 0x80, 0xE1, 0xEB, 0x17]),
+            # a dict with a list for a key
+            bytes([9, 1, 8, 0, 0x80]),
+            # lists nested far too deep
+            bytes([8, 1]) * 5000 + bytes([0]),
+        ):
+            conn.write_message(msg, binary=True)
+            res = OutgoingMessage.deserialize(await conn.read_message())
+            self.assertIs(res.message_type, OutgoingMessageType.error)
+        self.assertEqual(self.stats.invalid, 3)
+        MockedWebSocket.game_manager.route_message.assert_not_called()
+
+        # while the connection remains usable
+        conn.write_message(
+            wire.encode({TYPE: IncomingMessageType.join_game.name, KEY: "0123456789"}),
+            binary=True,
+        )
+        await conn.write_message(" " * (options.max_message_size + 1))
+        self.assertIsNone(await conn.read_message())
+        self.assertEqual(MockedWebSocket.game_manager.route_message.call_count, 1)
@@ -5,9 +5,10 @@ from igo.gameserver.containers import (
     ActionResponseContainer,
     OpponentConnectedContainer,
     GameStatusContainer,
+    GameStatusDeltaContainer,
     KeyContainer,
 )
-from igo.game import Color, Game
+from igo.game import Action, ActionType, Color, Game
 
 
 class KeyContainerTestCase(unittest.TestCase):
@@ -97,3 +98,66 @@ class GameStatusContainerTestCase(unittest.TestCase):
         self.assertEqual(
             GameStatusContainer.deserialize(game_status.jsonifyable()), game_status
         )
+
+    def test_version(self):
+        game_status = GameStatusContainer(Game(), 123.12312, 0)
+        self.assertEqual(game_status.jsonifyable()["version"], 0)
+        self.assertEqual(
+            GameStatusContainer.deserialize(game_status.jsonifyable()).version, 0
+        )
+        self.assertNotIn("version", GameStatusContainer(Game(), 1.0).jsonifyable())
+
+    def test_compact(self):
+        game = Game()
+        game_status = GameStatusContainer(game, 123.12312, compact=True)
+        self.assertEqual(
+            game_status.jsonifyable(),
+            {**game.jsonifyable(True), "timePlayed": 123.12312},
+        )
+        self.assertEqual(
+            GameStatusContainer.deserialize(game_status.jsonifyable()), game_status
+        )
+
+
+class GameStatusDeltaContainerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.game = Game(5)
+        self.base = GameStatusContainer.deserialize(
+            GameStatusContainer(self.game, 1.0, self.game.version()).jsonifyable()
+        )
+        self.base_board = bytes(self.game.board._data)
+        for i, coords in enumerate([(0, 1), (0, 0), (1, 0)]):
+            self.game.take_action(
+                Action(ActionType.place_stone, self.game.turn, i, coords)
+            )
+        self.delta = GameStatusDeltaContainer.from_boards(
+            self.game, 2.0, self.base.version, self.base_board
+        )
+
+    def test_from_boards(self):
+        self.assertEqual(self.delta.base_version, 0)
+        self.assertEqual(self.delta.version, 3)
+        # the white stone at (0, 0) was placed and then captured
+        self.assertEqual([(i, j) for i, j, _ in self.delta.changes], [(0, 1), (1, 0)])
+        self.assertEqual(self.delta.fields, self.game.jsonifyable_without_board())
+
+    def test_deserialize(self):
+        self.assertEqual(
+            GameStatusDeltaContainer.deserialize(self.delta.jsonifyable()),
+            self.delta,
+        )
+
+    def test_apply_delta(self):
+        delta = GameStatusDeltaContainer.deserialize(self.delta.jsonifyable())
+        res = self.base.apply_delta(delta)
+        self.assertEqual(res.version, 3)
+        self.assertEqual(res.time_played, 2.0)
+        self.assertEqual(
+            res.jsonifyable(), GameStatusContainer(self.game, 2.0, 3).jsonifyable()
+        )
+        # the base is unchanged
+        self.assertEqual(bytes(self.base.game.board._data), self.base_board)
+
+        # stale or unversioned bases must be resynced
+        self.assertIsNone(res.apply_delta(delta))
+        self.assertIsNone(GameStatusContainer(Game(5), 1.0).apply_delta(delta))
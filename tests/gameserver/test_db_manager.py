@@ -3,11 +3,14 @@ import logging
 from datetime import datetime
 from igo.gameserver.chat import ChatMessage, ChatThread
 import pickle
-from igo.game import Color, Game
+from igo.codec import LEGACY_PREFIX, decode_game
+from igo.game import Action, ActionType, Color, Game
 from igo.gameserver.db_manager import DbManager, JoinResult, _UpdateType
 import testing.postgresql
 import unittest
-from unittest.mock import AsyncMock, MagicMock, patch
+from typing import Optional
+from unittest.mock import AsyncMock, patch
+from tornado.options import options
 import asyncio
 
 
@@ -65,7 +68,7 @@ class DbManagerTestCase(unittest.IsolatedAsyncioTestCase):
             FROM player_key
             WHERE managed_by = $1
             """,
-                manager._machine_id,
+                manager._manager_id,
             ),
         )
         (
@@ -82,7 +85,7 @@ class DbManagerTestCase(unittest.IsolatedAsyncioTestCase):
                 WHERE managed_by = $1
             )
             """,
-            manager._machine_id,
+            manager._manager_id,
         )
         self.assertEqual(players_connected, 1)
         self.assertEqual(time_played, 0)
@@ -128,6 +131,72 @@ class DbManagerTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(players_connected, 0)
         self.assertIsNone(write_load_timestamp)
 
+    async def test_startup_cleans_per_process(self):
+        async def start(
+            task_id: Optional[int], processes: int = 2, keep: bool = True
+        ) -> DbManager:
+            with patch("tornado.process.task_id", return_value=task_id), patch.object(
+                options.mockable(), "processes", processes
+            ):
+                manager: DbManager = await DbManager(
+                    self.game_status_callback,
+                    self.chat_callback,
+                    self.opponent_connected_callback,
+                    self.__class__.postgresql.url(),
+                    False,
+                )
+
+            async def cleanup():
+                await manager._listener_connection.close()
+                await manager._connection_pool.close()
+
+            # when only the cleanup at startup matters, close the manager's
+            # connections right away to stay under the database's limit
+            if keep:
+                self.addAsyncCleanup(cleanup)
+            else:
+                await cleanup()
+            return manager
+
+        async def managed_by(keys: KeyContainer) -> Optional[str]:
+            return await self.manager._listener_connection.fetchval(
+                """
+                SELECT managed_by
+                FROM player_key
+                WHERE key = $1
+                """,
+                keys[Color.white].player_key,
+            )
+
+        # each process on the host manages its connections under its own id
+        first, second = await start(0), await start(1)
+        ids = {self.manager._manager_id, first._manager_id, second._manager_id}
+        self.assertEqual(len(ids), 3)
+        self.assertEqual({len(i) for i in ids}, {64})
+        keys = await second.write_new_game(Game(), Color.white)
+        single_keys = await self.manager.write_new_game(Game(), Color.white)
+
+        # so restarting one leaves the connections of the others alone, except
+        # that the first cleans up after a single process game server
+        await start(0, keep=False)
+        self.assertEqual(await managed_by(keys), second._manager_id)
+        self.assertIsNone(await managed_by(single_keys))
+        await start(1, keep=False)
+        self.assertIsNone(await managed_by(keys))
+
+        # restarting with fewer processes, the first cleans up after those
+        # beyond the new count, but not after those still running
+        third = await start(2, processes=3)
+        keys = await second.write_new_game(Game(), Color.white)
+        third_keys = await third.write_new_game(Game(), Color.white)
+        await start(0, keep=False)
+        self.assertEqual(await managed_by(keys), second._manager_id)
+        self.assertIsNone(await managed_by(third_keys))
+
+        # and a single process game server cleans up after all of them
+        await start(None, keep=False)
+        self.assertIsNone(await managed_by(keys))
+
     async def test_write_new_game(self):
         manager = self.manager
         game = Game()
@@ -139,7 +208,7 @@ class DbManagerTestCase(unittest.IsolatedAsyncioTestCase):
             FROM player_key
             WHERE managed_by = $1
             """,
-            manager._machine_id,
+            manager._manager_id,
         )
         game_id = row.get("game_id")
         self.assertEqual(keys[Color.white].player_key, row.get("key"))
@@ -170,7 +239,7 @@ class DbManagerTestCase(unittest.IsolatedAsyncioTestCase):
             """,
             keys[Color.white].player_key,
         )
-        self.assertEqual(pickle.loads(game_data), game)
+        self.assertEqual(decode_game(game_data), game)
         self.assertEqual(game.version(), version)
         self.assertEqual(time_played, 0)
 
@@ -235,21 +304,7 @@ class DbManagerTestCase(unittest.IsolatedAsyncioTestCase):
         await manager._subscribe_to_updates(key)
         self.assertEqual(len(manager._listening_channels[key]), len(_UpdateType))
 
-    @patch("igo.gameserver.db_manager.pickle.dumps", MagicMock(return_value=b"1"))
-    @patch("igo.gameserver.db_manager.pickle.loads", MagicMock(return_value=b"1"))
     async def test_write_game(self):
-        """
-        NOTE: pickling methods need to be mocked because of an error like
-
-        _pickle.PicklingError: Can't pickle <class 'unittest.mock.MagicMock'>:
-        it's not the same object as unittest.mock.MagicMock
-
-        I think this might actually be something I can fix, i.e. something to do
-        with the "Where to patch" trickiness with unittest mocking that isn't
-        standing out to me, but I'm also not testing pickling functionality, so
-        it doesn't really matter if they are real methods or not
-        """
-
         manager = self.manager
         game = Game()
         keys: KeyContainer = await manager.write_new_game(game, Color.white)
@@ -274,6 +329,57 @@ class DbManagerTestCase(unittest.IsolatedAsyncioTestCase):
         await asyncio.sleep(0.1)
         self.game_status_callback.assert_awaited_once()
 
+        # unless the opponent has been updated by other means
+        with patch.object(Game, "version", return_value=2):
+            self.assertGreater(
+                await manager.write_game(
+                    keys[Color.white].player_key, game, notify_opponent=False
+                ),
+                0,
+            )
+        await asyncio.sleep(0.1)
+        self.game_status_callback.assert_awaited_once()
+
+    async def test_migrate_game_data(self):
+        manager = self.manager
+        games = [Game(), Game(9)]
+        games[1].take_action(Action(ActionType.place_stone, Color.black, 1.0, (4, 4)))
+        keys = [await manager.write_new_game(g) for g in games]
+        # write a third game in the new format, which should be left alone
+        await manager.write_new_game(Game(13))
+        for g, k in zip(games, keys):
+            await manager._listener_connection.execute(
+                """
+                UPDATE game
+                SET data = $1
+                WHERE id = (SELECT game_id FROM player_key WHERE key = $2)
+                """,
+                pickle.dumps(g),
+                k[Color.white].player_key,
+            )
+
+        # pickled games can still be read
+        game_data = await manager._listener_connection.fetchval(
+            """
+            SELECT game_data FROM get_game_status($1);
+            """,
+            keys[1][Color.white].player_key,
+        )
+        self.assertTrue(game_data.startswith(LEGACY_PREFIX))
+        self.assertEqual(decode_game(game_data), games[1])
+
+        self.assertEqual(await manager.migrate_game_data(batch_size=1), 2)
+        for g, k in zip(games, keys):
+            game_data = await manager._listener_connection.fetchval(
+                """
+                SELECT game_data FROM get_game_status($1);
+                """,
+                k[Color.white].player_key,
+            )
+            self.assertFalse(game_data.startswith(LEGACY_PREFIX))
+            self.assertEqual(decode_game(game_data), g)
+        self.assertEqual(await manager.migrate_game_data(), 0)
+
     async def test_write_chat(self):
         manager = self.manager
         timestamp = datetime.now().timestamp()
@@ -0,0 +1,144 @@
+import asyncio
+import json
+from igo.codec import encode_game, encode_state
+from igo.game import Action, ActionType, Color, Game
+from igo.gameserver.constants import (
+    ACTION_TYPE,
+    COLOR,
+    COORDS,
+    KEY,
+    KOMI,
+    SIZE,
+    TYPE,
+    VS,
+)
+from igo.gameserver.db_manager import DbManager
+from igo.gameserver.engine import EnginePool
+from igo.gameserver.game_manager import GameManager
+from igo.gameserver.messages import (
+    IncomingMessage,
+    IncomingMessageType,
+    OutgoingMessage,
+)
+import testing.postgresql
+from tornado.websocket import WebSocketHandler
+from typing import Optional
+import unittest
+from unittest.mock import AsyncMock, patch
+
+
+class EnginePoolTestCase(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.postgresql = testing.postgresql.Postgresql(port=7654)
+        # forked before the event loop is started, see EnginePool
+        cls.engine = EnginePool(cls.postgresql.url(), 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.close()
+        cls.postgresql.stop()
+
+    async def asyncSetUp(self):
+        self.manager: DbManager = await DbManager(
+            AsyncMock(), AsyncMock(), AsyncMock(), self.__class__.postgresql.url(), True
+        )
+
+    async def asyncTearDown(self) -> None:
+        await self.manager._listener_connection.close()
+        await self.manager._connection_pool.close()
+
+    async def test_write_game(self):
+        engine = self.__class__.engine
+        keys = await self.manager.write_new_game(Game(), Color.white)
+        key = keys[Color.white].player_key
+        actions = [
+            Action(ActionType.place_stone, Color.black, 1.0, (0, 0)),
+            Action(ActionType.place_stone, Color.white, 2.0, (1, 1)),
+            Action(ActionType.place_stone, Color.black, 3.0, (2, 2)),
+            Action(ActionType.pass_turn, Color.white, 4.0),
+            Action(ActionType.pass_turn, Color.black, 5.0),
+        ]
+
+        async def write(start: int, stop: int) -> Optional[float]:
+            """Write actions[start:stop] as the game server would, with the
+            state of the game once they are taken"""
+
+            game = Game()
+            for action in actions[:stop]:
+                game.take_action(action)
+            return await engine.write_game(
+                key, key, encode_state(game), actions[start:stop], start
+            )
+
+        # the game is fetched by the first write, and its log kept for the next
+        self.assertIsNotNone(await write(0, 1))
+        self.assertIsNotNone(await write(1, 3))
+        game, _ = await self.manager.get_game(key)
+        self.assertEqual(game.action_stack, actions[:3])
+
+        # a write based on an earlier version is preempted
+        self.assertIsNone(await write(1, 2))
+        # as is one based on the version kept, once another game server has
+        # written the game since
+        game.take_action(actions[3])
+        self.assertIsNotNone(await self.manager.write_game(key, game))
+        self.assertIsNone(await write(3, 4))
+        # but not one based on the latest version, which is fetched, as it is
+        # once forgotten
+        await engine.forget(key)
+        self.assertIsNotNone(await write(4, 5))
+        written, _ = await self.manager.get_game(key)
+        self.assertEqual(written.action_stack, actions)
+        game.take_action(actions[4])
+        self.assertEqual(encode_game(written), encode_game(game))
+
+    @patch.object(WebSocketHandler, "__init__", lambda self: None)
+    @patch.object(WebSocketHandler, "__hash__", lambda self: 1)
+    @patch.object(WebSocketHandler, "__eq__", lambda self, o: o is self)
+    @patch.object(OutgoingMessage, "send")
+    async def test_game_manager(self, _):
+        gm = await GameManager(
+            self.__class__.postgresql.url(), engine=self.__class__.engine
+        )
+
+        async def cleanup():
+            await gm.store._db_manager._listener_connection.close()
+            await gm.store._db_manager._connection_pool.close()
+
+        self.addAsyncCleanup(cleanup)
+
+        async def route(player: WebSocketHandler, message_type, **data) -> None:
+            await gm.route_message(
+                IncomingMessage(json.dumps({TYPE: message_type.name, **data}), player)
+            )
+            # see note in test_db_manager about timing-dependent tests
+            await asyncio.sleep(0.1)
+
+        p1, p2 = WebSocketHandler(), WebSocketHandler()
+        await route(
+            p1,
+            IncomingMessageType.new_game,
+            **{VS: "human", COLOR: Color.white.name, SIZE: 9, KOMI: 6.5},
+        )
+        game_key = gm.store._clients[p1].game_key
+        black_key = await gm.store._db_manager._connection_pool.fetchval(
+            "SELECT opponent_key FROM player_key WHERE key = $1", game_key
+        )
+        await route(p2, IncomingMessageType.join_game, **{KEY: black_key})
+
+        # actions are written by the engine workers rather than the game server
+        with patch.object(DbManager, "write_game") as write_game:
+            await route(
+                p2,
+                IncomingMessageType.game_action,
+                **{
+                    KEY: black_key,
+                    ACTION_TYPE: ActionType.place_stone.name,
+                    COORDS: [0, 0],
+                },
+            )
+        write_game.assert_not_called()
+        game, _ = await gm.store._db_manager.get_game(game_key)
+        self.assertEqual(game, gm.store._clients[p1].game)
+        self.assertEqual(game.version(), 1)
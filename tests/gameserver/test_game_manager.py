@@ -1,4 +1,8 @@
 import asyncio
+import os
+import logging
+from time import time
+from tempfile import TemporaryDirectory
 from igo.gameserver.chat import ChatThread
 from typing import Optional, Tuple
 from igo.gameserver.containers import (
@@ -26,7 +30,7 @@ from igo.gameserver.messages import (
     OutgoingMessage,
     OutgoingMessageType,
 )
-from igo.game import Color, ActionType, Game
+from igo.game import Action, Color, ActionType, Game
 from igo.gameserver.constants import (
     AI_SECRET,
     TYPE,
@@ -37,8 +41,10 @@ from igo.gameserver.constants import (
     KEY,
     ACTION_TYPE,
     COORDS,
+    FEATURE_BATCH,
     MESSAGE,
 )
+from tornado.options import options
 import testing.postgresql
 
 
@@ -185,7 +191,7 @@ class GameManagerIntegrationTestCase(unittest.IsolatedAsyncioTestCase):
     @patch.object(OutgoingMessage, "send")
     async def test_new_game(self, send_mock: AsyncMock, init_mock: Mock) -> None:
         init_mock.return_value = None
-        player, _ = await self.createNewGame()
+        player, client_data = await self.createNewGame()
         self.assertEqual(send_mock.await_count, 4)
         # response message
         init_args = init_mock.call_args_list[0].args
@@ -197,6 +203,11 @@ class GameManagerIntegrationTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(init_args[0], OutgoingMessageType.game_status)
         self.assertIsInstance(init_args[1], GameStatusContainer)
         self.assertEqual(init_args[2], player)
+        # cached by game and version, the game being identified by the white key
+        self.assertEqual(
+            init_mock.call_args_list[1].kwargs["cache_key"][:2],
+            (client_data.keys.player_key, 0),
+        )
         # chat
         init_args = init_mock.call_args_list[2].args
         self.assertEqual(init_args[0], OutgoingMessageType.chat)
@@ -335,6 +346,90 @@ class GameManagerIntegrationTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertIsInstance(trigger_opp_connd, OpponentConnectedContainer)
         self.assertFalse(trigger_opp_connd.opponent_connected)
 
+    @patch.object(OutgoingMessage, "__init__")
+    @patch.object(OutgoingMessage, "send")
+    async def test_batch(self, send_mock: AsyncMock, init_mock: Mock) -> None:
+        init_mock.return_value = None
+        p1 = WebSocketHandler()
+        p1.features = frozenset((FEATURE_BATCH,))
+        await self.createNewGame(p1)
+        # the response, game status, chat and opponent connected in one batch
+        self.assertEqual(send_mock.call_count, 1)
+        self.assertEqual(
+            [c.args[0] for c in init_mock.call_args_list],
+            [
+                OutgoingMessageType.new_game_response,
+                OutgoingMessageType.game_status,
+                OutgoingMessageType.chat,
+                OutgoingMessageType.opponent_connected,
+                OutgoingMessageType.batch,
+            ],
+        )
+        self.assertEqual(len(init_mock.call_args_list[-1].args[1].messages), 4)
+        keys: KeyContainer = init_mock.call_args_list[0].args[1].keys
+
+        # likewise on joining, where the game, chat and opponent connected are
+        # fetched rather than notified
+        init_mock.reset_mock()
+        send_mock.call_count = 0
+        p2 = WebSocketHandler()
+        p2.features = frozenset((FEATURE_BATCH,))
+        await self.gm.route_message(
+            IncomingMessage(
+                json.dumps(
+                    {
+                        TYPE: IncomingMessageType.join_game.name,
+                        KEY: keys[Color.black].player_key,
+                    }
+                ),
+                p2,
+            )
+        )
+        # see note in test_db_manager about timing-dependent tests
+        await asyncio.sleep(0.1)
+        # the batch, and p1's notification that p2 connected
+        self.assertEqual(send_mock.call_count, 2)
+        batch = [c.args for c in init_mock.call_args_list if c.args[2] is p2]
+        self.assertEqual(
+            [args[0] for args in batch],
+            [
+                OutgoingMessageType.join_game_response,
+                OutgoingMessageType.game_status,
+                OutgoingMessageType.chat,
+                OutgoingMessageType.opponent_connected,
+                OutgoingMessageType.batch,
+            ],
+        )
+        self.assertTrue(batch[0][1].success)
+        self.assertEqual(batch[1][1].game, Game())
+        self.assertTrue(batch[3][1].opponent_connected)
+
+        # and the action response and game status after a successful action
+        init_mock.reset_mock()
+        send_mock.call_count = 0
+        await self.gm.route_message(
+            IncomingMessage(
+                json.dumps(
+                    {
+                        TYPE: IncomingMessageType.game_action.name,
+                        KEY: keys[Color.black].player_key,
+                        ACTION_TYPE: ActionType.place_stone.name,
+                        COORDS: [0, 0],
+                    }
+                ),
+                p2,
+            )
+        )
+        await asyncio.sleep(0.1)
+        self.assertEqual(
+            [c.args[0] for c in init_mock.call_args_list if c.args[2] is p2][:3],
+            [
+                OutgoingMessageType.game_action_response,
+                OutgoingMessageType.game_status,
+                OutgoingMessageType.batch,
+            ],
+        )
+
     @patch.object(OutgoingMessage, "__init__")
     @patch.object(OutgoingMessage, "send")
     async def test_route_game_actions(
@@ -491,6 +586,71 @@ class GameManagerIntegrationTestCase(unittest.IsolatedAsyncioTestCase):
                 )
             )
 
+    @patch.object(OutgoingMessage, "__init__")
+    @patch.object(OutgoingMessage, "send")
+    async def test_shared_game(self, send_mock: AsyncMock, init_mock: Mock) -> None:
+        init_mock.return_value = None
+        store = self.gm.store
+        p1, p1_data = await self.createNewGame()
+        keys: KeyContainer = init_mock.call_args_list[0].args[1].keys
+        p2 = WebSocketHandler()
+        await self.gm.route_message(
+            IncomingMessage(
+                json.dumps(
+                    {
+                        TYPE: IncomingMessageType.join_game.name,
+                        KEY: keys[Color.black].player_key,
+                    }
+                ),
+                p2,
+            )
+        )
+        # see note in test_db_manager about timing-dependent tests
+        await asyncio.sleep(0.1)
+        p2_data = store._clients[p2]
+        self.assertIs(p1_data.entry, p2_data.entry)
+        self.assertEqual(len(store._games), 1)
+
+        # the opponent is sent the game status directly, without a notification
+        # from the database
+        init_mock.reset_mock()
+        with patch.object(
+            DbManager, "write_game", autospec=True, side_effect=DbManager.write_game
+        ) as write_game, patch.object(DbManager, "_game_status_consumer") as consumer:
+            await self.gm.route_message(
+                IncomingMessage(
+                    json.dumps(
+                        {
+                            TYPE: IncomingMessageType.game_action.name,
+                            KEY: keys[Color.black].player_key,
+                            ACTION_TYPE: ActionType.place_stone.name,
+                            COORDS: [0, 0],
+                        }
+                    ),
+                    p2,
+                )
+            )
+            await asyncio.sleep(0.1)
+        self.assertFalse(write_game.call_args.kwargs["notify_opponent"])
+        consumer.assert_not_called()
+        self.assertEqual(
+            [c.args[0] for c in init_mock.call_args_list if c.args[2] is p1],
+            [OutgoingMessageType.game_status],
+        )
+        self.assertEqual(p1_data.game.version(), 1)
+
+        # a game fetched from the database never replaces a later one
+        await store._update_game(p1_data.game_key, p1_data.entry, Game(), 0.0, p1)
+        self.assertEqual(p1_data.game.version(), 1)
+
+        # the game is forgotten once both players have left
+        await self.gm.unsubscribe(p1)
+        self.assertEqual(
+            store._games[p2_data.game_key].player_keys, {p2_data.keys.player_key}
+        )
+        await self.gm.unsubscribe(p2)
+        self.assertEqual(store._games, {})
+
     @patch.object(OutgoingMessage, "__init__")
     @patch.object(OutgoingMessage, "send")
     @patch("igo.gameserver.game_manager.start_ai_player")
@@ -560,3 +720,248 @@ class GameManagerIntegrationTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertTrue(join_res.success)
         # already awaited once for new game
         self.assertEqual(start_ai_player_mock.await_count, 2)
+
+
+@patch.object(WebSocketHandler, "__init__", lambda self: None)
+@patch.object(WebSocketHandler, "__hash__", lambda self: 1)
+@patch.object(WebSocketHandler, "__eq__", lambda self, o: o is self)
+@patch.object(OutgoingMessage, "send")
+class WriteBehindTestCase(unittest.IsolatedAsyncioTestCase):
+    """
+    Test the whole stack from GameManager down in write-behind mode, where the
+    database lags behind the journal
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.postgresql = testing.postgresql.Postgresql(port=7654)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.postgresql.stop()
+
+    async def asyncSetUp(self):
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for name, value in {
+            "write_behind": True,
+            "journal_path": os.path.join(tmp.name, "journal"),
+            # never, unless set otherwise
+            "write_behind_moves": 1000,
+            "write_behind_interval": 1000.0,
+        }.items():
+            patcher = patch.object(options.mockable(), name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.gm: GameManager = await self.start(True)
+
+    async def start(self, run_db_setup_scripts: bool = False) -> GameManager:
+        gm = await GameManager(self.__class__.postgresql.url(), run_db_setup_scripts)
+
+        async def cleanup():
+            await gm.store._db_manager._listener_connection.close()
+            await gm.store._db_manager._connection_pool.close()
+
+        self.addAsyncCleanup(cleanup)
+        return gm
+
+    async def route(
+        self, player: WebSocketHandler, message_type: IncomingMessageType, **data
+    ) -> None:
+        await self.gm.route_message(
+            IncomingMessage(json.dumps({TYPE: message_type.name, **data}), player)
+        )
+        # see note in test_db_manager about timing-dependent tests
+        await asyncio.sleep(0.1)
+
+    async def play(self, player: WebSocketHandler, coords) -> None:
+        key = self.gm.store._clients[player].keys.player_key
+        await self.route(
+            player,
+            IncomingMessageType.game_action,
+            **{KEY: key, ACTION_TYPE: ActionType.place_stone.name, COORDS: coords},
+        )
+
+    async def new_game(self) -> Tuple[WebSocketHandler, WebSocketHandler, str]:
+        """Create a game and join both players to it, returning their clients
+        and the key of the game"""
+
+        p1, p2 = WebSocketHandler(), WebSocketHandler()
+        await self.route(
+            p1,
+            IncomingMessageType.new_game,
+            **{VS: "human", COLOR: Color.white.name, SIZE: 9, KOMI: 6.5},
+        )
+        game_key = self.gm.store._clients[p1].game_key
+        black_key = await self.gm.store._db_manager._connection_pool.fetchval(
+            "SELECT opponent_key FROM player_key WHERE key = $1", game_key
+        )
+        await self.route(p2, IncomingMessageType.join_game, **{KEY: black_key})
+        return p1, p2, game_key
+
+    async def written_version(self, game_key: str) -> int:
+        game, _ = await self.gm.store._db_manager.get_game(game_key)
+        return game.version()
+
+    async def test_crash_recovery(self, _):
+        p1, p2, game_key = await self.new_game()
+        for player, coords in ((p2, [0, 0]), (p1, [1, 1]), (p2, [2, 2])):
+            await self.play(player, coords)
+        game = self.gm.store._clients[p1].game
+        self.assertEqual(game.version(), 3)
+        # acknowledged, but only journaled
+        self.assertEqual(await self.written_version(game_key), 0)
+
+        # crash, without writing anything, and restart
+        self.gm = await self.start()
+        recovered, _ = await self.gm.store._db_manager.get_game(game_key)
+        self.assertEqual(recovered, game)
+        # and the journal is discarded once written
+        self.assertEqual(list(self.gm.store._journal.records()), [])
+
+    async def test_write_behind(self, _):
+        p1, p2, game_key = await self.new_game()
+        with patch.object(options.mockable(), "write_behind_moves", 2):
+            await self.play(p2, [0, 0])
+            self.assertEqual(await self.written_version(game_key), 0)
+            await self.play(p1, [1, 1])
+            self.assertEqual(await self.written_version(game_key), 2)
+
+        await self.play(p2, [2, 2])
+        await self.gm.store.flush()
+        self.assertEqual(await self.written_version(game_key), 3)
+
+        await self.play(p1, [3, 3])
+        await self.gm.unsubscribe(p1)
+        self.assertEqual(await self.written_version(game_key), 4)
+
+        # but when the opponent is connected to another game server, actions are
+        # written before they are acknowledged
+        self.gm.store._clients[p2].opponent_connected = True
+        with patch.object(
+            DbManager, "write_game", autospec=True, side_effect=DbManager.write_game
+        ) as write_game:
+            await self.play(p2, [4, 4])
+        self.assertEqual(await self.written_version(game_key), 5)
+        self.assertTrue(write_game.call_args.kwargs["notify_opponent"])
+
+        await self.gm.close()
+
+    async def test_write_conflict(self, _):
+        async def conflict(
+            action_type: ActionType, coords=None
+        ) -> ActionResponseContainer:
+            """Have black resign, after white took an action on another game
+            server but before we learned of it"""
+
+            p1, p2, game_key = await self.new_game()
+            await self.play(p2, [0, 0])
+            await self.gm.unsubscribe(p1)
+            self.gm.store._clients[p2].opponent_connected = True
+            game, _ = await self.gm.store._db_manager.get_game(game_key)
+            remote = Action(action_type, Color.white, time(), coords)
+            game.take_action(remote)
+            await self.gm.store._db_manager.write_game(
+                game_key, game, notify_opponent=False
+            )
+
+            with patch.object(
+                GameStore, "_send", autospec=True, side_effect=GameStore._send
+            ) as send:
+                await self.route(
+                    p2,
+                    IncomingMessageType.game_action,
+                    **{
+                        KEY: self.gm.store._clients[p2].keys.player_key,
+                        ACTION_TYPE: ActionType.resign.name,
+                    },
+                )
+            response, status = send.call_args.args[2]
+            self.assertIs(status.message_type, OutgoingMessageType.game_status)
+            written, _ = await self.gm.store._db_manager.get_game(game_key)
+            self.assertEqual(self.gm.store._clients[p2].game, written)
+            self.assertEqual(written.action_stack[1], remote)
+            return response.data
+
+        # the action is retaken on the game as written by the other game server
+        response = await conflict(ActionType.place_stone, (1, 1))
+        self.assertTrue(response.success)
+        self.assertEqual(response.explanation, "Black resigned")
+
+        # unless it is no longer valid
+        response = await conflict(ActionType.resign)
+        self.assertFalse(response.success)
+        self.assertEqual(response.explanation, "Game action is invalid once complete")
+
+    async def test_update_conflict(self, _):
+        # in case another test disabled logging
+        self.addCleanup(logging.disable, logging.root.manager.disable)
+        logging.disable(logging.NOTSET)
+        p1, p2, game_key = await self.new_game()
+        await self.play(p2, [0, 0])
+        # white resigned on another game server, before black's stone was written
+        game, time_played = await self.gm.store._db_manager.get_game(game_key)
+        game.take_action(Action(ActionType.resign, Color.white, time()))
+        entry = self.gm.store._clients[p1].entry
+
+        with patch.object(GameStore, "_send_game_status") as send_game_status:
+            with self.assertLogs(level="ERROR"):
+                await self.gm.store._update_game(
+                    game_key, entry, game, time_played, p1
+                )
+        # black's stone is dropped, and black told so, leaving white to the caller
+        self.assertEqual(entry.game, game)
+        send_game_status.assert_called_once_with(p2)
+
+    async def test_recovery_divergence(self, _):
+        p1, p2, game_key = await self.new_game()
+        await self.play(p2, [0, 0])
+        # written, but left in the journal along with the next action
+        entry = self.gm.store._clients[p1].entry
+        async with entry.lock:
+            await self.gm.store._write_unwritten(game_key, entry)
+        await self.play(p1, [1, 1])
+        game = self.gm.store._clients[p1].game
+
+        # a crash replays only the action which wasn't written
+        self.gm = await self.start()
+        recovered, _ = await self.gm.store._db_manager.get_game(game_key)
+        self.assertEqual(recovered, game)
+
+        # but none of a game which another game server has since written a
+        # different history of, even at the same versions
+        p1, p2, game_key = await self.new_game()
+        await self.play(p2, [0, 0])
+        await self.play(p1, [1, 1])
+        remote, _ = await self.gm.store._db_manager.get_game(game_key)
+        for color, coords in ((Color.black, (2, 2)), (Color.white, (3, 3))):
+            remote.take_action(Action(ActionType.place_stone, color, time(), coords))
+        # which we crash before learning of
+        with patch.object(GameStore, "_update_game"):
+            self.assertIsNotNone(
+                await self.gm.store._db_manager.write_game(
+                    game_key, remote, notify_opponent=False, base_version=0
+                )
+            )
+            await asyncio.sleep(0.1)
+
+        self.addCleanup(logging.disable, logging.root.manager.disable)
+        logging.disable(logging.NOTSET)
+        with self.assertLogs(level="ERROR"):
+            self.gm = await self.start()
+        recovered, _ = await self.gm.store._db_manager.get_game(game_key)
+        self.assertEqual(recovered, remote)
+        self.assertEqual(list(self.gm.store._journal.records()), [])
+
+    async def test_unwritten_uncached(self, _):
+        p1, p2, game_key = await self.new_game()
+        with patch.object(
+            GameStore, "_send", autospec=True, side_effect=GameStore._send
+        ) as send:
+            await self.play(p2, [0, 0])
+        # the game may yet be rebased onto another history of this version
+        _, status = send.call_args.args[2]
+        self.assertIsNone(status.cache_key)
+
+        await self.gm.store.flush()
+        self.assertIsNotNone(self.gm.store._game_status_message(p1).cache_key)
@@ -0,0 +1,65 @@
+import asyncio
+import os
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+from igo.game import Action, ActionType, Color
+from igo.gameserver.journal import Journal
+
+
+class JournalTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        tmp = TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "journal")
+        self.actions = [
+            Action(ActionType.place_stone, Color.black, 1.25, (0, 1)),
+            Action(ActionType.pass_turn, Color.white, 2.5),
+            Action(ActionType.mark_dead, Color.black, 3.0, ((0, 1), (2, 3))),
+        ]
+
+    async def test_records(self):
+        journal = Journal(self.path)
+        for version, action in enumerate(self.actions, 1):
+            await journal.append("0123456789", version, action)
+        # as if crashed while appending
+        journal._file.write('["0123456789", 4, "pass_')
+        await journal.close()
+
+        # only the segments left behind are read
+        journal = Journal(self.path)
+        self.assertEqual(journal.segment, 1)
+        self.assertEqual(
+            list(journal.records()),
+            [("0123456789", v, a) for v, a in enumerate(self.actions, 1)],
+        )
+        journal.discard(journal.segment)
+        self.assertEqual(list(journal.records()), [])
+        await journal.close()
+
+    async def test_rotate(self):
+        journal = Journal(self.path, fsync=False)
+        await journal.append("0123456789", 1, self.actions[0])
+        segment = await journal.rotate()
+        await journal.append("0123456789", 2, self.actions[1])
+        # the earlier segment can be discarded, but not the current one
+        journal.discard(segment)
+        await journal.close()
+        journal = Journal(self.path)
+        self.assertEqual(
+            list(journal.records()), [("0123456789", 2, self.actions[1])]
+        )
+        await journal.close()
+
+    async def test_group_sync(self):
+        journal = Journal(self.path)
+        with patch("os.fsync", wraps=os.fsync) as fsync:
+            await asyncio.gather(
+                *[journal.append(str(k), 1, self.actions[0]) for k in range(10)]
+            )
+        # all of which were appended before the first sync began
+        self.assertEqual(fsync.call_count, 1)
+        await journal.close()
+        journal = Journal(self.path)
+        self.assertEqual(len(list(journal.records())), 10)
+        await journal.close()
@@ -0,0 +1,89 @@
+import json
+import logging
+import unittest
+from unittest.mock import patch
+from igo.gameserver import log_events
+from igo.gameserver.log_events import log_event
+from igo.gameserver.messages import IncomingMessageType, OutgoingMessageType
+from tornado.options import options
+
+
+class Unformattable:
+    def __str__(self):
+        raise AssertionError("Formatted an event which wasn't logged")
+
+
+class LogEventsTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        # other tests may have disabled logging
+        self.addCleanup(logging.disable, logging.root.manager.disable)
+        logging.disable(logging.NOTSET)
+
+    def configure(self, **values) -> None:
+        for name, value in values.items():
+            patcher = patch.object(options.mockable(), name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        log_events.configure()
+        self.addCleanup(log_events.configure)
+
+    def test_formats(self):
+        fields = {
+            "message_type": OutgoingMessageType.game_status,
+            "client": "127.0.0.1 (AbCdEfG)",
+            "key": "0123456789",
+            "empty": "",
+            "seconds": 0.25,
+            "success": True,
+            "nothing": None,
+        }
+        self.configure(log_format="kv")
+        with self.assertLogs(level=logging.INFO) as logs:
+            log_event("sent", **fields)
+        self.assertEqual(
+            logs.records[0].getMessage(),
+            'event=sent message_type=game_status client="127.0.0.1 (AbCdEfG)"'
+            ' key=0123456789 empty="" seconds=0.25 success=True nothing=None',
+        )
+
+        self.configure(log_format="json")
+        with self.assertLogs(level=logging.INFO) as logs:
+            log_event("sent", **fields)
+        self.assertEqual(
+            json.loads(logs.records[0].getMessage()),
+            {"event": "sent", **fields, "message_type": "game_status"},
+        )
+
+        with patch.object(options.mockable(), "log_format", "xml"):
+            with self.assertRaises(ValueError):
+                log_events.configure()
+
+    def test_levels(self):
+        self.configure(log_format="kv")
+        with self.assertLogs(level=logging.WARNING) as logs:
+            # not formatted, as below the level
+            log_event("received", value=Unformattable())
+            log_event("rejected", logging.WARNING, reason="too big")
+        self.assertEqual(
+            [r.getMessage() for r in logs.records], ['event=rejected reason="too big"']
+        )
+
+    def test_sampling(self):
+        self.configure(
+            log_sample_rate=0.0, log_sample_rates="game_action=1, pong=1,chat=0.5"
+        )
+        with self.assertLogs(level=logging.INFO) as logs:
+            log_event("received", message_type=IncomingMessageType.new_game)
+            log_event("received", message_type=IncomingMessageType.game_action)
+            log_event("sent", message_type=OutgoingMessageType.game_status)
+            log_event("pong", client="bob")
+            log_event("ping", client=Unformattable())
+            for _ in range(1000):
+                log_event("sent", message_type=OutgoingMessageType.chat)
+        messages = [r.getMessage() for r in logs.records]
+        self.assertEqual(
+            messages[:2],
+            ["event=received message_type=game_action", "event=pong client=bob"],
+        )
+        # about half of the chat messages
+        self.assertLess(abs(len(messages) - 2 - 500), 100)
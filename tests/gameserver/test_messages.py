@@ -1,16 +1,31 @@
-from igo.gameserver.containers import GameStatusContainer
+from igo.gameserver.containers import ActionResponseContainer, GameStatusContainer
 from datetime import datetime
 from igo.game import ActionType, Color, Game
+from igo.gameserver import wire
 from igo.gameserver.messages import (
     IncomingMessage,
     IncomingMessageType,
+    MessageBatch,
     OutgoingMessage,
     OutgoingMessageType,
+    SERIALIZATION_CACHE_SIZE,
 )
 import unittest
 from unittest.mock import AsyncMock, patch
 from tornado.websocket import WebSocketHandler
-from igo.gameserver.constants import SIZE, TYPE, VS, COLOR, KOMI, KEY, ACTION_TYPE
+from igo.gameserver.constants import (
+    ACTION_TYPE,
+    AI_SECRET,
+    COLOR,
+    COORDS,
+    KEY,
+    KOMI,
+    MAX_CHAT_MESSAGE_LEN,
+    MESSAGE,
+    SIZE,
+    TYPE,
+    VS,
+)
 import json
 import asyncio
 
@@ -21,17 +36,17 @@ import asyncio
 class IncomingMessageTestCase(unittest.TestCase):
     def test_create_message(self):
         # test required keys (incorrect)
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(ValueError):
             IncomingMessage(
                 json.dumps({TYPE: IncomingMessageType.new_game.name}),
                 WebSocketHandler(),
             )
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(ValueError):
             IncomingMessage(
                 json.dumps({TYPE: IncomingMessageType.join_game.name}),
                 WebSocketHandler(),
             )
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(ValueError):
             IncomingMessage(
                 json.dumps({TYPE: IncomingMessageType.game_action.name}),
                 WebSocketHandler(),
@@ -51,7 +66,7 @@ class IncomingMessageTestCase(unittest.TestCase):
                 ),
                 WebSocketHandler(),
             )
-        except AssertionError as e:
+        except ValueError as e:
             self.fail(
                 f"Correctly specified IncomingMessage still failed required key assertion: {e}"
             )
@@ -62,7 +77,7 @@ class IncomingMessageTestCase(unittest.TestCase):
                 ),
                 WebSocketHandler(),
             )
-        except AssertionError:
+        except ValueError:
             self.fail(
                 f"Correctly specified IncomingMessage still failed required key assertion: {e}"
             )
@@ -77,7 +92,7 @@ class IncomingMessageTestCase(unittest.TestCase):
                 ),
                 WebSocketHandler(),
             )
-        except AssertionError:
+        except ValueError:
             self.fail(
                 f"Correctly specified IncomingMessage still failed required key assertion: {e}"
             )
@@ -121,6 +136,140 @@ class IncomingMessageTestCase(unittest.TestCase):
         m2.timestamp = ts
         self.assertNotEqual(m1, m2)
 
+    def test_validation(self):
+        valid = {
+            IncomingMessageType.new_game: {
+                VS: "computer",
+                COLOR: Color.black.name,
+                SIZE: 9,
+                KOMI: 6,
+            },
+            IncomingMessageType.join_game: {KEY: "0123456789", AI_SECRET: "abcdefghij"},
+            IncomingMessageType.game_action: {
+                KEY: "0123456789",
+                ACTION_TYPE: ActionType.mark_dead.name,
+                COORDS: [[0, 0], [24, 24]],
+            },
+            IncomingMessageType.chat_message: {KEY: "0123456789", MESSAGE: "hi"},
+            IncomingMessageType.resync_game: {KEY: "0123456789"},
+        }
+        invalid = {
+            VS: ["alien", None, 1],
+            COLOR: ["red", "w", ["white"]],
+            SIZE: [0, 26, 19.0, True, "19"],
+            KOMI: [float("nan"), float("inf"), "6.5", None, False],
+            KEY: ["012345678", "01234567890", 123456789, None],
+            AI_SECRET: ["", {}],
+            ACTION_TYPE: ["place stone", 1],
+            COORDS: [
+                [0],
+                [0, 0, 0],
+                [-1, 0],
+                [0, 25],
+                [0.0, 0],
+                [True, 0],
+                [[0, 0], [0, -1]],
+                [[0, 0], 0],
+                [[0, 0]] * 626,
+                "0,0",
+                0,
+                {},
+            ],
+            MESSAGE: ["x" * (MAX_CHAT_MESSAGE_LEN + 1), None],
+        }
+        p = WebSocketHandler()
+        for message_type, data in valid.items():
+            for raw in (json.dumps, wire.encode):
+                msg = IncomingMessage(raw({TYPE: message_type.name, **data}), p)
+                self.assertIs(msg.message_type, message_type)
+                self.assertEqual(msg.data, data)
+            for key, values in invalid.items():
+                if key not in data:
+                    continue
+                for value in values:
+                    with self.assertRaises(ValueError):
+                        IncomingMessage(
+                            json.dumps({TYPE: message_type.name, **data, key: value}),
+                            p,
+                        )
+
+        # a list of points is only fine for marking dead
+        for action_type in (ActionType.place_stone, ActionType.pass_turn):
+            with self.assertRaises(ValueError):
+                IncomingMessage(
+                    json.dumps(
+                        {
+                            TYPE: IncomingMessageType.game_action.name,
+                            KEY: "0123456789",
+                            ACTION_TYPE: action_type.name,
+                            COORDS: [[1, 2], [3, 4]],
+                        }
+                    ),
+                    p,
+                )
+        IncomingMessage(
+            json.dumps(
+                {
+                    TYPE: IncomingMessageType.game_action.name,
+                    KEY: "0123456789",
+                    ACTION_TYPE: ActionType.mark_dead.name,
+                    COORDS: [1, 2],
+                }
+            ),
+            p,
+        )
+
+        # no coords are fine when e.g. passing
+        for coords in (None, []):
+            IncomingMessage(
+                json.dumps(
+                    {
+                        TYPE: IncomingMessageType.game_action.name,
+                        KEY: "0123456789",
+                        ACTION_TYPE: ActionType.pass_turn.name,
+                        COORDS: coords,
+                    }
+                ),
+                p,
+            )
+        IncomingMessage(
+            json.dumps(
+                {
+                    TYPE: IncomingMessageType.chat_message.name,
+                    KEY: "0123456789",
+                    MESSAGE: "x" * MAX_CHAT_MESSAGE_LEN,
+                }
+            ),
+            p,
+        )
+
+        for raw in (
+            "",
+            "{",
+            "[1, 2]",
+            json.dumps({KEY: "0123456789"}),
+            json.dumps({TYPE: ["join_game"], KEY: "0123456789"}),
+            json.dumps({TYPE: "leave_game", KEY: "0123456789"}),
+            "[" * 100000 + "]" * 100000,
+            b"",
+            wire.encode([1, 2]),
+        ):
+            with self.assertRaises(ValueError):
+                IncomingMessage(raw, p)
+
+    def test_binary(self):
+        data = {TYPE: IncomingMessageType.join_game.name, KEY: "0123456789"}
+        p = WebSocketHandler()
+        m1 = IncomingMessage(json.dumps(data), p)
+        m2 = IncomingMessage(wire.encode(data), p)
+        m1.timestamp = m2.timestamp
+        self.assertEqual(m1, m2)
+        with self.assertRaises(ValueError):
+            IncomingMessage(
+                wire.encode({TYPE: IncomingMessageType.join_game.name}),
+                WebSocketHandler(),
+            )
+
 
 @patch.object(WebSocketHandler, "__init__", lambda self: None)
 class OutgoingMessageTestCase(unittest.TestCase):
@@ -134,6 +283,48 @@ class OutgoingMessageTestCase(unittest.TestCase):
             json.dumps(msg.jsonifyable())
         )
 
+    def test_send_binary(self):
+        WebSocketHandler.write_message = AsyncMock(autospec=True)
+        WebSocketHandler.id = "bob"
+        handler = WebSocketHandler()
+        handler.binary = True
+        g = GameStatusContainer(Game(1), 12.3)
+        msg = OutgoingMessage(OutgoingMessageType.game_status, g, handler)
+        asyncio.run(msg.send())
+        WebSocketHandler.write_message.assert_called_once_with(
+            wire.encode(msg.jsonifyable()), binary=True
+        )
+
+    def test_cache_key(self):
+        g = GameStatusContainer(Game(1), 12.3)
+        key = ("test_cache_key", 0)
+        msg = OutgoingMessage(OutgoingMessageType.game_status, g, cache_key=key)
+        with patch.object(
+            GameStatusContainer, "jsonifyable", return_value=g.jsonifyable()
+        ) as jsonifyable:
+            text = msg.serialize()
+            self.assertEqual(text, json.dumps(msg.jsonifyable()))
+            jsonifyable.reset_mock()
+            # any message of the same type and key is taken to be the same
+            for _ in range(3):
+                self.assertIs(
+                    OutgoingMessage(
+                        OutgoingMessageType.game_status,
+                        GameStatusContainer(Game(1), 45.6),
+                        cache_key=key,
+                    ).serialize(),
+                    text,
+                )
+            jsonifyable.assert_not_called()
+            # but the encodings are cached separately
+            self.assertEqual(msg.serialize(True), wire.encode(msg.jsonifyable()))
+
+        # the cache is bounded
+        for i in range(SERIALIZATION_CACHE_SIZE):
+            OutgoingMessage(OutgoingMessageType.game_status, g, cache_key=i).serialize()
+        self.assertIsNot(msg.serialize(), text)
+        self.assertEqual(msg.serialize(), text)
+
     def test_jsonifyable(self):
         g = Game(1)
         msg_type = OutgoingMessageType.game_status
@@ -150,3 +341,40 @@ class OutgoingMessageTestCase(unittest.TestCase):
             OutgoingMessageType.game_status, GameStatusContainer(Game(1), 12.3)
         )
         self.assertEqual(OutgoingMessage.deserialize(msg.jsonifyable()), msg)
+
+    def test_batch(self):
+        g = GameStatusContainer(Game(1), 12.3)
+        key = ("test_batch", 0)
+        batch = OutgoingMessage(
+            OutgoingMessageType.batch,
+            MessageBatch(
+                [
+                    OutgoingMessage(
+                        OutgoingMessageType.game_action_response,
+                        ActionResponseContainer(True, "success"),
+                    ),
+                    OutgoingMessage(OutgoingMessageType.game_status, g, cache_key=key),
+                ]
+            ),
+        )
+        # serializes exactly as a whole as it does in parts
+        for binary in (False, True):
+            self.assertEqual(
+                batch.serialize(binary),
+                (wire.encode if binary else json.dumps)(batch.jsonifyable()),
+            )
+        # reusing the serializations of cached messages
+        with patch.object(GameStatusContainer, "jsonifyable") as jsonifyable:
+            batch.serialize()
+            batch.serialize(True)
+            jsonifyable.assert_not_called()
+
+        res = OutgoingMessage.deserialize(batch.serialize())
+        self.assertIs(res.message_type, OutgoingMessageType.batch)
+        self.assertEqual(
+            [msg.message_type for msg in res.data.messages],
+            [OutgoingMessageType.game_action_response, OutgoingMessageType.game_status],
+        )
+        self.assertEqual(
+            res.data.messages[1], OutgoingMessage(OutgoingMessageType.game_status, g)
+        )
@@ -0,0 +1,165 @@
+from datetime import datetime
+import json
+import random
+import unittest
+from igo.game import (
+    Action,
+    ActionType,
+    Color,
+    Game,
+    Point,
+    Request,
+    RequestType,
+    Result,
+    ResultType,
+)
+from igo.gameserver import serializers
+from igo.gameserver.chat import ChatMessage, ChatThread
+from igo.gameserver.containers import (
+    ActionResponseContainer,
+    ErrorContainer,
+    GameStatusContainer,
+    GameStatusDeltaContainer,
+    JoinGameResponseContainer,
+    KeyContainer,
+    NewGameResponseContainer,
+    OpponentConnectedContainer,
+)
+from igo.gameserver.messages import MessageBatch, OutgoingMessage, OutgoingMessageType
+
+
+def random_game(size: int, num_moves: int, seed: int = 0) -> Game:
+    rng = random.Random(seed)
+    game = Game(size)
+    for _ in range(num_moves):
+        moves = game.legal_moves()
+        if not moves:
+            break
+        coords = rng.choice(moves)
+        game.take_action(Action(ActionType.place_stone, game.turn, 0, coords))
+    return game
+
+
+class SerializersTestCase(unittest.TestCase):
+    def assertSerializes(self, data):
+        self.assertEqual(serializers.dumps(data), json.dumps(data.jsonifyable()))
+
+    def test_containers(self):
+        keys = KeyContainer("0123456789", "9876543210", "secret")
+        for data in [
+            keys,
+            NewGameResponseContainer(True, "success", keys, Color.white),
+            JoinGameResponseContainer(False, "failure"),
+            JoinGameResponseContainer(True, 'with "quotes"\n', keys, Color.black),
+            ActionResponseContainer(True, "success"),
+            ActionResponseContainer(False, "üñíçødé"),
+            OpponentConnectedContainer(True),
+            OpponentConnectedContainer(False),
+            ErrorContainer(Exception("error")),
+            ErrorContainer(KeyError("key")),
+            ChatThread(),
+            ChatThread(
+                [
+                    ChatMessage(datetime.now().timestamp(), Color.black, "hi bob", "1"),
+                    ChatMessage(2, Color.white, "☃ \U0001F600", 2),
+                    ChatMessage(3.0, Color.white, ""),
+                ],
+                True,
+            ),
+        ]:
+            self.assertSerializes(data)
+
+    def test_game_status(self):
+        for size, num_moves in ((1, 0), (9, 0), (9, 30), (19, 150)):
+            game = random_game(size, num_moves)
+            for compact in (False, True):
+                for version in (None, 0, game.version()):
+                    self.assertSerializes(
+                        GameStatusContainer(game, 123.4, version, compact)
+                    )
+
+        # the state only reached at the end of a game, and unusual values
+        game = Game(5, 6)
+        game.take_action(Action(ActionType.place_stone, Color.black, 0, (0, 0)))
+        game.take_action(Action(ActionType.place_stone, Color.white, 1, (4, 4)))
+        game.take_action(Action(ActionType.pass_turn, Color.black, 2))
+        game.take_action(Action(ActionType.pass_turn, Color.white, 3))
+        game.take_action(Action(ActionType.mark_dead, Color.white, 4, ((0, 0),)))
+        self.assertEqual(
+            game.pending_request, Request(RequestType.mark_dead, Color.white)
+        )
+        for time_played in (0, 1.5, float("nan"), float("inf")):
+            for compact in (False, True):
+                self.assertSerializes(
+                    GameStatusContainer(game, time_played, 5, compact)
+                )
+        game.take_action(Action(ActionType.accept, Color.black, 5))
+        game.take_action(Action(ActionType.request_tally_score, Color.black, 6))
+        game.take_action(Action(ActionType.accept, Color.white, 7))
+        self.assertEqual(game.result.result_type, ResultType.standard_win)
+        for compact in (False, True):
+            self.assertSerializes(GameStatusContainer(game, 1.5, 8, compact))
+        game.result = Result(ResultType.draw)
+        self.assertSerializes(GameStatusContainer(game, 1.5))
+
+    def test_game_status_delta(self):
+        game = random_game(9, 10)
+        base_board = bytes(game.board._data)
+        game.take_action(Action(ActionType.place_stone, game.turn, 0, (0, 0)))
+        delta = GameStatusDeltaContainer.from_boards(game, 1.5, 10, base_board)
+        self.assertSerializes(delta)
+        # as received by clients
+        self.assertSerializes(GameStatusDeltaContainer.deserialize(delta.jsonifyable()))
+        self.assertSerializes(GameStatusDeltaContainer(0, 1, [], {}, 0.0))
+        self.assertSerializes(
+            GameStatusDeltaContainer(
+                0, 1, [(0, 0, Point(Color.white, True))], {1: "coerced key"}, 0.0
+            )
+        )
+
+    def test_fallback(self):
+        class Subclass(ActionResponseContainer):
+            def jsonifyable(self):
+                return {"different": True}
+
+        self.assertSerializes(Subclass(True, "success"))
+        game = Game(3)
+        # not a state Board ever writes, but which json.dumps could encode
+        game.board._data[3 * 3] = 2
+        self.assertSerializes(GameStatusContainer(game, 1.5))
+
+    def test_messages(self):
+        game = random_game(9, 20)
+        data = {
+            OutgoingMessageType.new_game_response: NewGameResponseContainer(
+                True, "success", KeyContainer("a", "b"), Color.white
+            ),
+            OutgoingMessageType.join_game_response: JoinGameResponseContainer(
+                False, "failure"
+            ),
+            OutgoingMessageType.game_action_response: ActionResponseContainer(
+                True, "success"
+            ),
+            OutgoingMessageType.game_status: GameStatusContainer(game, 1.5, 20, True),
+            OutgoingMessageType.chat: ChatThread(
+                [ChatMessage(1.5, Color.black, "hi", 1)], True
+            ),
+            OutgoingMessageType.opponent_connected: OpponentConnectedContainer(True),
+            OutgoingMessageType.error: ErrorContainer(Exception("error")),
+            OutgoingMessageType.game_status_delta: GameStatusDeltaContainer(
+                19,
+                20,
+                [(1, 2, Point(Color.black))],
+                game.jsonifyable_without_board(),
+                1.5,
+            ),
+        }
+        data[OutgoingMessageType.batch] = MessageBatch(
+            [OutgoingMessage(t, d) for t, d in data.items()]
+        )
+        # every type of message is covered
+        self.assertEqual(set(data), set(OutgoingMessageType))
+        for message_type, d in data.items():
+            msg = OutgoingMessage(message_type, d)
+            self.assertEqual(msg.to_json(), json.dumps(msg.jsonifyable()))
+            self.assertEqual(msg.serialize(), json.dumps(msg.jsonifyable()))
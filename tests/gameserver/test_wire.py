@@ -0,0 +1,156 @@
+from datetime import datetime
+import json
+import unittest
+from igo.game import (
+    Action,
+    ActionType,
+    Color,
+    Game,
+    GameStatus,
+    RequestType,
+    ResultType,
+)
+from igo.gameserver import wire
+from igo.gameserver.chat import ChatMessage, ChatThread
+from igo.gameserver.containers import (
+    ActionResponseContainer,
+    ErrorContainer,
+    GameStatusContainer,
+    GameStatusDeltaContainer,
+    JoinGameResponseContainer,
+    KeyContainer,
+    NewGameResponseContainer,
+    OpponentConnectedContainer,
+)
+from igo.gameserver.game_manager import OppponentType
+from igo.gameserver.messages import (
+    IncomingMessageType,
+    OutgoingMessage,
+    OutgoingMessageType,
+)
+
+
+class WireTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        for value in [
+            None,
+            True,
+            False,
+            0,
+            127,
+            128,
+            -1,
+            2**70,
+            -(2**70),
+            0.5,
+            -3.25,
+            "",
+            "game_status",
+            "not a symbol",
+            "üñíçødé",
+            [],
+            [1, [2, [3, None]], "b"],
+            [0, 255, 3],
+            [0, 256],
+            [True, 1],
+            {},
+            {"key": "0123456789", "other": {"nested": [1.5, False]}},
+        ]:
+            self.assertEqual(wire.decode(wire.encode(value)), value)
+        # tuples go as lists, as in JSON
+        self.assertEqual(wire.decode(wire.encode((1, (2, 3)))), [1, [2, 3]])
+        # already encoded values are written as is
+        self.assertEqual(
+            wire.decode(wire.encode([wire.Encoded(wire.encode({"a": 1})), 2])),
+            [{"a": 1}, 2],
+        )
+
+    def test_messages(self):
+        game = Game(9)
+        base_board = bytes(game.board._data)
+        game.take_action(Action(ActionType.place_stone, Color.black, 0, (2, 2)))
+        keys = KeyContainer("0123456789", "9876543210")
+        ts = datetime.now().timestamp()
+        for message_type, data in [
+            (
+                OutgoingMessageType.new_game_response,
+                NewGameResponseContainer(True, "success", keys, Color.white),
+            ),
+            (
+                OutgoingMessageType.join_game_response,
+                JoinGameResponseContainer(False, "failure"),
+            ),
+            (
+                OutgoingMessageType.game_action_response,
+                ActionResponseContainer(True, "success"),
+            ),
+            (OutgoingMessageType.game_status, GameStatusContainer(game, 1.5)),
+            (
+                OutgoingMessageType.game_status,
+                GameStatusContainer(game, 1.5, 1, True),
+            ),
+            (
+                OutgoingMessageType.game_status_delta,
+                GameStatusDeltaContainer.from_boards(game, 1.5, 0, base_board),
+            ),
+            (
+                OutgoingMessageType.chat,
+                ChatThread([ChatMessage(ts, Color.black, "hi bob", "1")], True),
+            ),
+            (OutgoingMessageType.opponent_connected, OpponentConnectedContainer(True)),
+            (OutgoingMessageType.error, ErrorContainer(Exception("error"))),
+        ]:
+            msg = OutgoingMessage(message_type, data)
+            encoded = wire.encode(msg.jsonifyable())
+            jsonified = json.dumps(msg.jsonifyable())
+            # decodes to exactly what the JSON would
+            self.assertEqual(wire.decode(encoded), json.loads(jsonified))
+            res = OutgoingMessage.deserialize(wire.decode(encoded))
+            self.assertEqual(
+                json.dumps(res.jsonifyable()),
+                json.dumps(OutgoingMessage.deserialize(jsonified).jsonifyable()),
+            )
+            self.assertLess(len(encoded), len(jsonified))
+
+    def test_symbols(self):
+        # every enum member name on the wire should be a symbol. if this
+        # fails, append the missing names to SYMBOLS and bump the version of
+        # BINARY_SUBPROTOCOL
+        for enum in (
+            IncomingMessageType,
+            OutgoingMessageType,
+            Color,
+            ActionType,
+            GameStatus,
+            RequestType,
+            ResultType,
+            OppponentType,
+        ):
+            for member in enum:
+                self.assertIn(member.name, wire.SYMBOLS)
+
+    def test_invalid(self):
+        with self.assertRaises(TypeError):
+            wire.encode({"a": object()})
+        with self.assertRaises(ValueError):
+            wire.decode(b"")
+        with self.assertRaises(ValueError):
+            # a list promising more items than there are
+            wire.decode(bytes([8, 2, 0x80]))
+        with self.assertRaises(ValueError):
+            wire.decode(wire.encode("not a symbol")[:-1])
+        with self.assertRaises(ValueError):
+            wire.decode(wire.encode([1, 2, 3])[:-1])
+        with self.assertRaises(ValueError):
+            wire.decode(wire.encode([1]) + b"\x00")
+        with self.assertRaises(ValueError):
+            wire.decode(bytes([0x3F]))
+        # a list or dict length beyond the message is rejected before anything
+        # is allocated for it
+        for tag in (8, 9):
+            with self.assertRaisesRegex(ValueError, "exceeds"):
+                wire.decode(bytes([tag, 0x80, 0xE1, 0xEB, 0x17]))
+        with self.assertRaisesRegex(ValueError, "Non-string key"):
+            wire.decode(bytes([9, 1, 8, 0, 0x80]))
+        with self.assertRaises(ValueError):
+            wire.decode(bytes([8, 1]) * 5000 + bytes([0]))
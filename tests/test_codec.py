@@ -0,0 +1,118 @@
+from datetime import datetime
+import pickle
+import random
+import unittest
+from igo.codec import ActionLog, decode_game, encode_game, encode_state
+from igo.game import (
+    Action,
+    ActionType,
+    Color,
+    Game,
+    GameStatus,
+    Request,
+    RequestType,
+    Result,
+    ResultType,
+)
+
+
+class CodecTestCase(unittest.TestCase):
+    def assertRoundTrips(self, game: Game):
+        res = decode_game(encode_game(game))
+        self.assertEqual(res, game)
+        # Game equality only compares initializers and actions, so compare
+        # state as well
+        self.assertEqual(
+            [a.timestamp for a in res.action_stack],
+            [a.timestamp for a in game.action_stack],
+        )
+        self.assertEqual(res.board._data, game.board._data)
+        self.assertIs(res.status, game.status)
+        self.assertIs(res.turn, game.turn)
+        self.assertEqual(res.prisoners, game.prisoners)
+        self.assertEqual(res.territory, game.territory)
+        self.assertEqual(res.pending_request, game.pending_request)
+        self.assertEqual(res.result, game.result)
+        self.assertEqual(res._hash, game._hash)
+        self.assertEqual(res._prev_hash, game._prev_hash)
+        self.assertEqual(res._hash_history, game._hash_history)
+        self.assertEqual(res._marked_dead, game._marked_dead)
+        self.assertEqual(res.legal_moves(), game.legal_moves())
+        return res
+
+    def test_round_trip(self):
+        self.assertRoundTrips(Game())
+        self.assertRoundTrips(Game(1, 0.5))
+
+        with open("sample_game.bin", "rb") as reader:
+            sample_game: Game = pickle.load(reader)
+        self.assertIs(sample_game.status, GameStatus.complete)
+        self.assertRoundTrips(sample_game)
+
+        # random games, with superko and with arbitrary timestamps
+        for size in (5, 19):
+            rng = random.Random(size)
+            g = Game(size, -3.25, superko=True)
+            ts = datetime.now().timestamp()
+            for _ in range(size * size):
+                moves = g.legal_moves()
+                if not moves:
+                    break
+                ts += rng.random() * 60
+                g.take_action(
+                    Action(ActionType.place_stone, g.turn, ts, rng.choice(moves))
+                )
+            self.assertRoundTrips(g)
+
+    def test_action_log(self):
+        with open("sample_game.bin", "rb") as reader:
+            sample_game: Game = pickle.load(reader)
+        actions = sample_game.action_stack
+
+        # extending the log a few actions at a time encodes the game as a whole
+        g = Game(sample_game.board.size, sample_game.komi)
+        log = ActionLog(g.board.size)
+        for start in range(0, len(actions), 3):
+            for action in actions[start : start + 3]:
+                g.take_action(action)
+            log.extend(actions[start : start + 3])
+            self.assertEqual(log.num_actions, g.version())
+            self.assertEqual(log.encode_game(encode_state(g)), encode_game(g))
+        self.assertEqual(decode_game(log.encode_game(encode_state(g))), sample_game)
+
+    def test_requests(self):
+        g = Game(5)
+        g.take_action(Action(ActionType.place_stone, Color.black, 0, (0, 0)))
+        g.take_action(Action(ActionType.place_stone, Color.white, 1, (4, 4)))
+        g.take_action(Action(ActionType.pass_turn, Color.black, 2))
+        g.take_action(Action(ActionType.pass_turn, Color.white, 3))
+        g.take_action(Action(ActionType.mark_dead, Color.white, 4, ((0, 0), (4, 4))))
+        self.assertEqual(g.pending_request, Request(RequestType.mark_dead, Color.white))
+        res = self.assertRoundTrips(g)
+        self.assertEqual(res.action_stack[-1].coords, ((0, 0), (4, 4)))
+        self.assertTrue(res.take_action(Action(ActionType.accept, Color.black, 5))[0])
+
+        g = Game(1)
+        g.take_action(Action(ActionType.resign, Color.black, 0))
+        self.assertEqual(g.result, Result(ResultType.resignation, Color.white))
+        self.assertRoundTrips(g)
+
+        g = Game(1)
+        g.take_action(Action(ActionType.request_draw, Color.black, 0))
+        g.take_action(Action(ActionType.accept, Color.white, 0))
+        self.assertEqual(g.result, Result(ResultType.draw))
+        self.assertRoundTrips(g)
+
+    def test_legacy(self):
+        with open("sample_game.bin", "rb") as reader:
+            data = reader.read()
+        self.assertEqual(decode_game(data), pickle.loads(data))
+
+        with self.assertRaises(ValueError):
+            decode_game(pickle.dumps("not a game"))
+        with self.assertRaises(ValueError):
+            decode_game(b"not a game")
+        data = bytearray(encode_game(Game()))
+        data[2] += 1
+        with self.assertRaises(ValueError):
+            decode_game(bytes(data))
@@ -1,5 +1,10 @@
+from copy import deepcopy
 from datetime import datetime
+import json
+import pickle
+import random
 from typing import Optional
+from unittest.mock import patch
 from igo.game import (
     Action,
     ActionType,
@@ -12,6 +17,9 @@ from igo.game import (
     RequestType,
     Result,
     ResultType,
+    count_territories,
+    neighbor_table,
+    territory_map,
 )
 
 import unittest
@@ -49,6 +57,57 @@ class PointTestCase(unittest.TestCase):
         self.assertEqual(Point.deserialize(p.jsonifyable()), p)
 
 
+class NeighborTableTestCase(unittest.TestCase):
+    def test_neighbor_table(self):
+        table = neighbor_table(3)
+        self.assertIs(table, neighbor_table(3))
+        self.assertEqual(len(table), 9)
+        self.assertSetEqual(set(table[0]), {1, 3})
+        self.assertSetEqual(set(table[4]), {1, 3, 5, 7})
+        self.assertSetEqual(set(table[5]), {2, 4, 8})
+        self.assertEqual(neighbor_table(1), [()])
+
+
+class TerritoryTestCase(unittest.TestCase):
+    def test_territory_map(self):
+        w, b = Color.white.value, Color.black.value
+        # fmt: off
+        colors = [
+            0, w, 0, b,
+            w, w, b, 0,
+            0, b, b, 0,
+            b, 0, 0, 0,
+        ]
+        self.assertEqual(
+            list(territory_map(4, colors)),
+            [
+                w, 0, 0, 0,
+                0, 0, 0, b,
+                0, 0, 0, b,
+                0, b, b, b,
+            ],
+        )
+        # fmt: on
+        self.assertEqual(list(territory_map(2, [0] * 4)), [0] * 4)
+
+    def test_count_territories(self):
+        rng = random.Random(0)
+        boards = []
+        for _ in range(20):
+            b = Board(7)
+            for i in range(7):
+                for j in range(7):
+                    b[i][j].color = rng.choice([None, None, Color.white, Color.black])
+            boards.append(b)
+        expected = [
+            {c: list(b.territory_map()).count(c.value) for c in Color} for b in boards
+        ]
+        self.assertEqual(count_territories(boards), expected)
+        with patch("igo.game.np", None):
+            self.assertEqual(count_territories(boards), expected)
+        self.assertEqual(count_territories([]), [])
+
+
 class BoardTestCase(unittest.TestCase):
     def test_json(self):
         board = Board(3)
@@ -114,6 +173,70 @@ class BoardTestCase(unittest.TestCase):
         b = Board()
         self.assertEqual(Board.deserialize(b.jsonifyable()), b)
 
+    def test_compact(self):
+        b = Board(3)
+        b[0][1].color = Color.black
+        b[1][2].color = Color.white
+        b[1][2].marked_dead = True
+        b[0][0].counted = True
+        b[0][0].counts_for = Color.black
+        b[2][2].counted = True
+        b[2][2].counts_for = Color.white
+        self.assertEqual(
+            b.jsonifyable(True),
+            {
+                "size": 3,
+                "colors": ".b...w...",
+                "markedDead": [5],
+                "counted": [0, 8],
+                "countsFor": {"w": [8], "b": [0]},
+            },
+        )
+        for compact in (False, True):
+            res = Board.deserialize(json.dumps(b.jsonifyable(compact)))
+            self.assertEqual(res._data, b._data)
+
+        with self.assertRaises(ValueError):
+            Board.deserialize({**b.jsonifyable(True), "colors": ".b..xw..."})
+        with self.assertRaises(ValueError):
+            Board.deserialize({**b.jsonifyable(True), "colors": ".b...w.."})
+        # indices which would fall on another plane or off the buffer
+        for index in (-1, 9, 1.0, "1"):
+            with self.assertRaises(ValueError):
+                Board.deserialize({**b.jsonifyable(True), "markedDead": [index]})
+            with self.assertRaises(ValueError):
+                Board.deserialize({**b.jsonifyable(True), "counted": [index]})
+            with self.assertRaises(ValueError):
+                Board.deserialize(
+                    {**b.jsonifyable(True), "countsFor": {"w": [index], "b": []}}
+                )
+
+    def test_views(self):
+        b = Board(3)
+        b[1][2].color = Color.white
+        b[1][2].marked_dead = True
+        b[0][0].counted = True
+        b[0][0].counts_for = Color.black
+        self.assertIs(b[1][2].color, Color.white)
+        self.assertTrue(b[1][2].marked_dead)
+        self.assertIs(b[0][0].counts_for, Color.black)
+        self.assertEqual(b[1][2], Point(Color.white))
+        self.assertEqual(b[-1][-1], Point())
+        with self.assertRaises(IndexError):
+            b[3]
+        with self.assertRaises(IndexError):
+            b[0][3]
+
+        # copies and round trips are independent of the original
+        for dup in (
+            deepcopy(b),
+            pickle.loads(pickle.dumps(b)),
+            Board.deserialize(b.jsonifyable()),
+        ):
+            self.assertEqual(dup.jsonifyable(), b.jsonifyable())
+            dup[0][1].color = Color.black
+            self.assertIsNone(b[0][1].color)
+
 
 class GameTestCase(unittest.TestCase):
     def test_eq(self):
@@ -201,6 +324,27 @@ class GameTestCase(unittest.TestCase):
         self.assertFalse(success)
         self.assertEqual(msg, "Point (0, 0) is occupied")
 
+    def test_off_board(self):
+        # a flat index computed from these would otherwise wrap onto the next
+        # row, or off the color plane altogether
+        for coords in ((0, 3), (3, 0), (0, -1), (-1, 0)):
+            g = Game(3)
+            before = deepcopy(g.board)
+            success, msg = g.take_action(
+                Action(
+                    ActionType.place_stone,
+                    Color.black,
+                    datetime.now().timestamp(),
+                    coords,
+                )
+            )
+            self.assertFalse(success)
+            self.assertEqual(msg, f"{coords} is off the board")
+            self.assertEqual(g.board._data, before._data)
+            self.assertEqual(g.action_stack, [])
+            with self.assertRaises(IndexError):
+                g.chain_at(coords)
+
     def test_suicide(self):
         g = Game(3)
         ts = datetime.now().timestamp()
@@ -257,6 +401,166 @@ class GameTestCase(unittest.TestCase):
         self.assertEqual(g.prisoners[Color.black], 0)
         self.assertEqual(g.prisoners[Color.white], 5)
 
+    def test_placement_rollback(self):
+        # placements are checked against the chains and position hashes
+        # without touching the board, and only applied if legal and not a dry
+        # run, so check that an illegal move or a dry run leaves the board,
+        # prisoners and turn as they were
+        g = Game(4)
+        ts = datetime.now().timestamp()
+        for a in [
+            Action(ActionType.place_stone, Color.black, ts, (1, 0)),
+            Action(ActionType.place_stone, Color.white, ts, (2, 0)),
+            Action(ActionType.place_stone, Color.black, ts, (0, 1)),
+            Action(ActionType.place_stone, Color.white, ts, (3, 1)),
+            Action(ActionType.place_stone, Color.black, ts, (1, 2)),
+            Action(ActionType.place_stone, Color.white, ts, (2, 2)),
+            Action(ActionType.place_stone, Color.black, ts, (2, 1)),
+            Action(ActionType.place_stone, Color.white, ts, (1, 1)),
+        ]:
+            g.take_action(a)
+        before = deepcopy(g.board)
+
+        # ko
+        success, _ = g._place_stone_base(Color.black, (2, 1))
+        self.assertFalse(success)
+        self.assertEqual(g.board, before)
+
+        # suicide
+        success, _ = g._place_stone_base(Color.black, (3, 0))
+        self.assertFalse(success)
+        self.assertEqual(g.board, before)
+
+        # dry run with a capture
+        success, _ = g._place_stone_base(Color.black, (0, 0), True)
+        self.assertTrue(success)
+        self.assertEqual(g.board, before)
+        self.assertEqual(g.prisoners[Color.black], 0)
+        self.assertIs(g.turn, Color.black)
+
+    def test_superko(self):
+        # black's last placement captures the white stone at (2, 0) and
+        # recreates the position after black's second placement. this is fine
+        # under the simple ko rule but not under positional superko
+        moves = [(2, 1), (1, 1), (1, 0), (0, 1), (0, 0), (2, 0), (1, 0)]
+        ts = datetime.now().timestamp()
+        for superko in (False, True):
+            g = Game(3, superko=superko)
+            for coords in moves:
+                success, msg = g.take_action(
+                    Action(ActionType.place_stone, g.turn, ts, coords)
+                )
+            self.assertIs(success, not superko)
+            if superko:
+                self.assertEqual(
+                    msg, "Playing at (1, 0) violates the positional superko rule"
+                )
+
+    def test_zobrist_hash(self):
+        # the incrementally maintained hash should always agree with hashing
+        # the board from scratch
+        with open("sample_game.bin", "rb") as reader:
+            sample_game: Game = pickle.load(reader)
+        self.assertEqual(sample_game._hash, sample_game.board.zobrist_hash())
+        g = Game(sample_game.board.size, sample_game.komi)
+        self.assertEqual(g._hash, 0)
+        for a in sample_game.action_stack:
+            g.take_action(a)
+            self.assertEqual(g._hash, g.board.zobrist_hash())
+        self.assertEqual(g._hash, sample_game._hash)
+
+    def test_chains(self):
+        def snapshot(g: Game):
+            return {
+                (i, j): (c.color, frozenset(c.stones), frozenset(c.liberties))
+                for i in range(g.board.size)
+                for j in range(g.board.size)
+                for c in [g.chain_at((i, j))]
+                if c
+            }
+
+        # the incrementally maintained chains should always agree with those
+        # built from scratch, including through captures
+        rng = random.Random(0)
+        ts = datetime.now().timestamp()
+        g = Game(5)
+        for _ in range(200):
+            moves = g.legal_moves()
+            if not moves:
+                break
+            g.take_action(
+                Action(ActionType.place_stone, g.turn, ts, rng.choice(moves))
+            )
+            chains = snapshot(g)
+            g._chains = None
+            self.assertEqual(chains, snapshot(g))
+        self.assertGreater(sum(g.prisoners.values()), 0)
+
+        g = Game(3)
+        g.take_action(Action(ActionType.place_stone, Color.black, ts, (0, 0)))
+        g.take_action(Action(ActionType.place_stone, Color.white, ts, (2, 2)))
+        g.take_action(Action(ActionType.place_stone, Color.black, ts, (0, 1)))
+        chain = g.chain_at((0, 0))
+        self.assertIs(chain, g.chain_at((0, 1)))
+        self.assertIs(chain.color, Color.black)
+        # flat indices
+        self.assertSetEqual(chain.stones, {0, 1})
+        self.assertSetEqual(chain.liberties, {3, 4, 2})
+        self.assertIsNone(g.chain_at((1, 1)))
+
+        # modifying the board directly is picked up too
+        g.board[1][1].color = Color.white
+        self.assertSetEqual(g.chain_at((0, 0)).liberties, {3, 2})
+
+    def test_legal_moves_incremental(self):
+        # only the points affected by each placement are rescreened, so check
+        # against screening every point from scratch through plenty of
+        # captures, with and without superko
+        rng = random.Random(0)
+        ts = datetime.now().timestamp()
+        for superko in (False, True):
+            g = Game(5, superko=superko)
+            for _ in range(200):
+                moves = g.legal_moves()
+                self.assertListEqual(
+                    moves,
+                    [
+                        (i, j)
+                        for i in range(5)
+                        for j in range(5)
+                        if g._place_stone_base(g.turn, (i, j), True)[0]
+                    ],
+                )
+                if not moves:
+                    break
+                g.take_action(
+                    Action(ActionType.place_stone, g.turn, ts, rng.choice(moves))
+                )
+            self.assertGreater(sum(g.prisoners.values()), 0)
+
+    def test_pickle(self):
+        # set up a ko and make sure that it is still detected after a round
+        # trip through pickle
+        g = Game(4)
+        ts = datetime.now().timestamp()
+        for a in [
+            Action(ActionType.place_stone, Color.black, ts, (1, 0)),
+            Action(ActionType.place_stone, Color.white, ts, (2, 0)),
+            Action(ActionType.place_stone, Color.black, ts, (0, 1)),
+            Action(ActionType.place_stone, Color.white, ts, (3, 1)),
+            Action(ActionType.place_stone, Color.black, ts, (1, 2)),
+            Action(ActionType.place_stone, Color.white, ts, (2, 2)),
+            Action(ActionType.place_stone, Color.black, ts, (2, 1)),
+            Action(ActionType.place_stone, Color.white, ts, (1, 1)),
+        ]:
+            g.take_action(a)
+        g = pickle.loads(pickle.dumps(g))
+        success, msg = g.take_action(
+            Action(ActionType.place_stone, Color.black, ts, (2, 1))
+        )
+        self.assertFalse(success)
+        self.assertEqual(msg, "Playing at (2, 1) violates the simple ko rule")
+
     def test_pass_assertions(self):
         g = Game(1)
         a = Action(ActionType.pass_turn, Color.white, datetime.now().timestamp())
@@ -391,6 +695,58 @@ class GameTestCase(unittest.TestCase):
         self.assertFalse(success)
         self.assertEqual(msg, "There is no group at (2, 2) to mark dead")
 
+        # as does mark dead off the board
+        a.coords = (0, 3)
+        success, msg = g.take_action(a)
+        self.assertFalse(success)
+        self.assertEqual(msg, "(0, 3) is off the board")
+
+    def test_mark_dead_batch(self):
+        g = Game(5)
+        g.board[0][0].color = Color.white
+        g.board[0][1].color = Color.white
+        g.board[4][4].color = Color.black
+        g.board[2][2].color = Color.white
+        g.status = GameStatus.endgame
+        ts = datetime.now().timestamp()
+
+        # a single empty point fails the whole batch, marking nothing
+        a = Action(ActionType.mark_dead, Color.white, ts, ((0, 0), (3, 3)))
+        success, msg = g.take_action(a)
+        self.assertFalse(success)
+        self.assertEqual(msg, "There is no group at (3, 3) to mark dead")
+        self.assertFalse(g.board[0][0].marked_dead)
+        self.assertIs(g.status, GameStatus.endgame)
+
+        # groups of both colors can be marked at once, and naming a group
+        # twice marks it once
+        a.coords = ((0, 0), (4, 4), (0, 1))
+        success, msg = g.take_action(a)
+        self.assertTrue(success)
+        self.assertEqual(msg, "3 stones marked as dead. Awaiting response...")
+        self.assertEqual(
+            [(i, j) for i in range(5) for j in range(5) if g.board[i][j].marked_dead],
+            [(0, 0), (0, 1), (4, 4)],
+        )
+
+        # the pending marks survive a round trip through pickle
+        g = pickle.loads(pickle.dumps(g))
+        success, msg = g.take_action(Action(ActionType.accept, Color.black, ts))
+        self.assertTrue(success)
+        self.assertEqual(
+            msg,
+            "Black accepted white's request to mark 2 white and 1 black stones as"
+            " dead",
+        )
+        self.assertEqual(g.prisoners, {Color.white: 1, Color.black: 2})
+        self.assertEqual(
+            [(i, j) for i in range(5) for j in range(5) if g.board[i][j].color],
+            [(2, 2)],
+        )
+        self.assertFalse(
+            any(g.board[i][j].marked_dead for i in range(5) for j in range(5))
+        )
+
     def test_request_draw_assertions(self):
         g = Game(1)
         a = Action(ActionType.request_draw, Color.black, datetime.now().timestamp())
@@ -0,0 +1,104 @@
+from datetime import datetime
+import pickle
+import random
+import unittest
+from igo.game import Action, ActionType, Color, Game
+from igo.replay import Replay, replay_all
+
+
+class ReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        with open("sample_game.bin", "rb") as reader:
+            self.sample_game: Game = pickle.load(reader)
+
+    @staticmethod
+    def naive(game: Game, k: int) -> Game:
+        res = Game(game.board.size, game.komi, game.superko)
+        for action in game.action_stack[:k]:
+            res.take_action(action)
+        return res
+
+    def assertSamePosition(self, g1: Game, g2: Game):
+        self.assertEqual(g1.action_stack, g2.action_stack)
+        self.assertEqual(g1.board._data, g2.board._data)
+        self.assertIs(g1.status, g2.status)
+        self.assertIs(g1.turn, g2.turn)
+        self.assertEqual(g1.prisoners, g2.prisoners)
+        self.assertEqual(g1.territory, g2.territory)
+        self.assertEqual(g1.pending_request, g2.pending_request)
+        self.assertEqual(g1.result, g2.result)
+        self.assertEqual(g1._hash, g2._hash)
+        self.assertEqual(g1._prev_hash, g2._prev_hash)
+        self.assertEqual(g1._hash_history, g2._hash_history)
+        self.assertEqual(g1.legal_moves(), g2.legal_moves())
+
+    def test_position_at(self):
+        r = Replay.from_game(self.sample_game, 8)
+        self.assertEqual(len(r), len(self.sample_game.action_stack))
+        self.assertEqual(r.position, len(r))
+        for k in range(len(r) + 1):
+            self.assertSamePosition(r.position_at(k), self.naive(self.sample_game, k))
+        # the cursor doesn't move
+        self.assertEqual(r.position, len(r))
+
+        # positions are independent of one another and of the replay
+        g = r.position_at(3)
+        g.take_action(Action(ActionType.resign, g.turn, datetime.now().timestamp()))
+        self.assertSamePosition(r.position_at(3), self.naive(self.sample_game, 3))
+
+        with self.assertRaises(IndexError):
+            r.position_at(len(r) + 1)
+        with self.assertRaises(IndexError):
+            r.position_at(-1)
+
+    def test_stepping(self):
+        r = Replay.from_game(self.sample_game, 8)
+        for k in reversed(range(len(r))):
+            self.assertSamePosition(r.step_back(), self.naive(self.sample_game, k))
+            self.assertEqual(r.position, k)
+        with self.assertRaises(IndexError):
+            r.step_back()
+        for k in range(1, len(r) + 1):
+            self.assertSamePosition(r.step_forward(), self.naive(self.sample_game, k))
+        with self.assertRaises(IndexError):
+            r.step_forward()
+
+        rng = random.Random(0)
+        for _ in range(50):
+            k = rng.randrange(len(r) + 1)
+            self.assertSamePosition(r.seek(k), self.naive(self.sample_game, k))
+
+    def test_superko(self):
+        g = Game(3, superko=True)
+        ts = datetime.now().timestamp()
+        for i, coords in enumerate([(2, 1), (1, 1), (1, 0), (0, 1), (0, 0), (2, 0)]):
+            g.take_action(
+                Action(
+                    ActionType.place_stone,
+                    Color.black if i % 2 == 0 else Color.white,
+                    ts,
+                    coords,
+                )
+            )
+        r = Replay.from_game(g, 4)
+        for k in range(len(r) + 1):
+            self.assertSamePosition(r.position_at(k), self.naive(g, k))
+        success, msg = r.game.take_action(
+            Action(ActionType.place_stone, Color.black, ts, (1, 0))
+        )
+        self.assertFalse(success)
+        self.assertEqual(msg, "Playing at (1, 0) violates the positional superko rule")
+
+    def test_invalid(self):
+        ts = datetime.now().timestamp()
+        with self.assertRaises(ValueError):
+            Replay([Action(ActionType.place_stone, Color.white, ts, (0, 0))], 9)
+        with self.assertRaises(ValueError):
+            Replay([], 9, interval=0)
+
+    def test_replay_all(self):
+        replays = replay_all([self.sample_game, Game(9)])
+        self.assertEqual(
+            [len(r) for r in replays], [len(self.sample_game.action_stack), 0]
+        )
+        self.assertSamePosition(replays[1].game, Game(9))